@@ -0,0 +1,76 @@
+"""Logging pipeline benchmark
+
+Compares the time a handler thread spends in a START/END like ``logger.info`` call with a synchronous
+``StreamHandler`` and with the queue handler of ``nsqworker.logs.stream_handler``, for a stream whose writes take
+``--write-us`` microseconds (a stdout pipe read slower than it is written).
+
+Usage: python benchmarks/logging_pipeline.py [--messages N] [--threads N] [--write-us N]
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nsqworker import logs  # noqa: E402
+
+
+class SlowStream(object):
+    def __init__(self, write_us):
+        self.write_s = write_us / 1e6
+        self.lines = 0
+
+    def write(self, data):
+        time.sleep(self.write_s)
+        self.lines += 1
+
+    def flush(self):
+        pass
+
+
+def run(handler, messages, threads):
+    """Microseconds per logging call
+    """
+    logger = logging.getLogger("benchmark.{}".format(id(handler)))
+    logger.propagate = 0
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    def log():
+        for i in range(messages // threads):
+            logger.info("[%s] [END] [topic=%s] [channel=%s] [event=%s] [route=%s] [try_num=%s] [status=%s] [time=%s]",
+                        "a1b2c3d4e5", "topic", "channel", "event", "route", 1, "OK", i)
+
+    workers = [threading.Thread(target=log) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / messages * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=8000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--write-us", type=int, default=50)
+    args = parser.parse_args()
+
+    sync_stream = SlowStream(args.write_us)
+    sync = run(logging.StreamHandler(sync_stream), args.messages, args.threads)
+
+    queued = logs.stream_handler("%(asctime)s - %(levelname)s - %(message)s")
+    queued.target.stream = SlowStream(args.write_us)
+    queued_us = run(queued, args.messages, args.threads)
+    logs._stop_writer()
+
+    print("{:>12} {:>12} {:>9} {:>9}".format("sync (us)", "queued (us)", "speedup", "dropped"))
+    print("{:>12.1f} {:>12.1f} {:>8.1f}x {:>9}".format(sync, queued_us, sync / queued_us, queued.dropped))
+
+
+if __name__ == "__main__":
+    main()
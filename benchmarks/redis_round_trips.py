@@ -0,0 +1,276 @@
+"""Redis round trips benchmark
+
+Runs the redis calls made per message by a locked route, before (``redis.lock`` per message, separate clients for
+the locker and the persistor) and after ``RedisAccess`` (shared pool, lock scripts, batched release + persist),
+against an in-process stand-in speaking the redis protocol, which counts round trips and adds a fixed latency to each.
+
+``RedisAccess`` saves the round trip of the failed message persistence (pipelined with the lock release) and the one
+of the lock ttl on contention (returned by the acquire script). A successful locked route still takes two round trips:
+the lock is acquired before the handler runs and released after it, neither can be sent along with another command.
+The hundredth above the whole numbers is the connection setup and the script loads of the first message.
+
+Usage: python benchmarks/redis_round_trips.py [--messages N] [--latency-ms MS]
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import redis  # noqa: E402
+
+
+class StandInRedis(object):
+    """Minimal single process redis: strings with ttl, sorted set adds and the lock scripts (recognized by content)
+    """
+
+    def __init__(self, latency_ms):
+        self.latency = latency_ms / 1000.0
+        self.data = {}
+        self.expires = {}
+        self.scripts = {}
+        self.round_trips = 0
+        self.commands = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = socket.socket()
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(64)
+        self.port = self._server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def reset_counters(self):
+        self.round_trips = self.commands = self.connections = 0
+
+    def _accept(self):
+        while True:
+            conn, _ = self._server.accept()
+            self.connections += 1
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        buf = b""
+        resp3 = False
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                return
+            buf += data
+            replies = []
+            while True:
+                command, buf = _parse_command(buf)
+                if command is None:
+                    break
+                resp3 = resp3 or (command[0].upper() == b"HELLO" and command[1:2] == [b"3"])
+                with self._lock:
+                    self.commands += 1
+                    replies.append(_encode(self._execute(command), resp3))
+            if replies:
+                self.round_trips += 1
+                time.sleep(self.latency)
+                conn.sendall(b"".join(replies))
+
+    def _alive(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def _pttl(self, key):
+        if not self._alive(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return int((self.expires[key] - time.monotonic()) * 1000)
+
+    def _execute(self, command):
+        name = command[0].upper()
+        args = command[1:]
+        if name in (b"PING", b"CLIENT", b"SELECT"):
+            return b"+OK"
+        if name == b"HELLO":
+            return {b"server": b"redis", b"version": b"7.0.0", b"proto": int(args[0])}
+        if name == b"SET":
+            key, value, options = args[0], args[1], [a.upper() for a in args[2:]]
+            if b"NX" in options and self._alive(key):
+                return None
+            self.data[key] = value
+            self.expires.pop(key, None)
+            if b"PX" in options:
+                self.expires[key] = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000.0
+            return b"+OK"
+        if name == b"GET":
+            return self.data.get(args[0]) if self._alive(args[0]) else None
+        if name == b"PTTL":
+            return self._pttl(args[0])
+        if name == b"ZADD":
+            return 1
+        if name == b"SCRIPT":
+            if args[0].upper() == b"LOAD":
+                sha = hashlib.sha1(args[1]).hexdigest().encode()
+                self.scripts[sha] = args[1]
+                return sha
+            return [1 if sha in self.scripts else 0 for sha in args[1:]]
+        if name in (b"EVAL", b"EVALSHA"):
+            script = args[0] if name == b"EVAL" else self.scripts.get(args[0])
+            if script is None:
+                return redis.exceptions.NoScriptError("NOSCRIPT No matching script")
+            key_count = int(args[1])
+            return self._script(script, args[2:2 + key_count], args[2 + key_count:])
+        return redis.exceptions.ResponseError("unknown command {}".format(name))
+
+    def _script(self, script, keys, argv):
+        key = keys[0]
+        if b"'set'" in script:
+            # acquire
+            if self._alive(key):
+                return [0, self._pttl(key)]
+            self.data[key] = argv[0]
+            self.expires[key] = time.monotonic() + int(argv[1]) / 1000.0
+            return [1, 0]
+        held = self._alive(key) and self.data[key] == argv[0]
+        if b"'del'" in script:
+            if held:
+                del self.data[key]
+                self.expires.pop(key, None)
+            return 1 if held else 0
+        if b"pexpire" in script:
+            if held:
+                self.expires[key] = time.monotonic() + int(argv[1]) / 1000.0
+            return 1 if held else 0
+        return redis.exceptions.ResponseError("unknown script")
+
+
+def _parse_command(buf):
+    if not buf.startswith(b"*"):
+        return None, buf
+    end = buf.find(b"\r\n")
+    if end < 0:
+        return None, buf
+    count = int(buf[1:end])
+    pos = end + 2
+    parts = []
+    for _ in range(count):
+        end = buf.find(b"\r\n", pos)
+        if end < 0:
+            return None, buf
+        size = int(buf[pos + 1:end])
+        start = end + 2
+        if len(buf) < start + size + 2:
+            return None, buf
+        parts.append(buf[start:start + size])
+        pos = start + size + 2
+    return parts, buf[pos:]
+
+
+def _encode(value, resp3):
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(value, Exception):
+        return b"-" + str(value).encode() + b"\r\n"
+    if isinstance(value, int):
+        return b":" + str(value).encode() + b"\r\n"
+    if isinstance(value, dict):
+        items = b"".join(_encode(k, resp3) + _encode(v, resp3) for k, v in value.items())
+        return b"%" + str(len(value)).encode() + b"\r\n" + items
+    if isinstance(value, list):
+        return b"*" + str(len(value)).encode() + b"\r\n" + b"".join(_encode(v, resp3) for v in value)
+    if value.startswith(b"+"):
+        return value + b"\r\n"
+    return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+
+
+def _doc(i):
+    return json.dumps({"topic": "t", "channel": "c", "route": "r", "message": "m{}".format(i), "error_str": "e"})
+
+
+def before(server, messages, fail):
+    """The redis calls of the baseline lock wrapper and persistor"""
+    locker_redis = redis.StrictRedis(host="127.0.0.1", port=server.port)
+    persistor_redis = redis.StrictRedis(host="127.0.0.1", port=server.port)
+    for i in range(messages):
+        lock = locker_redis.lock("svc:lock:ev:{}".format(i), timeout=10, blocking_timeout=10, sleep=0.02)
+        lock.acquire()
+        lock.release()
+        if fail:
+            persistor_redis.zadd("eh:messages:failed", {_doc(i): time.time()})
+
+
+def after(server, messages, fail):
+    from locker.redis_access import RedisAccess
+    from locker.redis_locker import NsqLockOptions, RedisLocker
+
+    access = RedisAccess("127.0.0.1", server.port, max_connections=4)
+    locker = RedisLocker("svc", redis_access=access)
+    options = NsqLockOptions("id")
+    for i in range(messages):
+        with access.batch():
+            lock = locker.get_lock_object("ev:{}".format(i), options)
+            lock.lock()
+            lock.unlock()
+            if fail:
+                access.zadd("eh:messages:failed", time.time(), _doc(i))
+
+
+def contended_before(server, messages):
+    """A requeue on contention needs the lock ttl: a try plus a PTTL"""
+    client = redis.StrictRedis(host="127.0.0.1", port=server.port)
+    client.set("svc:lock:hot", "holder", px=60000)
+    for _ in range(messages):
+        client.lock("svc:lock:hot", timeout=10).acquire(blocking=False)
+        client.pttl("svc:lock:hot")
+
+
+def contended_after(server, messages):
+    from locker.redis_access import RedisAccess
+    from locker.redis_locker import NsqLockOptions, RedisLocker
+
+    access = RedisAccess("127.0.0.1", server.port, max_connections=4)
+    access.redis.set("svc:lock:hot", "holder", px=60000)
+    lock_options = NsqLockOptions("id")
+    locker = RedisLocker("svc", redis_access=access)
+    for _ in range(messages):
+        lock = locker.get_lock_object("hot", lock_options)
+        lock.try_lock()
+        lock.requeue_delay(1)
+
+
+def run(name, server, func, *args):
+    server.reset_counters()
+    start = time.perf_counter()
+    func(server, *args)
+    elapsed = time.perf_counter() - start
+    messages = args[0]
+    print("{:<32} {:>8.2f} {:>10} {:>8.1f} {:>12}".format(
+        name, server.round_trips / float(messages), server.commands, elapsed * 1000, server.connections))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=0.5)
+    args = parser.parse_args()
+
+    server = StandInRedis(args.latency_ms)
+    os.environ["REDIS_HOST"] = "127.0.0.1"
+    # read by locker.redis_locker on import
+    os.environ["REDIS_PORT"] = str(server.port)
+
+    print("{} messages, {}ms per round trip".format(args.messages, args.latency_ms))
+    print("{:<32} {:>8} {:>10} {:>8} {:>12}".format("scenario", "rt/msg", "commands", "ms", "connections"))
+    run("locked route ok, before", server, before, args.messages, False)
+    run("locked route ok, after", server, after, args.messages, False)
+    run("locked route failed, before", server, before, args.messages, True)
+    run("locked route failed, after", server, after, args.messages, True)
+    run("contended requeue, before", server, contended_before, args.messages)
+    run("contended requeue, after", server, contended_after, args.messages)
+
+
+if __name__ == "__main__":
+    main()
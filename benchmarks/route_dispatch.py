@@ -0,0 +1,63 @@
+"""Route dispatch benchmark
+
+Compares the linear matcher scan used before the route index with ``RouteTable.match`` for a growing number
+of ``json_matcher("name", ...)`` routes plus a few opaque (lambda / regex) routes.
+
+Usage: python benchmarks/route_dispatch.py [--iterations N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from nsqworker.basic_matchers import apply_matcher, json_matcher, regex_matcher  # noqa: E402
+from nsqworker.parsed_message import ParsedMessage  # noqa: E402
+from nsqworker.routing import RouteTable  # noqa: E402
+
+ROUTE_COUNTS = [1, 10, 30, 100, 300, 1000]
+
+
+def _handler(self, message):
+    pass
+
+
+def build_table(route_count):
+    table = RouteTable()
+    for i in range(route_count):
+        table.add(json_matcher("name", "event.{}".format(i)), _handler)
+
+    table.add(lambda body: b"audit" in body, _handler)
+    table.add(regex_matcher(b"^ping$"), _handler)
+
+    return table
+
+
+def linear_match(table, parsed):
+    return [r for r in table.routes if apply_matcher(r.matcher_func, parsed) is True]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>14} {:>9}".format("routes", "linear (us)", "indexed (us)", "speedup"))
+    for route_count in ROUTE_COUNTS:
+        table = build_table(route_count)
+        body = json.dumps({"name": "event.{}".format(route_count // 2), "data": {"id": 42}}).encode()
+
+        assert linear_match(table, ParsedMessage(body)) == table.match(ParsedMessage(body))
+
+        # a fresh ParsedMessage per dispatch, so both sides pay for decoding the body once
+        linear = timeit.timeit(lambda: linear_match(table, ParsedMessage(body)), number=args.iterations)
+        indexed = timeit.timeit(lambda: table.match(ParsedMessage(body)), number=args.iterations)
+
+        print("{:>8} {:>14.2f} {:>14.2f} {:>8.1f}x".format(
+            route_count, linear / args.iterations * 1e6, indexed / args.iterations * 1e6, linear / indexed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import logging
+import os
+import threading
+import time
+
+import redis as redis_client
+
+# seconds between two renewal rounds, a lease is renewed once a third of its ttl elapsed
+LEASE_TICK_DURATION = 0.5
+
+
+class Lease:
+    """
+    A lock held by this process and renewed by a ``LeaseWatchdog``, ``lost`` is set if the lock expired or was taken
+    by someone else before it could be renewed
+    """
+
+    def __init__(self, name, token, ttl_ms):
+        self.name = name
+        self.token = token
+        self.ttl_ms = ttl_ms
+        self.renew_at = time.monotonic() + ttl_ms / 3000.0
+        self.lost = False
+
+
+class LeaseWatchdog:
+    """
+    Background thread renewing the leases of all the locks held by the process, the leases due for renewal are
+    renewed together in a single redis pipeline per tick
+    """
+
+    def __init__(self, redis_access, logger=None, tick=LEASE_TICK_DURATION):
+        """
+        :type redis_access: locker.redis_access.RedisAccess
+        """
+        self.redis_access = redis_access
+        self.logger = logger or logging.getLogger("LeaseWatchdog")
+        self.tick = tick
+        self.__leases = set()
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__pid = None
+
+    def register(self, name, token, ttl_ms):
+        """
+        Start renewing a lock
+        :rtype: Lease
+        """
+        lease = Lease(name, token, ttl_ms)
+        with self.__lock:
+            self.__leases.add(lease)
+            # the thread doesn't survive a fork
+            if self.__thread is None or self.__pid != os.getpid():
+                self.__pid = os.getpid()
+                self.__thread = threading.Thread(target=self.__run, name="LeaseWatchdog")
+                self.__thread.daemon = True
+                self.__thread.start()
+        return lease
+
+    def unregister(self, lease):
+        with self.__lock:
+            self.__leases.discard(lease)
+
+    def __run(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.renew()
+            except Exception as e:
+                self.logger.warning("Renewing locks failed with error: {}".format(e))
+
+    def renew(self):
+        """
+        Renew the leases due for renewal, returns the number of renewed leases
+        """
+        now = time.monotonic()
+        with self.__lock:
+            due = [lease for lease in self.__leases if lease.renew_at <= now]
+        if not due:
+            return 0
+
+        pipe = self.redis_access.redis.pipeline(transaction=False)
+        for lease in due:
+            self.redis_access.extend(lease.name, lease.token, lease.ttl_ms, client=pipe)
+        try:
+            results = pipe.execute()
+        except redis_client.RedisError as re:
+            # retried on the next tick, as long as the leases didn't expire
+            self.logger.warning("Failed renewing {} locks with redis error: {}".format(len(due), re))
+            return 0
+
+        renewed = 0
+        for lease, result in zip(due, results):
+            if result == 1:
+                lease.renew_at = now + lease.ttl_ms / 3000.0
+                renewed += 1
+                continue
+
+            with self.__lock:
+                if lease not in self.__leases:
+                    # released meanwhile
+                    continue
+                self.__leases.discard(lease)
+            lease.lost = True
+            self.logger.warning("Lock {} expired or was taken before being renewed".format(lease.name))
+
+        return renewed
@@ -0,0 +1,173 @@
+import os
+import threading
+from contextlib import contextmanager
+
+import redis as redis_client
+
+# seconds a thread waits for a free pooled connection before failing with a ConnectionError
+POOL_TIMEOUT = 5
+DEFAULT_MAX_CONNECTIONS = 50
+
+# KEYS[1] - lock name, ARGV[1] - token, ARGV[2] - ttl in milliseconds
+# returns {1, 0} if the lock was acquired, {0, pttl of the current holder} otherwise
+LUA_ACQUIRE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return {1, 0}
+end
+return {0, redis.call('pttl', KEYS[1])}
+"""
+
+# KEYS[1] - lock name, ARGV[1] - token, returns 1 if the lock was held with the token and deleted
+LUA_RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# KEYS[1] - key, ARGV[1] - ttl in seconds
+# returns the current value of the key if it exists, otherwise sets it to "running" and returns nil
+LUA_CLAIM_SCRIPT = """
+local state = redis.call('get', KEYS[1])
+if state then
+    return state
+end
+redis.call('set', KEYS[1], 'running', 'EX', ARGV[1])
+return false
+"""
+
+# KEYS[1] - lock name, ARGV[1] - token, ARGV[2] - new ttl in milliseconds, returns 1 if the lock was held and extended
+LUA_EXTEND_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+def _pipeline_eval(pipeline, script, keys, args):
+    # EVAL rather than a pipelined Script, which costs an extra SCRIPT EXISTS round trip on every execute
+    return pipeline.eval(script.script, len(keys), *(keys + args))
+
+
+class RedisAccess:
+    """
+    Redis client shared by the locker and the message persistor of an ``NSQHandler``
+
+    Connections come from a single bounded pool (a thread waits for a free connection instead of opening a new one),
+    lock operations are single round trip scripts registered once, and the writes issued by a thread inside a
+    ``batch`` block are sent in a single pipeline when the block exits.
+    """
+
+    def __init__(self, host, port, password=None, max_connections=DEFAULT_MAX_CONNECTIONS):
+        self.pool = redis_client.BlockingConnectionPool(host=host, port=int(port), db=0, password=password,
+                                                        max_connections=max_connections, timeout=POOL_TIMEOUT)
+        self.redis = redis_client.StrictRedis(connection_pool=self.pool)
+        self.__acquire_script = self.redis.register_script(LUA_ACQUIRE_SCRIPT)
+        self.__release_script = self.redis.register_script(LUA_RELEASE_SCRIPT)
+        self.__extend_script = self.redis.register_script(LUA_EXTEND_SCRIPT)
+        self.__claim_script = self.redis.register_script(LUA_CLAIM_SCRIPT)
+        self.__local = threading.local()
+
+    @classmethod
+    def from_env(cls, max_connections=DEFAULT_MAX_CONNECTIONS):
+        """
+        Returns a client for REDIS_HOST / REDIS_PORT, None if they are not set
+        """
+        host = os.environ.get("REDIS_HOST")
+        port = os.environ.get("REDIS_PORT")
+        if not all([host, port]):
+            return None
+        return cls(host, port, os.environ.get("REDIS_PASSWORD", None), max_connections)
+
+    def acquire(self, name, token, ttl_ms):
+        """
+        Try once to lock `name` with `token`
+        :return: (True, 0) if the lock was acquired, (False, milliseconds left to the current holder) otherwise
+        :rtype: (bool, int)
+        """
+        acquired, pttl = self.__acquire_script(keys=[name], args=[token, ttl_ms])
+        return bool(acquired), int(pttl)
+
+    def release(self, name, token, on_result=None):
+        """
+        Release `name` if it is held with `token`
+        :return: True if it was, False if it wasn't, None if the release was batched (``on_result`` is then called
+                 with the script result, or the error, when the batch is sent)
+        """
+        if self._pipeline is not None:
+            _pipeline_eval(self._pipeline, self.__release_script, [name], [token])
+            self.__local.callbacks.append(on_result)
+            return None
+        return bool(self.__release_script(keys=[name], args=[token]))
+
+    def extend(self, name, token, ttl_ms, client=None):
+        """
+        Reset the ttl of `name` if it is held with `token`, returns True if it was
+        ``client`` - optional pipeline to queue the command on, its result is then returned by ``execute``
+        """
+        if client is not None:
+            return _pipeline_eval(client, self.__extend_script, [name], [token, ttl_ms])
+        return bool(self.__extend_script(keys=[name], args=[token, ttl_ms]))
+
+    def claim(self, name, ttl):
+        """
+        Set `name` to "running" for `ttl` seconds unless it exists
+        :return: None if it was set, its current value otherwise
+        """
+        return self.__claim_script(keys=[name], args=[ttl])
+
+    def _write(self, on_result, command, *args, **kwargs):
+        if self._pipeline is not None:
+            getattr(self._pipeline, command)(*args, **kwargs)
+            self.__local.callbacks.append(on_result)
+            return None
+        return getattr(self.redis, command)(*args, **kwargs)
+
+    def zadd(self, key, score, member, on_result=None):
+        """
+        Returns the number of added members, None if the write was batched (see ``release``)
+        """
+        return self._write(on_result, "zadd", key, {member: score})
+
+    def set_expiring(self, key, value, ttl, on_result=None):
+        """
+        Set `key` to `value` for `ttl` seconds, None if the write was batched
+        """
+        return self._write(on_result, "set", key, value, ex=ttl)
+
+    def delete(self, key, on_result=None):
+        """
+        Returns the number of deleted keys, None if the write was batched
+        """
+        return self._write(on_result, "delete", key)
+
+    @property
+    def _pipeline(self):
+        return getattr(self.__local, "pipeline", None)
+
+    @contextmanager
+    def batch(self):
+        """
+        Writes (``release``, ``zadd``, ``set_expiring``, ``delete``) issued by the current thread inside the block are
+        sent in a single pipeline when it exits, nested blocks join the outer one
+        """
+        if self._pipeline is not None:
+            yield
+            return
+
+        self.__local.pipeline = self.redis.pipeline(transaction=False)
+        self.__local.callbacks = []
+        try:
+            yield
+        finally:
+            pipeline, callbacks = self.__local.pipeline, self.__local.callbacks
+            self.__local.pipeline = self.__local.callbacks = None
+            if callbacks:
+                try:
+                    results = pipeline.execute(raise_on_error=False)
+                except redis_client.RedisError as re:
+                    results = [re] * len(callbacks)
+                for callback, result in zip(callbacks, results):
+                    if callback is not None:
+                        callback(result)
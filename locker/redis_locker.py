@@ -1,9 +1,14 @@
 import logging
 import os
+import random
 import time
+import uuid
 
 import redis as redis_client
 
+from .lease_watchdog import LeaseWatchdog
+from .redis_access import RedisAccess
+
 REDIS_HOST = os.environ.get("REDIS_HOST")
 REDIS_PORT = os.environ.get("REDIS_PORT")
 REDIS_PASSWORD = os.environ.get("REDIS_PASSWORD", None)
@@ -15,80 +20,167 @@ DEFAULT_TIMEOUT = 10
 DEFAULT_RETRIES = 3
 LOCKED_RETRY_DURATION = 0.02
 ERR_RETRY_DURATION = 0.05
+# NsqLockOptions modes
+LOCK_MODE_REDIS = "redis"
+LOCK_MODE_LOCAL = "local"
+# NsqLockOptions behaviours when the resource is locked by someone else
+LOCK_CONTENTION_WAIT = "wait"
+LOCK_CONTENTION_REQUEUE = "requeue"
+# first requeue delay of a message whose resource is locked, doubled on every attempt up to the lock ttl
+LOCK_REQUEUE_BASE_DELAY_MS = 100
 
 
 class LockerError(Exception):
     pass
 
 
+class LockContendedError(LockerError):
+    """Raised in place of waiting for a lock held by someone else, the message should be re-queued after ``delay_ms``
+    """
+
+    def __init__(self, key, delay_ms):
+        LockerError.__init__(self, "Resource {} is locked, retry in {}ms".format(key, delay_ms))
+        self.key = key
+        self.delay_ms = delay_ms
+
+
 current_milli_time = lambda: int(round(time.time() * 1000))
 
 
 class RedisLocker:
-    def __init__(self, service_name, logger=None):
-        self.redis = redis_client.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0, password=REDIS_PASSWORD)
+    def __init__(self, service_name, logger=None, redis_access=None):
+        """
+        ``redis_access`` - optional ``RedisAccess`` shared with other redis clients of the process
+        """
+        self.redis_access = redis_access or RedisAccess(REDIS_HOST, REDIS_PORT, REDIS_PASSWORD)
+        self.redis = self.redis_access.redis
         self.service_name = service_name
         if logger is None:
             logger = logging.getLogger(service_name)
             logger.setLevel(logging.INFO)
         self.logger = logger
+        self.watchdog = LeaseWatchdog(self.redis_access, self.logger)
 
     def get_lock_object(self, key, lock_options):
-        return RedisLock(key, lock_options, self.service_name, self.redis, self.logger)
+        return RedisLock(key, lock_options, self.service_name, self.redis_access, self.logger,
+                         self.watchdog if lock_options.auto_renew else None)
 
 
 class RedisLock:
     """
-    This class represent a redis lock object, it wraps ``redis.Lock`` class. A client who would like to lock a resource,
-    should create this object and hold it. There are 2 main methods: lock, unlock
+    This class represent a redis lock object, a key set with a random token and a ttl. A client who would like to lock a
+    resource, should create this object and hold it. There are 2 main methods: lock, unlock
     """
 
-    def __init__(self, key, lock_options, service_name, redis, logger):
-        self.__lock_obj = redis.lock(name=self.get_key(service_name, key), timeout=lock_options.ttl,
-                                     blocking_timeout=lock_options.timeout,
-                                     sleep=LOCKED_RETRY_DURATION)
+    def __init__(self, key, lock_options, service_name, redis_access, logger, watchdog=None):
+        """
+        ``watchdog`` - optional ``LeaseWatchdog`` renewing the lock until it is unlocked
+        """
+        self.name = self.get_key(service_name, key)
+        self.__redis_access = redis_access
+        self.__token = None
+        # time left to the current holder, as of the last attempt
+        self.__holder_pttl = -1
         self.__retries = lock_options.retries
+        self.__ttl = lock_options.ttl
+        self.__timeout = lock_options.timeout
+        self.__watchdog = watchdog
+        self.__lease = None
         self.logger = logger
 
-    def lock(self):
-        """
-        This method tries to acquire a lock. If a redis error is raised during the process, it will try again for
-        ``self.__lock_obj.retries`` times
-        :return: True if the resource is locked, False o.w
-        :raise: ``RedisError`` in case of redis returned error while trying to lock and all retries were used
-        """
+    def _acquire_once(self, blocking):
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.__timeout if self.__timeout is not None else None
+        while True:
+            acquired, self.__holder_pttl = self.__redis_access.acquire(self.name, token, int(self.__ttl * 1000))
+            if acquired:
+                self.__token = token
+                return True
+            if not blocking or (deadline is not None and time.monotonic() + LOCKED_RETRY_DURATION > deadline):
+                return False
+            time.sleep(LOCKED_RETRY_DURATION)
+
+    def _acquire(self, blocking):
         start_time = current_milli_time()
         err = None
-        for retries_index in xrange(0, self.__retries):
+        for retries_index in range(0, self.__retries):
             try:
-                is_locked = self.__lock_obj.acquire()
-                self.logger.info('[LOCK_TIME] [lock_key={}] [lock_status=ACQUIRED] [time={} Millisec]'.format(
-                    self.__lock_obj.name, str(current_milli_time() - start_time)))
+                is_locked = self._acquire_once(blocking)
+                if is_locked and self.__watchdog is not None:
+                    self.__lease = self.__watchdog.register(self.name, self.__token, int(self.__ttl * 1000))
+                self.logger.info('[LOCK_TIME] [lock_key=%s] [lock_status=%s] [time=%s Millisec]', self.name,
+                                 "ACQUIRED" if is_locked else "LOCKED", current_milli_time() - start_time)
                 return is_locked
             except redis_client.RedisError as re:
                 err = re
-                if retries_index != self.__lock_obj.retries - 1:
+                if retries_index != self.__retries - 1:
                     time.sleep(ERR_RETRY_DURATION)
         self.logger.warning('Failed {} times acquiring lock on resource with key: {}. Redis error message: {}'.
-                            format(self.__retries, self.__lock_obj.name, err))
+                            format(self.__retries, self.name, err))
         raise err
 
+    def lock(self):
+        """
+        This method tries to acquire a lock. If a redis error is raised during the process, it will try again for
+        ``lock_options.retries`` times
+        :return: True if the resource is locked, False o.w
+        :raise: ``RedisError`` in case of redis returned error while trying to lock and all retries were used
+        """
+        return self._acquire(blocking=True)
+
+    def try_lock(self):
+        """
+        Same as ``lock`` without waiting for the resource to be released
+        :return: True if the resource is locked, False if it is locked by someone else
+        """
+        return self._acquire(blocking=False)
+
+    def requeue_delay(self, attempts):
+        """
+        Delay in milliseconds before retrying a message whose resource is locked by someone else: doubled on every
+        attempt (with jitter) and capped by the time left to the current lock
+        :type attempts: int
+        """
+        delay = LOCK_REQUEUE_BASE_DELAY_MS * 2 ** min(max(attempts - 1, 0), 16)
+        delay = random.randint(delay // 2, delay)
+        remaining = self.__holder_pttl if self.__holder_pttl > 0 else self.__ttl * 1000
+        return int(max(1, min(delay, remaining)))
+
     def unlock(self):
         """
-        unlocks the lock object
+        unlocks the lock object, inside a ``RedisAccess.batch`` block the release is sent with the batch and a failure
+        is only logged
         :return: there is no return for this function, if everything goes well, no exception will be thrown
         :raise: ``RedisError`` - general error with redis, there are 2 special cases where there will be raised
         ``LockError(RedisError)`` if the lock does not exist or if the lock is owned by a different owner (the lock
         token is different).
         """
         start_time = current_milli_time()
+        if self.__token is None:
+            raise redis_client.exceptions.LockError("Cannot release an unlocked lock")
+        if self.__lease is not None:
+            self.__watchdog.unregister(self.__lease)
+            if self.__lease.lost:
+                self.logger.warning("Lock {} was lost while held".format(self.name))
+            self.__lease = None
+
+        token, self.__token = self.__token, None
         try:
-            self.__lock_obj.release()
+            released = self.__redis_access.release(self.name, token, on_result=self._on_batched_release)
         except redis_client.RedisError as re:
             self.logger.warning("Unlock Failed with redis error: {}".format(re))
             raise re
-        self.logger.info('[UNLOCK_TIME] [lock_key={}] [time={} Millisec]'.format(
-            self.__lock_obj.name, str(current_milli_time() - start_time)))
+        if released is False:
+            self.logger.warning("Unlock Failed, lock {} is no longer owned".format(self.name))
+            raise redis_client.exceptions.LockError("Cannot release a lock that's no longer owned")
+        self.logger.info('[UNLOCK_TIME] [lock_key=%s] [time=%s Millisec]', self.name,
+                         current_milli_time() - start_time)
+
+    def _on_batched_release(self, result):
+        if isinstance(result, Exception):
+            self.logger.warning("Unlock Failed with redis error: {}".format(result))
+        elif not result:
+            self.logger.warning("Unlock Failed, lock {} is no longer owned".format(self.name))
 
     @staticmethod
     def get_key(service_name, resource):
@@ -101,17 +193,20 @@ class LockOptions:
     Lock Object, should be used by locking mechanism clients for defining the lock properties
     """
 
-    def __init__(self, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    def __init__(self, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, auto_renew=False):
         """
         Create a new lock object
         ``ttl`` - the expiry time of the lock
         ``timeout`` - the amount of time which the locker will try to get a lock while the resource is locked by
                     another process
         ``retries`` - the amount of retries which in case of redis error the locker will try to lock
+        ``auto_renew`` - renew the lock every third of its ttl until it is unlocked, a short ttl then only bounds the
+                    time a crashed holder keeps the resource locked
         """
         self.ttl = ttl
         self.timeout = timeout
         self.retries = retries
+        self.auto_renew = auto_renew
 
 
 class NsqLockOptions(LockOptions):
@@ -120,12 +215,23 @@ class NsqLockOptions(LockOptions):
     """
 
     def __init__(self, path_to_id, is_mandatory=False, ttl=DEFAULT_TTL, timeout=DEFAULT_TIMEOUT,
-                 retries=DEFAULT_RETRIES):
+                 retries=DEFAULT_RETRIES, mode=LOCK_MODE_REDIS, on_contention=LOCK_CONTENTION_WAIT, auto_renew=False):
         """
         Create a new NSQ lock object
         ``path_to_id`` path to resource id on nsq event data
         ``is_mandatory`` is the lock mandatory for event handling (behaviour hint for lock allocation fails )
+        ``mode`` LOCK_MODE_REDIS locks the resource in redis, LOCK_MODE_LOCAL handles the messages of a resource one at
+        a time and in order in the consuming process, without redis (valid only if a single process consumes the
+        channel)
+        ``on_contention`` LOCK_CONTENTION_WAIT waits up to ``timeout`` for a locked resource, LOCK_CONTENTION_REQUEUE
+        tries once and re-queues the message with a delay if the resource is locked (redis mode only)
         """
-        LockOptions.__init__(self, ttl, timeout, retries)
+        if mode not in (LOCK_MODE_REDIS, LOCK_MODE_LOCAL):
+            raise ValueError("Unknown lock mode {}".format(mode))
+        if on_contention not in (LOCK_CONTENTION_WAIT, LOCK_CONTENTION_REQUEUE):
+            raise ValueError("Unknown lock contention behaviour {}".format(on_contention))
+        LockOptions.__init__(self, ttl, timeout, retries, auto_renew)
         self.is_mandatory = is_mandatory
         self.path_to_id = path_to_id
+        self.mode = mode
+        self.on_contention = on_contention
@@ -0,0 +1,214 @@
+import logging
+import threading
+from collections import deque
+
+from tornado import ioloop
+from tornado.concurrent import Future
+
+
+class ConcurrencyLimit(object):
+    """Resizable counting semaphore for coroutines running on the IOLoop
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = deque()
+
+    def acquire(self):
+        future = Future()
+        if self.active < self.limit:
+            self.active += 1
+            future.set_result(None)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    def set_limit(self, limit):
+        self.limit = limit
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.active < self.limit:
+            self.active += 1
+            self._waiters.popleft().set_result(None)
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+
+class WorkerStats(object):
+    """Counters of the messages handled by a worker, reset by whoever reads them
+    """
+
+    def __init__(self):
+        self.in_flight = 0
+        # route failures are reported from the executor threads
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.handled = 0
+            self.failed = 0
+            self.latency_sum_ms = 0.0
+            self.busy_samples = 0
+            self.samples = 0
+
+    def message_done(self, message, latency_ms, failed):
+        with self._lock:
+            self.handled += 1
+            self.latency_sum_ms += latency_ms
+            if failed or getattr(message, "failed_routes", 0):
+                self.failed += 1
+
+    def route_failed(self, message):
+        """A failure was caught by the message handler itself (e.g. a failed NSQHandler route), counted in
+        ``message.failed_routes``. The message counts as failed once it is done, however many of its routes failed.
+        Can be called from any thread
+        """
+        with self._lock:
+            message.failed_routes = getattr(message, "failed_routes", 0) + 1
+
+    @property
+    def error_rate(self):
+        return float(self.failed) / self.handled if self.handled else 0.0
+
+    @property
+    def avg_latency_ms(self):
+        return self.latency_sum_ms / self.handled if self.handled else 0.0
+
+
+class AdaptiveOptions(object):
+    """Bounds and thresholds of the adaptive max_in_flight / concurrency controller
+    """
+
+    def __init__(self, min_in_flight=1, max_in_flight=100, min_concurrency=1, max_concurrency=16, interval=5,
+                 target_latency_ms=None, max_error_rate=0.5, max_drain_seconds=None):
+        """
+        ``min_in_flight``, ``max_in_flight`` - bounds of the reader max_in_flight (RDY)
+        ``min_concurrency``, ``max_concurrency`` - bounds of the number of messages handled at once by the executor
+        ``interval`` - seconds between two adjustments
+        ``target_latency_ms`` - above this average handler latency the controller backs off, ignored if None
+        ``max_error_rate`` - above this rate of failed messages the controller backs off
+        ``max_drain_seconds`` - with an ``NSQHandler(..., backlog=...)`` monitor, a channel backlog which won't be
+                                consumed within this many seconds makes the controller grow max_in_flight, ignored if
+                                None
+        """
+        self.min_in_flight = min_in_flight
+        self.max_in_flight = max_in_flight
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.interval = interval
+        self.target_latency_ms = target_latency_ms
+        self.max_error_rate = max_error_rate
+        self.max_drain_seconds = max_drain_seconds
+
+
+class AdaptiveController(object):
+    """Adjusts a worker's reader max_in_flight and executor concurrency from its load
+
+    Every ``interval`` seconds, looking at the messages handled since the previous adjustment:
+
+    * high error rate or latency: max_in_flight and concurrency are cut by a quarter
+    * messages waiting for an executor thread: concurrency grows by one while it is all busy, otherwise
+      max_in_flight is cut by a quarter, messages would wait in the worker instead of in nsqd
+    * reader starved (as many messages in flight as allowed) with no queueing: max_in_flight grows by 10%
+    * channel lagging (its backlog in nsqd won't drain within ``max_drain_seconds``, see ``on_backlog``) with no
+      queueing: max_in_flight grows by 10% too
+    * executor mostly idle: concurrency shrinks by one, unless the channel is lagging
+    """
+
+    def __init__(self, worker, options, logger=None):
+        """
+        :type worker: nsqworker.nsqworker.ThreadWorker
+        :type options: AdaptiveOptions
+        """
+        self.worker = worker
+        self.options = options
+        self.logger = logger or logging.getLogger("AdaptiveController")
+        # last nsqworker.backlog.BacklogStats of the channel, None without a backlog monitor
+        self.backlog = None
+        self._sampler = ioloop.PeriodicCallback(self._sample, 100)
+        self._adjuster = ioloop.PeriodicCallback(self.adjust, options.interval * 1000)
+
+    def start(self):
+        self._sampler.start()
+        self._adjuster.start()
+
+    def stop(self):
+        self._sampler.stop()
+        self._adjuster.stop()
+
+    def on_backlog(self, stats):
+        """Listener of an ``nsqworker.backlog.BacklogMonitor``
+        """
+        self.backlog = stats
+
+    @property
+    def lagging(self):
+        """True if the channel backlog won't drain within ``max_drain_seconds`` at the current rates
+        """
+        backlog = self.backlog
+        if self.options.max_drain_seconds is None or backlog is None or backlog.depth == 0:
+            return False
+        return backlog.time_to_drain is None or backlog.time_to_drain > self.options.max_drain_seconds
+
+    def _sample(self):
+        stats = self.worker.stats
+        stats.samples += 1
+        limit = self.worker.concurrency_limit
+        if limit is not None and limit.active >= limit.limit:
+            stats.busy_samples += 1
+
+    def adjust(self):
+        options = self.options
+        stats = self.worker.stats
+        limit = self.worker.concurrency_limit
+        reader = self.worker.reader
+        if reader is None or self.worker.paused:
+            return
+
+        max_in_flight = reader.max_in_flight
+        concurrency = limit.limit if limit is not None else self.worker.concurrency
+        queued = self.worker.queue_depth
+        busy = float(stats.busy_samples) / stats.samples if stats.samples else 0.0
+        lagging = self.lagging
+
+        overloaded = stats.handled and (
+            stats.error_rate > options.max_error_rate or
+            (options.target_latency_ms is not None and stats.avg_latency_ms > options.target_latency_ms))
+
+        if overloaded:
+            max_in_flight = int(max_in_flight * 0.75)
+            concurrency = int(concurrency * 0.75)
+        elif queued > 0:
+            if busy >= 0.9 and concurrency < options.max_concurrency:
+                concurrency += 1
+            else:
+                max_in_flight = int(max_in_flight * 0.75)
+        elif stats.in_flight >= max_in_flight or lagging:
+            max_in_flight += max(1, int(max_in_flight * 0.1))
+        elif busy < 0.5:
+            concurrency -= 1
+
+        max_in_flight = min(options.max_in_flight, max(options.min_in_flight, max_in_flight))
+        concurrency = min(options.max_concurrency, max(options.min_concurrency, concurrency))
+
+        self.logger.info(
+            "[ADAPTIVE] [handled={}] [error_rate={:.2f}] [latency={:.0f}ms] [queued={}] [busy={:.2f}] [lagging={}] "
+            "[max_in_flight={}->{}] [concurrency={}->{}]".format(
+                stats.handled, stats.error_rate, stats.avg_latency_ms, queued, busy, lagging,
+                reader.max_in_flight, max_in_flight, limit.limit if limit is not None else concurrency, concurrency))
+
+        if max_in_flight != reader.max_in_flight:
+            reader.set_max_in_flight(max_in_flight)
+        if limit is not None and concurrency != limit.limit:
+            limit.set_limit(concurrency)
+
+        stats.reset()
@@ -0,0 +1,258 @@
+import json
+import logging
+import os
+import time
+
+from tornado import gen, ioloop
+from tornado.httpclient import AsyncHTTPClient
+
+# Channel backlog monitor of NSQHandler, see ``BacklogMonitor``
+# seconds between two polls of the nsqd /stats of the channel
+BACKLOG_POLL_INTERVAL = os.environ.get('BACKLOG_POLL_INTERVAL', '15')
+# seconds before an nsqd or lookupd HTTP request is abandoned
+BACKLOG_REQUEST_TIMEOUT = os.environ.get('BACKLOG_REQUEST_TIMEOUT', '5')
+if not BACKLOG_POLL_INTERVAL.isdigit() or int(BACKLOG_POLL_INTERVAL) < 1:
+    raise EnvironmentError("Please set a positive number to the backlog poll interval")
+if not BACKLOG_REQUEST_TIMEOUT.isdigit():
+    raise EnvironmentError("Please set a number to the backlog request timeout")
+BACKLOG_POLL_INTERVAL = int(BACKLOG_POLL_INTERVAL)
+BACKLOG_REQUEST_TIMEOUT = int(BACKLOG_REQUEST_TIMEOUT)
+
+
+class BacklogStats(object):
+    """Backlog of a channel over all its nsqd, the rates are per second since the previous poll
+
+    ``depth`` - messages waiting in the channel (in memory and on disk)
+    ``in_flight`` - messages sent to the consumers and not yet finished
+    ``deferred`` - messages re-queued or published with a delay
+    ``publish_rate`` - messages put in the channel
+    ``finish_rate`` - messages finished by all the consumers of the channel
+    ``requeue_rate``, ``timeout_rate`` - messages re-queued by the consumers, timed out in flight
+    ``time_to_drain`` - seconds before the backlog is consumed at the current rates, None if it isn't shrinking
+    """
+    __slots__ = ("depth", "in_flight", "deferred", "publish_rate", "finish_rate", "requeue_rate", "timeout_rate",
+                 "time_to_drain", "nodes", "at")
+
+    def __init__(self):
+        self.depth = 0
+        self.in_flight = 0
+        self.deferred = 0
+        self.publish_rate = 0.0
+        self.finish_rate = 0.0
+        self.requeue_rate = 0.0
+        self.timeout_rate = 0.0
+        self.time_to_drain = None
+        self.nodes = 0
+        self.at = None
+
+    @property
+    def backlog(self):
+        return self.depth + self.in_flight + self.deferred
+
+    def as_dict(self):
+        """
+        :rtype: dict
+        """
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+# counters of a channel on an nsqd, their rates are computed from two polls
+_COUNTERS = ("message_count", "finish_count", "requeue_count", "timeout_count")
+
+
+def _response_data(body):
+    # nsqd and nsqlookupd before 1.0 wrap their responses in {"status_code", "status_txt", "data"}
+    data = json.loads(body.decode("utf-8") if isinstance(body, bytes) else body)
+    return data.get("data", data) if isinstance(data, dict) and "status_code" in data else data
+
+
+def channel_counters(stats, topic, channel):
+    """Gauges and counters of a channel from an nsqd /stats response, None if the nsqd doesn't have it
+
+    nsqd only counts the finished messages per client, a sum over the clients drops when one disconnects. The
+    channel ``finish_count`` is the messages which left the channel instead: the messages put in it minus the ones
+    still queued, in flight or deferred (re-queues and timeouts stay in the channel, emptying the channel counts as
+    finishing its messages).
+
+    :type stats: dict
+    :rtype: dict
+    """
+    for topic_stats in stats.get("topics") or []:
+        if topic_stats.get("topic_name") != topic:
+            continue
+        for channel_stats in topic_stats.get("channels") or []:
+            if channel_stats.get("channel_name") != channel:
+                continue
+            counters = dict(depth=channel_stats.get("depth", 0),
+                            in_flight=channel_stats.get("in_flight_count", 0),
+                            deferred=channel_stats.get("deferred_count", 0),
+                            message_count=channel_stats.get("message_count", 0),
+                            requeue_count=channel_stats.get("requeue_count", 0),
+                            timeout_count=channel_stats.get("timeout_count", 0))
+            backlog = counters["depth"] + counters["in_flight"] + counters["deferred"]
+            counters["finish_count"] = max(0, counters["message_count"] - backlog)
+            return counters
+    return None
+
+
+class BacklogMonitor(object):
+    """Polls the /stats of a topic channel on every nsqd holding it, every ``interval`` seconds from the IOLoop
+
+    The nsqd are the ``nsqd_http_addresses``, or the producers of the topic returned by the
+    ``lookupd_http_addresses`` on every poll. Every poll updates ``stats`` (a ``BacklogStats``), the backlog gauges
+    of ``metrics`` and calls the listeners with it (e.g. an autoscaler or the ``AdaptiveController``).
+    """
+
+    def __init__(self, topic, channel, nsqd_http_addresses=(), lookupd_http_addresses=(),
+                 interval=BACKLOG_POLL_INTERVAL, request_timeout=BACKLOG_REQUEST_TIMEOUT, metrics=None, logger=None,
+                 clock=time.monotonic):
+        """
+        ``metrics`` - optional ``nsqworker.metrics.MetricsAggregator`` the backlog gauges are set on
+        """
+        if not nsqd_http_addresses and not lookupd_http_addresses:
+            raise ValueError("The backlog monitor needs nsqd or lookupd HTTP addresses")
+
+        self.topic = topic
+        self.channel = channel
+        self.nsqd_http_addresses = list(nsqd_http_addresses)
+        self.lookupd_http_addresses = list(lookupd_http_addresses)
+        self.interval = interval
+        self.request_timeout = request_timeout
+        self.metrics = metrics
+        self.logger = logger or logging.getLogger("BacklogMonitor")
+        self.stats = None
+        self._clock = clock
+        self._listeners = []
+        # nsqd address to its (poll time, counters) at the previous poll
+        self._previous = {}
+        self._polling = False
+        self._poller = ioloop.PeriodicCallback(self.poll, interval * 1000)
+
+    @classmethod
+    def from_env(cls, topic, channel, metrics=None, logger=None):
+        nsqd_http_addresses = [a for a in os.environ.get("NSQD_HTTP_ADDRESSES", "").split(",") if a]
+        lookupd_http_addresses = [a for a in os.environ.get("LOOKUPD_HTTP_ADDRESSES", "").split(",") if a]
+        return cls(topic, channel, nsqd_http_addresses, lookupd_http_addresses, metrics=metrics, logger=logger)
+
+    def add_listener(self, listener):
+        """``listener`` is called on the IOLoop with every new ``BacklogStats``, or None when no nsqd reported the
+        channel
+        """
+        self._listeners.append(listener)
+
+    def start(self):
+        self._poller.start()
+        ioloop.IOLoop.current().add_callback(self.poll)
+
+    def stop(self):
+        self._poller.stop()
+
+    def _fetch(self, address, path):
+        return AsyncHTTPClient().fetch("http://{}{}".format(address, path), request_timeout=self.request_timeout)
+
+    @gen.coroutine
+    def _discover(self):
+        """HTTP addresses of the nsqd holding the topic
+        """
+        if not self.lookupd_http_addresses:
+            raise gen.Return(self.nsqd_http_addresses)
+
+        responses = yield [self._fetch_or_none(a, "/lookup?topic={}".format(self.topic))
+                           for a in self.lookupd_http_addresses]
+        nodes = []
+        for response in responses:
+            for producer in (response or {}).get("producers") or []:
+                node = "{}:{}".format(producer.get("broadcast_address"), producer.get("http_port"))
+                if node not in nodes:
+                    nodes.append(node)
+        raise gen.Return(nodes)
+
+    @gen.coroutine
+    def _fetch_or_none(self, address, path):
+        try:
+            response = yield self._fetch(address, path)
+            data = _response_data(response.body)
+        except Exception as e:
+            self.logger.warning("Fetching http://{}{} failed with error: {}".format(address, path, e))
+            raise gen.Return(None)
+        raise gen.Return(data)
+
+    @gen.coroutine
+    def poll(self):
+        """Fetch the channel stats of every nsqd and update ``stats``
+        """
+        if self._polling:
+            return
+        self._polling = True
+        try:
+            nodes = yield self._discover()
+            path = "/stats?format=json&topic={}&channel={}".format(self.topic, self.channel)
+            responses = yield [self._fetch_or_none(node, path) for node in nodes]
+            counters = {}
+            for node, response in zip(nodes, responses):
+                channel = channel_counters(response, self.topic, self.channel) if response is not None else None
+                if channel is not None:
+                    counters[node] = channel
+            if counters:
+                self._update(counters)
+            else:
+                self.logger.warning("No nsqd reported channel {} of topic {}".format(self.channel, self.topic))
+                self.stats = None
+                self._notify(None)
+        finally:
+            self._polling = False
+
+    def _update(self, counters):
+        """
+        :type counters: dict[str, dict]
+        """
+        now = self._clock()
+        stats = BacklogStats()
+        stats.at = time.time()
+        stats.nodes = len(counters)
+        rates = dict.fromkeys(_COUNTERS, 0.0)
+        previous, self._previous = self._previous, {}
+        for node, channel in counters.items():
+            stats.depth += channel["depth"]
+            stats.in_flight += channel["in_flight"]
+            stats.deferred += channel["deferred"]
+            self._previous[node] = (now, channel)
+            if node not in previous:
+                continue
+            then, before = previous[node]
+            for name in _COUNTERS:
+                # a counter going back means the nsqd restarted or the channel was recreated, skip it for this poll
+                delta = channel[name] - before[name]
+                if delta >= 0 and now > then:
+                    rates[name] += delta / (now - then)
+
+        stats.publish_rate = rates["message_count"]
+        stats.finish_rate = rates["finish_count"]
+        stats.requeue_rate = rates["requeue_count"]
+        stats.timeout_rate = rates["timeout_count"]
+        draining = stats.finish_rate - stats.publish_rate
+        if stats.backlog == 0:
+            stats.time_to_drain = 0.0
+        elif draining > 0:
+            stats.time_to_drain = stats.backlog / draining
+        self.stats = stats
+
+        self.logger.info("[BACKLOG] [topic={}] [channel={}] [nodes={}] [depth={}] [in_flight={}] [deferred={}] "
+                         "[publish_rate={:.1f}] [finish_rate={:.1f}] [requeue_rate={:.1f}] [timeout_rate={:.1f}] "
+                         "[time_to_drain={}]".format(self.topic, self.channel, stats.nodes, stats.depth,
+                                                     stats.in_flight, stats.deferred, stats.publish_rate,
+                                                     stats.finish_rate, stats.requeue_rate, stats.timeout_rate,
+                                                     "{:.0f}s".format(stats.time_to_drain)
+                                                     if stats.time_to_drain is not None else "never"))
+        if self.metrics is not None:
+            for name in ("depth", "in_flight", "deferred", "publish_rate", "finish_rate", "requeue_rate",
+                         "timeout_rate", "time_to_drain"):
+                self.metrics.gauge("backlog_{}".format(name), getattr(stats, name), self.topic, self.channel)
+        self._notify(stats)
+
+    def _notify(self, stats):
+        for listener in self._listeners:
+            try:
+                listener(stats)
+            except Exception:
+                self.logger.exception("Backlog listener {} failed".format(listener))
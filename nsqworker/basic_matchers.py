@@ -1,20 +1,41 @@
-import json
 import re
 
-import mdict
+from .parsed_message import ParsedMessage
+
+
+def parsed_matcher(matcher_func):
+    """Mark a matcher as accepting a ``ParsedMessage`` instead of the raw message body
+
+    Matchers without the mark (plain lambdas, legacy matchers) keep receiving the raw body.
+    """
+    matcher_func.accepts_parsed = True
+    return matcher_func
+
+
+def apply_matcher(matcher_func, parsed):
+    """Call `matcher_func` with `parsed` or with the raw body, according to what the matcher accepts
+
+    :type parsed: ParsedMessage
+    """
+    if getattr(matcher_func, "accepts_parsed", False):
+        return matcher_func(parsed)
+
+    return matcher_func(parsed.body)
+
+
+def _as_parsed(message):
+    return message if isinstance(message, ParsedMessage) else ParsedMessage(message)
 
 
 def predicate_field_matcher(field, missing_value=False, inverse=False):
 
+    @parsed_matcher
     def match(message):
-
-        try:
-            msg = json.loads(message)
-        except ValueError:
+        message = _as_parsed(message)
+        if message.mdict is None:
             return False
 
-        md = mdict.MDict(msg)
-        val = bool(md.get(field, default=missing_value))
+        val = bool(message.get(field, default=missing_value))
 
         return val if not inverse else not val
 
@@ -24,16 +45,19 @@ def predicate_field_matcher(field, missing_value=False, inverse=False):
 def json_matcher(field, value):
     """Basic JSON matcher
 
-    Returns a method for matching a message `field` against `value`
+    Returns a method for matching a message `field` against `value`.
+    The matcher exposes `index_key` so route tables can dispatch it with a hash lookup.
     """
+    @parsed_matcher
     def match(message):
-        try:
-            message = json.loads(message)
-            md = mdict.MDict(message)
-        except ValueError:
+        message = _as_parsed(message)
+        if message.mdict is None:
             return False
 
-        return md.get(field) == value
+        return message.get(field) == value
+
+    match.index_key = (field, value)
+    match.index_exact = True
 
     return match
 
@@ -43,19 +67,29 @@ def regex_matcher(pattern):
 
     Returns a method for matching a message against a given regex pattern
     """
+    @parsed_matcher
     def match(message):
-        return re.match(pattern, message) is not None
+        body = message.body if isinstance(message, ParsedMessage) else message
+        return re.match(pattern, body) is not None
 
     return match
 
 
 def multi_matcher(*matcher_funcs):
 
+    @parsed_matcher
     def match(message):
+        message = _as_parsed(message)
         for mf in matcher_funcs:
-            if not mf(message):
+            if not apply_matcher(mf, message):
                 return False
 
         return True
 
+    # index on the first equality matcher, the other matchers are checked for the index candidates
+    for mf in matcher_funcs:
+        if getattr(mf, "index_key", None) is not None:
+            match.index_key = mf.index_key
+            break
+
     return match
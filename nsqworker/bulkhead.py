@@ -0,0 +1,135 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado import gen
+
+from .adaptive import ConcurrencyLimit
+
+# delay before a message shed by a full bulkhead is handled again
+BULKHEAD_REQUEUE_DELAY_MS = 1000
+
+
+class BulkheadFullError(Exception):
+    """A bulkhead has too many messages waiting, the message should be handled again after ``delay_ms``
+    """
+
+    def __init__(self, name, delay_ms):
+        Exception.__init__(self, "Bulkhead {} is full".format(name))
+        self.name = name
+        self.delay_ms = delay_ms
+
+
+class _RouteOccupancy(object):
+    __slots__ = ("running", "waiting", "shed")
+
+    def __init__(self):
+        self.running = 0
+        self.waiting = 0
+        self.shed = 0
+
+
+class Bulkhead(object):
+    """Isolated pool of the routes sharing it
+
+    Blocking handlers run on the bulkhead's own ``max_concurrency`` threads, coroutine handlers are limited to
+    ``max_concurrency`` at once on the IOLoop, so a slow route only delays its own messages.
+    With ``max_waiting`` a message arriving while that many messages wait for the bulkhead raises
+    ``BulkheadFullError`` instead of waiting.
+    """
+
+    def __init__(self, name, max_concurrency, max_waiting=None, requeue_delay_ms=BULKHEAD_REQUEUE_DELAY_MS):
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be positive")
+
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.requeue_delay_ms = requeue_delay_ms
+        self.executor = ThreadPoolExecutor(max_concurrency, thread_name_prefix="bulkhead-{}".format(name))
+        self._limit = ConcurrencyLimit(max_concurrency)
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def _occupancy(self, key):
+        occupancy = self._routes.get(key)
+        if occupancy is None:
+            occupancy = self._routes[key] = _RouteOccupancy()
+        return occupancy
+
+    def _admit(self, key):
+        with self._lock:
+            occupancy = self._occupancy(key)
+            if self.max_waiting is not None and sum(o.waiting for o in self._routes.values()) >= self.max_waiting:
+                occupancy.shed += 1
+                raise BulkheadFullError(self.name, self.requeue_delay_ms)
+            occupancy.waiting += 1
+
+    def _started(self, key):
+        with self._lock:
+            occupancy = self._routes[key]
+            occupancy.waiting -= 1
+            occupancy.running += 1
+
+    def _done(self, key):
+        with self._lock:
+            self._routes[key].running -= 1
+
+    def submit(self, key, fn, *args):
+        """Run a blocking function on the bulkhead threads, can be called from any thread
+
+        ``key`` - the route the function runs for, occupancy is reported per key
+        :raise: ``BulkheadFullError``
+        :rtype: concurrent.futures.Future
+        """
+        self._admit(key)
+        return self.executor.submit(self._run, key, fn, *args)
+
+    def _run(self, key, fn, *args):
+        self._started(key)
+        try:
+            return fn(*args)
+        finally:
+            self._done(key)
+
+    def run_async(self, key, fn, *args):
+        """Run a coroutine function within the bulkhead limit, must be called from the IOLoop
+
+        :raise: ``BulkheadFullError``
+        :rtype: tornado.concurrent.Future
+        """
+        self._admit(key)
+        return self._run_async(key, fn, *args)
+
+    @gen.coroutine
+    def _run_async(self, key, fn, *args):
+        yield self._limit.acquire()
+        self._started(key)
+        try:
+            result = yield gen.convert_yielded(fn(*args))
+        finally:
+            self._done(key)
+            self._limit.release()
+        raise gen.Return(result)
+
+    @property
+    def running(self):
+        with self._lock:
+            return sum(o.running for o in self._routes.values())
+
+    @property
+    def waiting(self):
+        with self._lock:
+            return sum(o.waiting for o in self._routes.values())
+
+    def stats(self):
+        """Occupancy of the bulkhead per route: running and waiting messages, messages shed since the last call
+
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {}
+            for key, occupancy in self._routes.items():
+                stats[key] = dict(pool=self.name, running=occupancy.running, waiting=occupancy.waiting,
+                                  shed=occupancy.shed, occupancy=float(occupancy.running) / self.max_concurrency)
+                occupancy.shed = 0
+            return stats
@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import deque
+
+from .retry import MAX_RETRY_DELAY_MS
+
+CIRCUIT_CLOSED = "CLOSED"
+CIRCUIT_OPEN = "OPEN"
+CIRCUIT_HALF_OPEN = "HALF_OPEN"
+
+# what happens to the messages of a route while its circuit is open
+CIRCUIT_OPEN_REQUEUE = "requeue"
+CIRCUIT_OPEN_PERSIST = "persist"
+
+
+class CircuitOpenError(Exception):
+    """The circuit of a route is open, its handler isn't called
+    """
+
+    def __init__(self, name, delay_ms):
+        Exception.__init__(self, "Circuit of route {} is open".format(name))
+        self.name = name
+        self.delay_ms = delay_ms
+
+
+class CircuitBreakerOptions(object):
+    """Thresholds of a route circuit breaker, given with ``nsqhandler.route(..., circuit_breaker=...)``
+
+    The circuit opens once at least ``min_calls`` calls were made in the last ``window`` seconds and their error rate
+    reached ``max_error_rate``, or the rate of calls slower than ``slow_call_ms`` reached ``max_slow_call_rate``.
+    After ``open_duration`` seconds ``half_open_calls`` probe calls are let through: it closes if they all succeed and
+    opens again otherwise.
+    ``on_open`` - CIRCUIT_OPEN_REQUEUE (the message is handled again once the circuit may have closed) or
+                  CIRCUIT_OPEN_PERSIST (the message is persisted as failed)
+    """
+
+    def __init__(self, max_error_rate=0.5, slow_call_ms=None, max_slow_call_rate=0.5, min_calls=20, window=30,
+                 open_duration=30, half_open_calls=1, on_open=CIRCUIT_OPEN_REQUEUE):
+        if on_open not in (CIRCUIT_OPEN_REQUEUE, CIRCUIT_OPEN_PERSIST):
+            raise ValueError("Unknown on_open {}".format(on_open))
+        if min_calls < 1 or half_open_calls < 1:
+            raise ValueError("min_calls and half_open_calls must be positive")
+
+        self.max_error_rate = max_error_rate
+        self.slow_call_ms = slow_call_ms
+        self.max_slow_call_rate = max_slow_call_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_duration = open_duration
+        self.half_open_calls = half_open_calls
+        self.on_open = on_open
+
+
+class CircuitBreaker(object):
+    """Circuit breaker of a route, thread safe
+
+    ``on_state_change`` - optional callable, called with the breaker name, the previous and the new state
+    """
+
+    def __init__(self, name, options, on_state_change=None, clock=time.monotonic):
+        """
+        :type options: CircuitBreakerOptions
+        """
+        self.name = name
+        self.options = options
+        self.on_state_change = on_state_change
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CIRCUIT_CLOSED
+        # [second, calls, failures, slow calls] per second of the window
+        self._buckets = deque()
+        self._changed_at = clock()
+        self._probes = 0
+        self._probe_successes = 0
+
+    def _set_state(self, state, now):
+        previous, self.state = self.state, state
+        self._changed_at = now
+        self._buckets.clear()
+        self._probes = 0
+        self._probe_successes = 0
+        return previous, state
+
+    def _notify(self, transition):
+        if transition is not None and self.on_state_change is not None:
+            self.on_state_change(self.name, *transition)
+
+    def allow(self):
+        """Returns True if the handler can be called, False if the message should be shed
+        """
+        transition = None
+        with self._lock:
+            now = self._clock()
+            if self.state == CIRCUIT_OPEN:
+                if now - self._changed_at < self.options.open_duration:
+                    return False
+                transition = self._set_state(CIRCUIT_HALF_OPEN, now)
+
+            if self.state == CIRCUIT_HALF_OPEN:
+                if self._probes >= self.options.half_open_calls:
+                    if now - self._changed_at < self.options.open_duration:
+                        allowed = False
+                    else:
+                        # no probe result for open_duration (e.g. the probe message was re-queued), probe again
+                        self._changed_at = now
+                        self._probes = 1
+                        self._probe_successes = 0
+                        allowed = True
+                else:
+                    self._probes += 1
+                    allowed = True
+            else:
+                allowed = True
+
+        self._notify(transition)
+        return allowed
+
+    def record(self, succeeded, latency_ms):
+        """Record the outcome of an allowed call
+        """
+        slow = self.options.slow_call_ms is not None and latency_ms >= self.options.slow_call_ms
+        transition = None
+        with self._lock:
+            now = self._clock()
+            if self.state == CIRCUIT_HALF_OPEN:
+                if succeeded and not slow:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.options.half_open_calls:
+                        transition = self._set_state(CIRCUIT_CLOSED, now)
+                else:
+                    transition = self._set_state(CIRCUIT_OPEN, now)
+            elif self.state == CIRCUIT_CLOSED:
+                self._add(now, succeeded, slow)
+                if self._should_open():
+                    transition = self._set_state(CIRCUIT_OPEN, now)
+
+        self._notify(transition)
+
+    def _add(self, now, succeeded, slow):
+        second = int(now)
+        if not self._buckets or self._buckets[-1][0] != second:
+            self._buckets.append([second, 0, 0, 0])
+        bucket = self._buckets[-1]
+        bucket[1] += 1
+        bucket[2] += 0 if succeeded else 1
+        bucket[3] += 1 if slow else 0
+        while self._buckets[0][0] <= second - self.options.window:
+            self._buckets.popleft()
+
+    def _should_open(self):
+        calls = sum(b[1] for b in self._buckets)
+        if calls < self.options.min_calls:
+            return False
+        failures = sum(b[2] for b in self._buckets)
+        slow = sum(b[3] for b in self._buckets)
+        return (float(failures) / calls >= self.options.max_error_rate or
+                (self.options.slow_call_ms is not None and float(slow) / calls >= self.options.max_slow_call_rate))
+
+    def retry_after_ms(self):
+        """Milliseconds before a shed message should be handled again: until the circuit gets half open
+        """
+        with self._lock:
+            remaining = self.options.open_duration - (self._clock() - self._changed_at)
+        if self.state != CIRCUIT_OPEN or remaining <= 0:
+            remaining = self.options.open_duration
+        return int(min(max(1, remaining * 1000), MAX_RETRY_DELAY_MS))
+
+    def stats(self):
+        """
+        :rtype: dict
+        """
+        with self._lock:
+            calls = sum(b[1] for b in self._buckets)
+            failures = sum(b[2] for b in self._buckets)
+            return dict(state=self.state, calls=calls, error_rate=float(failures) / calls if calls else 0.0)
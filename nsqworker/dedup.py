@@ -0,0 +1,196 @@
+import hashlib
+import logging
+import math
+import os
+import threading
+import time
+
+from redis import exceptions as redis_errors
+
+# Message de-duplication of NSQHandler routes registered with dedup=True, see ``Deduplicator``
+# DEDUP_KEY - "id" (re-deliveries of the same message) or "content" (also messages published twice)
+DEDUP_KEY = os.environ.get('DEDUP_KEY', "id")
+# seconds a handled message is remembered
+DEDUP_WINDOW = os.environ.get('DEDUP_WINDOW', '3600')
+# messages remembered per window by the local filter before its false positive rate degrades
+DEDUP_CAPACITY = os.environ.get('DEDUP_CAPACITY', '1000000')
+# "1" to share handled messages between processes in redis
+DEDUP_REDIS = os.environ.get('DEDUP_REDIS', '1')
+if DEDUP_KEY not in ("id", "content"):
+    raise EnvironmentError("Please set DEDUP_KEY to id or content")
+if not all(v.isdigit() for v in (DEDUP_WINDOW, DEDUP_CAPACITY, DEDUP_REDIS)):
+    raise EnvironmentError("Please set a number to the DEDUP_* variables")
+DEDUP_WINDOW = int(DEDUP_WINDOW)
+DEDUP_CAPACITY = int(DEDUP_CAPACITY)
+DEDUP_REDIS = DEDUP_REDIS == '1'
+
+DEFAULT_ERROR_RATE = 1e-6
+# seconds a message stays claimed by a handler run, a crashed consumer only blocks its duplicates that long
+DEFAULT_CLAIM_TTL = 60
+# requeue delay of a duplicate whose original is being handled by another consumer
+IN_PROGRESS_REQUEUE_DELAY_MS = 1000
+
+_REDIS_KEY = "eh:dedup:{}"
+
+
+class DuplicateInProgressError(Exception):
+    """The same message is being handled by another consumer, it should be re-queued after ``delay_ms``
+    """
+
+    def __init__(self, key, delay_ms):
+        Exception.__init__(self, "Message {} is being handled by another consumer".format(key))
+        self.key = key
+        self.delay_ms = delay_ms
+
+
+class BloomFilter(object):
+    """Fixed size Bloom filter over strings, ``capacity`` keys with a ``error_rate`` false positive rate
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        # double hashing, k positions out of the two halves of a single digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class RotatingBloomFilter(object):
+    """Remembers keys for ``window`` to 2 * ``window`` seconds in bounded memory
+
+    Keys are added to the current filter and looked up in the current and previous ones, every ``window`` seconds the
+    previous filter is dropped and the current one becomes the previous. Thread safe.
+    """
+
+    def __init__(self, capacity, error_rate, window):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.window = window
+        self._lock = threading.Lock()
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = None
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self):
+        now = time.monotonic()
+        if now - self._rotated_at < self.window:
+            return
+        # a filter older than two windows has nothing left to remember
+        self._previous = self._current if now - self._rotated_at < 2 * self.window else None
+        self._current = BloomFilter(self.capacity, self.error_rate)
+        self._rotated_at = now
+
+    def add(self, key):
+        with self._lock:
+            self._rotate()
+            self._current.add(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            self._rotate()
+            return key in self._current or (self._previous is not None and key in self._previous)
+
+
+class Deduplicator(object):
+    """Skips the routes which already handled a message
+
+    A (route, message) key is remembered once its handler succeeded, in a local rotating Bloom filter and, with a
+    ``redis_access``, in redis for the other consumers. While a handler runs the key is claimed in redis: a duplicate
+    delivered to another consumer meanwhile raises ``DuplicateInProgressError`` instead of being handled twice.
+    With redis, a hit of the local filter is confirmed by the claim, so a false positive (``error_rate``) is handled;
+    without redis, or while it fails, a false positive skips a message which wasn't handled.
+    """
+
+    def __init__(self, key=DEDUP_KEY, window=DEDUP_WINDOW, capacity=DEDUP_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 redis_access=None, claim_ttl=DEFAULT_CLAIM_TTL, logger=None):
+        """
+        ``key`` - "id" or "content", what identifies a message
+        ``redis_access`` - optional ``locker.redis_access.RedisAccess``
+        """
+        if key not in ("id", "content"):
+            raise ValueError("Unknown de-duplication key {}".format(key))
+
+        self.key = key
+        self.window = window
+        self.redis_access = redis_access
+        self.claim_ttl = claim_ttl
+        self.logger = logger or logging.getLogger("Deduplicator")
+        self._filter = RotatingBloomFilter(capacity, error_rate, window)
+
+    @classmethod
+    def from_env(cls, redis_access=None, logger=None):
+        return cls(redis_access=redis_access if DEDUP_REDIS else None, logger=logger)
+
+    def message_key(self, message, route_name, channel):
+        """
+        :type message: nsq.Message
+        """
+        if self.key == "id":
+            message_id = message.id.decode() if isinstance(message.id, bytes) else message.id
+        else:
+            body = message.body if isinstance(message.body, bytes) else message.body.encode("utf-8")
+            message_id = hashlib.blake2b(body, digest_size=16).hexdigest()
+
+        return "{}:{}:{}".format(channel, route_name, message_id)
+
+    def claim(self, key):
+        """Returns False if the message was already handled, True if it should be handled
+
+        :raise: ``DuplicateInProgressError`` if it is being handled by another consumer
+        """
+        seen = key in self._filter
+        if self.redis_access is None:
+            return not seen
+
+        try:
+            state = self.redis_access.claim(_REDIS_KEY.format(key), self.claim_ttl)
+        except redis_errors.RedisError as re:
+            self.logger.warning("De-duplication check failed with redis error: {}, {} message".format(
+                re, "skipping" if seen else "handling"))
+            return not seen
+        if state is None:
+            if seen:
+                # unknown to redis (or expired there)
+                self.logger.info("De-duplication filter false positive on {}, handling message".format(key))
+            return True
+        if state == b"done":
+            # handled by this or another consumer
+            self._filter.add(key)
+            return False
+        raise DuplicateInProgressError(key, IN_PROGRESS_REQUEUE_DELAY_MS)
+
+    def done(self, key):
+        """The handler succeeded, duplicates are skipped for the next ``window`` seconds
+        """
+        self._filter.add(key)
+        if self.redis_access is not None:
+            try:
+                self.redis_access.set_expiring(_REDIS_KEY.format(key), b"done", self.window,
+                                               on_result=self._on_result)
+            except redis_errors.RedisError as re:
+                self._on_result(re)
+
+    def failed(self, key):
+        """The handler failed, the message can be handled again
+        """
+        if self.redis_access is not None:
+            try:
+                self.redis_access.delete(_REDIS_KEY.format(key), on_result=self._on_result)
+            except redis_errors.RedisError as re:
+                self._on_result(re)
+
+    def _on_result(self, result):
+        if isinstance(result, Exception):
+            self.logger.warning("Updating de-duplication state failed with redis error: {}".format(result))
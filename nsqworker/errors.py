@@ -1,2 +1,8 @@
 class TimeoutError(Exception):
     pass
+
+
+class PublishError(Exception):
+    """A message was dropped after its publish retries (or the retry buffer) were exhausted
+    """
+    pass
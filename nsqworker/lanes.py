@@ -0,0 +1,84 @@
+import logging
+import sys
+from collections import deque
+
+from tornado import gen
+from tornado.concurrent import Future
+
+
+class _Lane(object):
+    __slots__ = ("key", "queue")
+
+    def __init__(self, key):
+        self.key = key
+        self.queue = deque()
+
+
+class KeyedLanes(object):
+    """Runs the tasks sharing a key one at a time and in submission order, tasks of different keys run concurrently
+
+    A lane is created on the first task of a key and dropped once it is empty. Lanes are bounded: ``on_full`` is called
+    when a lane reaches ``capacity`` queued tasks and ``on_drained`` once every full lane is back to half of it, the
+    caller is expected to stop feeding tasks in between (e.g. RDY 0). Must be used from the IOLoop thread.
+    """
+
+    def __init__(self, capacity, on_full=None, on_drained=None, logger=None):
+        self.capacity = capacity
+        self.on_full = on_full
+        self.on_drained = on_drained
+        self.logger = logger or logging.getLogger("KeyedLanes")
+        self._lanes = {}
+        self._full = set()
+
+    def submit(self, key, run):
+        """Queue `run` on the lane of `key`, `run()` is called once the previous tasks of the lane are done and
+        returns a future (or any yieldable)
+
+        :return: a future resolved with the outcome of `run()`
+        :rtype: tornado.concurrent.Future
+        """
+        future = Future()
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(key)
+            lane.queue.append((run, future))
+            self._drain(lane)
+        else:
+            lane.queue.append((run, future))
+
+        if len(lane.queue) >= self.capacity and key not in self._full:
+            self.logger.warning("Lane {} is full ({} messages)".format(key, len(lane.queue)))
+            self._full.add(key)
+            if len(self._full) == 1 and self.on_full is not None:
+                self.on_full()
+
+        return future
+
+    @gen.coroutine
+    def _drain(self, lane):
+        # the queue head is the running task, it's removed once done so that the queue length accounts for it
+        while lane.queue:
+            run, future = lane.queue[0]
+            try:
+                result = yield gen.convert_yielded(run())
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+            lane.queue.popleft()
+            if lane.key in self._full and len(lane.queue) <= self.capacity // 2:
+                self._full.discard(lane.key)
+                if not self._full and self.on_drained is not None:
+                    self.on_drained()
+
+        del self._lanes[lane.key]
+
+    @property
+    def queued(self):
+        """Number of tasks waiting behind the running task of their lane
+        """
+        return sum(len(lane.queue) - 1 for lane in self._lanes.values())
+
+    def __len__(self):
+        return len(self._lanes)
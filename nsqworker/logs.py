@@ -0,0 +1,150 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# "text" or "json" (a JSON object per line)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# 1 to write the logs from a background thread, 0 to write them from the logging thread
+LOG_ASYNC = os.environ.get('LOG_ASYNC', '1')
+# records waiting for the background writer before new ones are dropped, 0 for no limit
+LOG_QUEUE_SIZE = os.environ.get('LOG_QUEUE_SIZE', '10000')
+# percentage of the messages whose per route START/END lines are logged, failures are always logged
+LOG_SAMPLE_RATE = os.environ.get('LOG_SAMPLE_RATE', '100')
+if LOG_FORMAT not in ("text", "json"):
+    raise EnvironmentError("Please set LOG_FORMAT to text or json")
+if LOG_ASYNC not in ("0", "1"):
+    raise EnvironmentError("Please set LOG_ASYNC to 0 or 1")
+if not LOG_QUEUE_SIZE.isdigit():
+    raise EnvironmentError("Please set a number to the log queue size")
+if not LOG_SAMPLE_RATE.isdigit() or int(LOG_SAMPLE_RATE) > 100:
+    raise EnvironmentError("Please set a percentage to the log sample rate")
+LOG_ASYNC = LOG_ASYNC == "1"
+LOG_QUEUE_SIZE = int(LOG_QUEUE_SIZE)
+LOG_SAMPLE_RATE = int(LOG_SAMPLE_RATE)
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object: timestamp, level, logger and message, along with the fields of a dict given
+    as ``extra={"fields": {...}}``
+    """
+
+    def format(self, record):
+        entry = dict(timestamp=self.formatTime(record), level=record.levelname, logger=record.name,
+                     message=record.getMessage())
+        fields = getattr(record, "fields", None)
+        if isinstance(fields, dict):
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class _Writer(logging.handlers.QueueListener):
+    """Background thread formatting and writing the records queued by ``_QueueHandler``s, with their own handler
+    """
+
+    def __init__(self, size):
+        logging.handlers.QueueListener.__init__(self, queue.Queue(size))
+
+    def handle(self, item):
+        target, record = item
+        if record.levelno >= target.level:
+            target.handle(record)
+
+    def enqueue_sentinel(self):
+        # waits for room in a full queue, the writer is draining it
+        self.queue.put(self._sentinel)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = _Writer(LOG_QUEUE_SIZE)
+                writer.start()
+                _writer = writer
+    return _writer
+
+
+def _stop_writer():
+    """Writes the queued records, at exit
+    """
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+
+def _after_fork():
+    # the writer thread doesn't survive a fork, the child starts its own on its first record
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+atexit.register(_stop_writer)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Hands the records to the background writer without formatting them, the message arguments are only merged
+    by the writer (they must not be mutated after the logging call). Records are dropped while the queue is full.
+    """
+
+    def __init__(self, target):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.target = target
+        self.dropped = 0
+
+    def enqueue(self, record):
+        writer = _get_writer()
+        try:
+            if self.dropped:
+                writer.queue.put_nowait((self.target, self._dropped_record(record)))
+                self.dropped = 0
+            writer.queue.put_nowait((self.target, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def _dropped_record(self, record):
+        return logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                                 "Dropped %d log records, the log writer is behind", (self.dropped,), None)
+
+    def prepare(self, record):
+        return record
+
+
+def stream_handler(fmt, level=logging.INFO):
+    """Handler of the package loggers: writes to stdout with ``fmt`` (or as JSON with LOG_FORMAT=json), from a
+    background thread unless LOG_ASYNC=0
+
+    :rtype: logging.Handler
+    """
+    handler = logging.StreamHandler(stream=sys.stdout)
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else logging.Formatter(fmt))
+    handler.setLevel(level)
+    if not LOG_ASYNC:
+        return handler
+
+    queue_handler = _QueueHandler(handler)
+    queue_handler.setLevel(level)
+    return queue_handler
+
+
+def sampled(key):
+    """True if the per message lines of the message with the hexadecimal ``key`` (its route id) should be logged,
+    the START and END lines of a message are sampled together
+    """
+    return LOG_SAMPLE_RATE >= 100 or int(key, 16) % 100 < LOG_SAMPLE_RATE
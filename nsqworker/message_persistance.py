@@ -1,36 +1,31 @@
 import json
-import os
 import time
 from datetime import datetime
 
-import redis
+from locker.redis_access import RedisAccess
 
 MESSAGE_STORE_KEY = "eh:messages:failed"
 
 
 class MessagePersistor(object):
 
-    def __init__(self, logger):
+    def __init__(self, logger, redis_access=None):
+        """
+        ``redis_access`` - optional ``locker.redis_access.RedisAccess`` shared with other redis clients of the process
+        """
 
         self._logger = logger
-        self._init_redis()
+        self._init_redis(redis_access)
         self._enabled = True
 
         if not self._redis:
             self._enabled = False
             self._logger.info("Redis client unavailable, failed message persistence disabled")
 
-    def _init_redis(self):
+    def _init_redis(self, redis_access):
 
-        self._redis = None
-
-        _host = os.environ.get("REDIS_HOST")
-        _port = os.environ.get("REDIS_PORT")
-        _password = os.environ.get("REDIS_PASSWORD", None)
-
-        if all([_host, _port]):
-            self._redis = redis.StrictRedis(host=_host, port=_port,
-                                            db=0, password=_password)
+        self._redis_access = redis_access or RedisAccess.from_env()
+        self._redis = self._redis_access.redis if self._redis_access else None
 
     def persist_message(self, topic, channel, route, message, err_str):
 
@@ -50,9 +45,15 @@ class MessagePersistor(object):
 
         ts = time.mktime(persist_time.timetuple())
 
-        new = self._redis.zadd(MESSAGE_STORE_KEY, ts, json.dumps(doc))
+        # None when batched with other writes (``RedisAccess.batch``)
+        new = self._redis_access.zadd(MESSAGE_STORE_KEY, ts, json.dumps(doc), on_result=self._on_batched_persist)
         return new
 
+    def _on_batched_persist(self, result):
+
+        if isinstance(result, Exception):
+            self._logger.error("Persisting failed message failed with redis error: {}".format(result))
+
     def is_persisted_message(self, message):
 
         return True if 'recipients' in message else False
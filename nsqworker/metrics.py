@@ -0,0 +1,376 @@
+import bisect
+import inspect
+import logging
+import os
+import threading
+import time
+import weakref
+
+from auguryapi.metrics import measure_nsq_latency, measure_nsq_stats
+from tornado import web
+
+# seconds between two flushes of the aggregated metrics to the sink, 0 to send every measure right away
+METRICS_FLUSH_INTERVAL = os.environ.get('METRICS_FLUSH_INTERVAL', '10')
+# optional port of a pull endpoint serving the aggregated metrics (Prometheus text format) on /metrics
+METRICS_HTTP_PORT = os.environ.get('METRICS_HTTP_PORT', '')
+if not METRICS_FLUSH_INTERVAL.isdigit():
+    raise EnvironmentError("Please set a number to the metrics flush interval")
+if METRICS_HTTP_PORT and not METRICS_HTTP_PORT.isdigit():
+    raise EnvironmentError("Please set a port number to METRICS_HTTP_PORT")
+METRICS_FLUSH_INTERVAL = int(METRICS_FLUSH_INTERVAL)
+METRICS_HTTP_PORT = int(METRICS_HTTP_PORT) if METRICS_HTTP_PORT else None
+
+# upper bounds of the latency histogram buckets, a last bucket counts the slower values
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750, 1000, 1500, 2500, 5000, 10000, 30000,
+                      60000)
+
+# kind of the series of route outcomes, keyed by (ROUTE_METRIC, topic, channel, event, route, status)
+ROUTE_METRIC = "route"
+# kind of the series of message stage timings, keyed by (STAGE_METRIC, topic, channel, stage)
+STAGE_METRIC = "stage"
+
+
+class Histogram(object):
+    """Fixed buckets histogram of latencies in milliseconds
+    """
+    __slots__ = ("counts", "sums", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.sums = [0.0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(LATENCY_BUCKETS_MS, value)
+        self.counts[i] += 1
+        self.sums[i] += value
+        self.count += 1
+        self.sum += value
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+            self.sums[i] += other.sums[i]
+        self.count += other.count
+        self.sum += other.sum
+
+    def percentile(self, q):
+        """Approximate ``q`` quantile (0 to 1), interpolated within the bucket holding it
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lower = LATENCY_BUCKETS_MS[i - 1] if i else 0.0
+                # the last bucket has no upper bound, its mean stands for it
+                upper = LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else max(lower, self.sums[i] / c)
+                return lower + (upper - lower) * (rank - seen) / c
+            seen += c
+        return float(LATENCY_BUCKETS_MS[-1])
+
+
+class Series(object):
+    """Count and (for timed measures) latency histogram of a metric key
+    """
+    __slots__ = ("count", "histogram")
+
+    def __init__(self):
+        self.count = 0
+        self.histogram = None
+
+    def record(self, value):
+        self.count += 1
+        if value is not None:
+            if self.histogram is None:
+                self.histogram = Histogram()
+            self.histogram.observe(value)
+
+    def merge(self, other):
+        self.count += other.count
+        if other.histogram is not None:
+            if self.histogram is None:
+                self.histogram = Histogram()
+            self.histogram.merge(other.histogram)
+
+
+class _Shard(object):
+    """Series recorded by a single thread, the lock is only contended by a flush
+    """
+    __slots__ = ("lock", "series")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {}
+
+
+def _merge(into, series):
+    for key, s in series.items():
+        merged = into.get(key)
+        if merged is None:
+            merged = into[key] = Series()
+        merged.merge(s)
+
+
+def _accepts_count(func):
+    # a measure taking **kwargs would forward an unknown count to its backend, only an explicit parameter is trusted
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+    count = parameters.get("count")
+    return count is not None and count.kind in (count.POSITIONAL_OR_KEYWORD, count.KEYWORD_ONLY)
+
+
+# auguryapi versions whose measures take a count get a single stats measure per series
+_STATS_COUNT = _accepts_count(measure_nsq_stats)
+
+
+def auguryapi_sink(series):
+    """Sends aggregated series to ``auguryapi.metrics`` once per flush: per series, a stats measure with the number of
+    messages (replayed once per message if ``measure_nsq_stats`` takes no count) and, for the timed ones, a latency
+    measure at the mean latency of the interval
+
+    :type series: dict[tuple, Series]
+    """
+    for key, s in series.items():
+        if key[0] != ROUTE_METRIC:
+            continue
+        _, topic, channel, event, route, status = key
+        if _STATS_COUNT:
+            measure_nsq_stats(status=status, topic=topic, channel=channel, event=event, route=route, count=s.count)
+        else:
+            for _ in range(s.count):
+                measure_nsq_stats(status=status, topic=topic, channel=channel, event=event, route=route)
+        if s.histogram is not None and s.histogram.count:
+            measure_nsq_latency(duration=s.histogram.sum / s.histogram.count, topic=topic, channel=channel,
+                                event=event, route=route)
+
+
+# the aggregators of the process, their flusher thread and thread shards are reset in a forked child
+_aggregators = weakref.WeakSet()
+# the aggregator shared by the handlers of the process, see ``process_aggregator``
+_process_aggregator = None
+_process_aggregator_lock = threading.Lock()
+
+
+def _after_fork():
+    for aggregator in list(_aggregators):
+        aggregator._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class MetricsAggregator(object):
+    """Route metrics of the process, aggregated in memory and flushed to a sink by a background thread
+
+    A measure only updates a series of the calling thread (no lock shared between handler threads), every
+    ``flush_interval`` seconds the series of all the threads are merged and sent to ``sink`` off the message path.
+    With a ``flush_interval`` of 0 every measure is sent to the sink right away.
+    """
+
+    def __init__(self, flush_interval=METRICS_FLUSH_INTERVAL, sink=auguryapi_sink, logger=None):
+        """
+        ``sink`` - called with a dict of metric key to ``Series``, see ``auguryapi_sink``
+        """
+        self.flush_interval = flush_interval
+        self.sink = sink
+        self.logger = logger or logging.getLogger("MetricsAggregator")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._pending = {}
+        self._totals = {}
+        # (name, topic, channel) to the last value of a gauge, only served by ``render``
+        self._gauges = {}
+        self._thread = None
+        _aggregators.add(self)
+
+    def _after_fork(self):
+        # the flusher thread and the other threads shards don't survive a fork
+        started = self._thread is not None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._pending = {}
+        self._thread = None
+        if started:
+            self.start()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def record(self, key, value=None):
+        """Count a measure of ``key``, ``value`` - optional latency in milliseconds
+        """
+        if not self.flush_interval:
+            series = Series()
+            series.record(value)
+            self._send({key: series})
+            return
+
+        shard = self._shard()
+        with shard.lock:
+            series = shard.series.get(key)
+            if series is None:
+                series = shard.series[key] = Series()
+            series.record(value)
+
+    def count(self, status, topic, channel, event, route):
+        self.record((ROUTE_METRIC, topic, channel, event, route, status))
+
+    def observe(self, duration_ms, status, topic, channel, event, route):
+        """Count a route outcome along with its duration
+        """
+        self.record((ROUTE_METRIC, topic, channel, event, route, status), float(duration_ms))
+
+    def observe_stage(self, duration_ms, stage, topic, channel):
+        """Time a message spent in a stage of its handling, see ``nsqworker.timing.MessageTimings.stages``
+        """
+        self.record((STAGE_METRIC, topic, channel, stage), float(duration_ms))
+
+    def gauge(self, name, value, topic, channel):
+        """Set the current value of a gauge (e.g. the channel backlog), None removes it
+        """
+        with self._lock:
+            if value is None:
+                self._gauges.pop((name, topic, channel), None)
+            else:
+                self._gauges[(name, topic, channel)] = value
+
+    def start(self):
+        if not self.flush_interval or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="MetricsFlusher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def collect(self):
+        """Merge the series recorded by all the threads, returns the totals since the start of the process
+
+        :rtype: dict[tuple, Series]
+        """
+        with self._lock:
+            shards = list(self._shards)
+        collected = {}
+        for shard in shards:
+            with shard.lock:
+                series, shard.series = shard.series, {}
+            _merge(collected, series)
+
+        with self._lock:
+            _merge(self._pending, collected)
+            _merge(self._totals, collected)
+            return dict(self._totals)
+
+    def flush(self):
+        """Send the series recorded since the last flush to the sink
+        """
+        self.collect()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self._send(pending)
+
+    def _send(self, series):
+        try:
+            self.sink(series)
+        except Exception as e:
+            self.logger.warning("Sending metrics failed with error: {}".format(e))
+
+    def render(self):
+        """Totals since the start of the process in the Prometheus text format
+
+        :rtype: str
+        """
+        lines = []
+        totals = sorted(self.collect().items())
+        lines.append("# TYPE nsqworker_messages_total counter")
+        for key, s in totals:
+            if key[0] == ROUTE_METRIC:
+                lines.append("nsqworker_messages_total{{{}}} {}".format(_labels(key), s.count))
+
+        for kind, name in ((ROUTE_METRIC, "nsqworker_latency_ms"), (STAGE_METRIC, "nsqworker_stage_ms")):
+            lines.append("# TYPE {} histogram".format(name))
+            for key, s in totals:
+                if key[0] != kind or s.histogram is None:
+                    continue
+                labels = _labels(key)
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS_MS + ("+Inf",), s.histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative))
+                lines.append("{}_sum{{{}}} {}".format(name, labels, s.histogram.sum))
+                lines.append("{}_count{{{}}} {}".format(name, labels, s.histogram.count))
+
+        with self._lock:
+            gauges = sorted(self._gauges.items())
+        for name in sorted(set(key[0] for key, _ in gauges)):
+            lines.append("# TYPE nsqworker_{} gauge".format(name))
+            for (gauge, topic, channel), value in gauges:
+                if gauge == name:
+                    lines.append('nsqworker_{}{{topic="{}",channel="{}"}} {}'.format(
+                        name, _escape(topic), _escape(channel), value))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """Serve ``render`` on http://:port/metrics from the IOLoop
+        """
+        app = web.Application([(r"/metrics", _MetricsHandler, dict(aggregator=self))])
+        app.listen(port)
+        self.logger.info("Serving metrics on port {}".format(port))
+
+
+_LABEL_NAMES = {
+    ROUTE_METRIC: ("kind", "topic", "channel", "event", "route", "status"),
+    STAGE_METRIC: ("kind", "topic", "channel", "stage"),
+}
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key):
+    return ",".join('{}="{}"'.format(name, _escape(value)) for name, value in zip(_LABEL_NAMES[key[0]], key))
+
+
+class _MetricsHandler(web.RequestHandler):
+
+    def initialize(self, aggregator):
+        self.aggregator = aggregator
+
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(self.aggregator.render())
+
+
+def process_aggregator():
+    """The aggregator shared by the handlers of the process, created on first use and then served on
+    ``METRICS_HTTP_PORT`` (if set), once per process whatever the number of handlers
+
+    :rtype: MetricsAggregator
+    """
+    global _process_aggregator
+    with _process_aggregator_lock:
+        if _process_aggregator is None:
+            aggregator = MetricsAggregator()
+            if METRICS_HTTP_PORT is not None:
+                aggregator.serve(METRICS_HTTP_PORT)
+            _process_aggregator = aggregator
+        return _process_aggregator
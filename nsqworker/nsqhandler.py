@@ -1,24 +1,36 @@
-import json
+import concurrent.futures
+import contextlib
 import logging
 import os
 import random
 import string
-import sys
+import threading
 import time
 import traceback
-from functools import wraps
+from functools import partial, wraps
 from string import hexdigits
 
 import nsq
-from auguryapi.metrics import measure_nsq_latency, measure_nsq_stats
 from redis import exceptions as redis_errors
-from tornado import ioloop
+from tornado import gen, ioloop
 
 import locker.redis_locker as _locker
+from locker.redis_access import RedisAccess
+from .backlog import BacklogMonitor
+from .bulkhead import Bulkhead, BulkheadFullError
+from .circuit_breaker import CIRCUIT_OPEN_PERSIST, CircuitBreaker, CircuitOpenError
+from .dedup import Deduplicator, DuplicateInProgressError
 from .helpers import register_nsq_topics
+from .logs import sampled, stream_handler
 from .message_persistance import MessagePersistor
-from .nsqworker import ThreadWorker
+from .metrics import process_aggregator
+from .nsqworker import WORKER_MODES, is_coroutine_function
 from .nsqwriter import NSQWriter
+from .parsed_message import ParsedMessage, parse_message
+from .profiler import RouteProfiler
+from .retry import RetryPolicy, contentions, retry_attempt, retry_body
+from .route_batcher import RouteBatcher
+from .routing import RouteTable
 
 # Fetch NSQD address
 NSQD_TCP_ADDRESSES = os.environ.get('NSQD_TCP_ADDRESSES', "").split(",")
@@ -32,6 +44,13 @@ RETRY_LIMIT = os.environ.get('RETRY_LIMIT', '3')
 if not RETRY_LIMIT.isdigit():
     raise EnvironmentError("Please set a number to the retry count")
 RETRY_LIMIT = int(RETRY_LIMIT)
+# the retries of an idempotent route which failed after other routes of its message ran
+_IDEMPOTENT_RETRY_POLICY = RetryPolicy(max_attempts=RETRY_LIMIT)
+# seconds between two logs of the bulkheads occupancy, 0 to disable
+BULKHEAD_REPORT_INTERVAL = os.environ.get('BULKHEAD_REPORT_INTERVAL', '60')
+if not BULKHEAD_REPORT_INTERVAL.isdigit():
+    raise EnvironmentError("Please set a number to the bulkhead report interval")
+BULKHEAD_REPORT_INTERVAL = int(BULKHEAD_REPORT_INTERVAL)
 
 kwargs = {}
 
@@ -57,22 +76,80 @@ def load_routes(cls):
     funcs = [(member.options, member) for name, member in cls.__dict__.items() if
              getattr(member, 'options', None) is not None]
     for options, handler in funcs:
-        for matcher, lock_options, is_idempotent in options:
+        for matcher, lock_options, is_idempotent, route_options in options:
             # check if lock exist, and wrap handler with lock accordingly
-            cls.register_route(matcher, handler, is_idempotent) if lock_options is None else cls.register_route(
-                matcher, with_lock(handler, lock_options), is_idempotent)
+            if lock_options is None:
+                cls.register_route(matcher, handler, is_idempotent, **route_options)
+            else:
+                # locked routes are never run in parallel
+                route_options = dict(route_options, sequential=True)
+                cls.register_route(matcher, with_lock(handler, lock_options), is_idempotent, **route_options)
 
     return cls
 
 
-def route(matcher_func, nsq_lock_options=None, is_idempotent=False):
+def route(matcher_func, nsq_lock_options=None, is_idempotent=False, dedup=False, retry_policy=None, sequential=False,
+          max_concurrency=None, max_waiting=None, pool=None, circuit_breaker=None):
     """Decorator for registering a class method along with it's route (matcher based)
+
+    ``is_idempotent`` - a failed message is re-queued, up to ``RETRY_LIMIT`` times. Once other routes of the message
+                        ran the route is retried on its own instead, as with a ``retry_policy`` of ``RETRY_LIMIT``
+                        retries.
+    ``dedup`` - skip the messages this route already handled, requires an ``NSQHandler(..., dedup=...)``
+    ``retry_policy`` - optional ``nsqworker.retry.RetryPolicy``, a failure of the route is retried with a delayed
+                       message addressed to this route only (instead of re-queuing the message for all its routes when
+                       ``is_idempotent``), the failure is persisted once the retries are exhausted. Only applies to
+                       JSON object messages.
+    ``sequential`` - with ``NSQHandler(..., parallel_routes=True)``, run in registration order with the other
+                     sequential and locked routes instead of in parallel
+    ``max_concurrency`` - run the route on a bulkhead of its own handling up to ``max_concurrency`` messages at once
+    ``max_waiting`` - with ``max_concurrency``, the messages waiting for the bulkhead beyond which the route is shed:
+                      its messages are deferred by a copy addressed to the route
+    ``pool`` - run the route on the bulkhead of this name given to ``NSQHandler(..., pools=...)``
+    A route with a bulkhead doesn't use the worker executor threads: it runs on the bulkhead, concurrently with the
+    other routes of the message with ``NSQHandler(..., parallel_routes=True)`` (unless locked or ``sequential``), in
+    the registration order otherwise.
+    ``circuit_breaker`` - optional ``nsqworker.circuit_breaker.CircuitBreakerOptions``, while the route keeps failing
+                          its messages are deferred (or persisted) without calling the handler
     """
+    if max_concurrency is not None and pool is not None:
+        raise ValueError("A route takes either max_concurrency or pool")
+    if max_waiting is not None and max_concurrency is None:
+        raise ValueError("max_waiting needs max_concurrency, set it on the pool Bulkhead otherwise")
 
     def wrapper(handler_func):
         if getattr(handler_func, 'options', None) is None:
             handler_func.options = []
-        handler_func.options.insert(0, (matcher_func, nsq_lock_options, is_idempotent))
+        handler_func.options.insert(0, (matcher_func, nsq_lock_options, is_idempotent,
+                                        dict(dedup=dedup, retry_policy=retry_policy, sequential=sequential,
+                                             max_concurrency=max_concurrency, max_waiting=max_waiting, pool=pool,
+                                             circuit_breaker=circuit_breaker)))
+        return handler_func
+
+    return wrapper
+
+
+def batch_route(matcher_func, max_size=100, max_wait=1.0, is_idempotent=False, retry_policy=None):
+    """Decorator for registering a class method handling the messages of a route in batches
+
+    The handler is called with a list of up to ``max_size`` messages collected for at most ``max_wait`` seconds, it
+    returns None if all of them were handled, or a list holding the result of every message: an exception for a
+    failed message, anything else for a handled one. An exception raised by the handler fails all the messages of
+    the batch. A failed message is retried for this route only, as ``route(..., retry_policy=...)`` does (by default
+    ``RETRY_LIMIT`` times when ``is_idempotent``), and persisted once the retries are exhausted.
+    Messages wait for their batch in flight (touched, without holding a thread nor their lane), so a batch never
+    exceeds the worker ``max_in_flight``. A batch route runs after the other routes matching a message.
+    """
+    if max_size < 1:
+        raise ValueError("max_size must be positive")
+    if retry_policy is None and is_idempotent:
+        retry_policy = _IDEMPOTENT_RETRY_POLICY
+
+    def wrapper(handler_func):
+        if getattr(handler_func, 'options', None) is None:
+            handler_func.options = []
+        handler_func.options.insert(0, (matcher_func, None, is_idempotent,
+                                        dict(batch_size=max_size, batch_wait=max_wait, retry_policy=retry_policy)))
         return handler_func
 
     return wrapper
@@ -83,44 +160,145 @@ def gen_random_string(n=10):
 
 
 _identity = lambda x: x
+_not_profiled = contextlib.nullcontext()
+
+
+class _BatchItem(object):
+    """A message waiting for its batch route"""
+    __slots__ = ("message", "event_name", "jsn", "route_id", "start_time")
+
+    def __init__(self, message, event_name, jsn, route_id, start_time):
+        self.message = message
+        self.event_name = event_name
+        self.jsn = jsn
+        self.route_id = route_id
+        self.start_time = start_time
+
+
+def _batch_results(results, size):
+    """Per message results of a batch route handler
+    """
+    if results is None:
+        return [None] * size
+    results = list(results)
+    if len(results) != size:
+        raise ValueError("Batch handler returned {} results for {} messages".format(len(results), size))
+    return results
+
+
+def _all_done(futures):
+    """Returns a future resolved once all of ``futures`` are done, failed with the first error if any of them failed
+
+    :type futures: list[concurrent.futures.Future]
+    :rtype: concurrent.futures.Future
+    """
+    if len(futures) == 1:
+        return futures[0]
+
+    done = concurrent.futures.Future()
+    remaining = [len(futures)]
+    errors = []
+    lock = threading.Lock()
+
+    def on_done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+            if future.exception() is not None:
+                errors.append(future.exception())
+        if not last:
+            return
+        if errors:
+            done.set_exception(errors[0])
+        else:
+            done.set_result(None)
+
+    for future in futures:
+        future.add_done_callback(on_done)
+    return done
+
+
+def _lock_key(self, message, nsq_lock_options):
+    """Returns the lock key of a message, None if the message should be handled without a lock
+    """
+    event = self._event(message)
+    event_name = event.get("name")
+    resource_id = event.get(nsq_lock_options.path_to_id)
+    if resource_id is None:
+        self.logger.warning(
+            "Cannot find lock resource id on event data path:{}".format(nsq_lock_options.path_to_id))
+        if nsq_lock_options.is_mandatory:
+            raise ValueError("Mandatory lock acquiring aborted due to lack of resource id on event data")
+        return None
+
+    return "{}:{}".format(event_name, resource_id)
+
+
+def _contention_attempts(self, message):
+    """Attempts of a message along with the times it was deferred on contention, the lock re-queue delay grows with them
+    """
+    jsn = parse_message(message).json
+    return message.attempts + getattr(message, "contentions", 0) + (contentions(jsn) if isinstance(jsn, dict) else 0)
+
+
+def _add_lock_time(message, since):
+    """Count the time since ``since`` (``time.monotonic``) as lock time of the message
+    """
+    timings = getattr(message, "timings", None)
+    if timings is not None:
+        timings.add_lock_time((time.monotonic() - since) * 1000)
+
+
+def _lock_method(lock_object, nsq_lock_options):
+    if nsq_lock_options.on_contention == _locker.LOCK_CONTENTION_REQUEUE:
+        return lock_object.try_lock
+    return lock_object.lock
+
+
+def _lock_not_acquired(self, key, nsq_lock_options):
+    self.logger.warning("Acquiring lock timed out - resource {} is locked by another process".format(key))
+    if nsq_lock_options.is_mandatory:
+        self.logger.error("Lock is mandatory, aborting handler")
+        raise _locker.LockerError("Mandatory lock not acquired, aborting handler")
 
 
 def with_lock(handler_func, nsq_lock_options):
+    if nsq_lock_options.mode == _locker.LOCK_MODE_LOCAL:
+        return _with_lane(handler_func, nsq_lock_options)
+    if is_coroutine_function(handler_func):
+        return _with_lock_async(handler_func, nsq_lock_options)
+
     @wraps(handler_func)
     def flock(self, message):
-        event = self.extract(message.body)
-        event_name = event.get("name")
-        resource_id = event.get(nsq_lock_options.path_to_id)
-        if resource_id is None:
-            self.logger.warning(
-                "Cannot find lock resource id on event data path:{}".format(nsq_lock_options.path_to_id))
-            if nsq_lock_options.is_mandatory:
-                raise ValueError("Mandatory lock acquiring aborted due to lack of resource id on event data")
-            else:
-                return handler_func(self, message)
+        key = _lock_key(self, message, nsq_lock_options)
+        if key is None:
+            return handler_func(self, message)
 
-        key = "{}:{}".format(event_name, resource_id)
         lock_object = self.locker.get_lock_object(key, nsq_lock_options)
 
         # locking
+        lock_start = time.monotonic()
         try:
-            is_locked = lock_object.lock()
+            is_locked = _lock_method(lock_object, nsq_lock_options)()
         except redis_errors.RedisError as re:
+            _add_lock_time(message, lock_start)
             self.logger.warning("Acquiring lock failed with error:{}".format(re))
             if nsq_lock_options.is_mandatory:
                 raise re
             return handler_func(self, message)
+        _add_lock_time(message, lock_start)
         if is_locked:
             try:
                 return handler_func(self, message)
             finally:
+                unlock_start = time.monotonic()
                 lock_object.unlock()
+                _add_lock_time(message, unlock_start)
 
         # lock not acquired, resource is locked
-        self.logger.warning("Acquiring lock timed out - resource {} is locked by another process".format(key))
-        if nsq_lock_options.is_mandatory:
-            self.logger.error("Lock is mandatory, aborting handler")
-            raise _locker.LockerError("Mandatory lock not acquired, aborting handler")
+        if nsq_lock_options.on_contention == _locker.LOCK_CONTENTION_REQUEUE:
+            raise _locker.LockContendedError(key, lock_object.requeue_delay(_contention_attempts(self, message)))
+        _lock_not_acquired(self, key, nsq_lock_options)
 
         # lock is not mandatory run handler without lock
         return handler_func(self, message)
@@ -128,34 +306,227 @@ def with_lock(handler_func, nsq_lock_options):
     return flock
 
 
+def _with_lock_async(handler_func, nsq_lock_options):
+    """Lock wrapper of coroutine handlers, the blocking redis calls are run in the worker executor
+    """
+    @wraps(handler_func)
+    @gen.coroutine
+    def flock(self, message):
+        key = _lock_key(self, message, nsq_lock_options)
+        if key is None:
+            result = yield gen.convert_yielded(handler_func(self, message))
+            raise gen.Return(result)
+
+        lock_object = self.locker.get_lock_object(key, nsq_lock_options)
+
+        # locking
+        lock_start = time.monotonic()
+        try:
+            is_locked = yield self.worker.executor.submit(_lock_method(lock_object, nsq_lock_options))
+        except redis_errors.RedisError as re:
+            self.logger.warning("Acquiring lock failed with error:{}".format(re))
+            if nsq_lock_options.is_mandatory:
+                raise re
+            is_locked = None
+        finally:
+            _add_lock_time(message, lock_start)
+        if is_locked:
+            try:
+                result = yield gen.convert_yielded(handler_func(self, message))
+            finally:
+                unlock_start = time.monotonic()
+                yield self.worker.executor.submit(lock_object.unlock)
+                _add_lock_time(message, unlock_start)
+            raise gen.Return(result)
+
+        if is_locked is not None:
+            # lock not acquired, resource is locked
+            if nsq_lock_options.on_contention == _locker.LOCK_CONTENTION_REQUEUE:
+                delay_ms = yield self.worker.executor.submit(lock_object.requeue_delay,
+                                                             _contention_attempts(self, message))
+                raise _locker.LockContendedError(key, delay_ms)
+            _lock_not_acquired(self, key, nsq_lock_options)
+
+        # lock is not mandatory run handler without lock
+        result = yield gen.convert_yielded(handler_func(self, message))
+        raise gen.Return(result)
+
+    return flock
+
+
+def _with_lane(handler_func, nsq_lock_options):
+    """Wrapper of "local" mode locks, the worker runs the messages of a resource on their own lane (see
+    ``NSQHandler._shard_key``) so the handler only checks the resource id
+    """
+    if is_coroutine_function(handler_func):
+        @wraps(handler_func)
+        @gen.coroutine
+        def flock(self, message):
+            _lock_key(self, message, nsq_lock_options)
+            result = yield gen.convert_yielded(handler_func(self, message))
+            raise gen.Return(result)
+    else:
+        @wraps(handler_func)
+        def flock(self, message):
+            _lock_key(self, message, nsq_lock_options)
+            return handler_func(self, message)
+
+    flock.lane_lock_options = nsq_lock_options
+    return flock
+
+
+def _bulkhead(name, pool):
+    """The bulkhead of an ``NSQHandler(..., pools=...)`` entry
+
+    :rtype: Bulkhead
+    """
+    if isinstance(pool, Bulkhead):
+        return pool
+    if isinstance(pool, tuple):
+        max_concurrency, max_waiting = pool
+        return Bulkhead(name, max_concurrency, max_waiting=max_waiting)
+    return Bulkhead(name, pool)
+
+
 class NSQHandler(NSQWriter):
     def __init__(self, topic, channel, timeout=None, concurrency=1, max_in_flight=1,
-                 message_preprocessor=None, service_name=get_random_string(), raven_client=None):
+                 message_preprocessor=None, service_name=get_random_string(), raven_client=None,
+                 worker_mode="thread", adaptive=None, lane_capacity=10, dedup=None, parallel_routes=False,
+                 pools=None, metrics=None, trace=None, profiler=None, backlog=None):
 
         """Wrapper around nsqworker.ThreadWorker
+
+        ``worker_mode`` - "thread" runs every message in an executor thread, "async" runs messages on the IOLoop,
+                          routes can then be coroutines (``async def``), blocking routes are run in the executor,
+                          "process" runs every message in a pool of ``concurrency`` processes and kills handlers
+                          exceeding ``timeout``
+        ``adaptive`` - optional ``nsqworker.adaptive.AdaptiveOptions``, adjusts max_in_flight and concurrency at
+                       runtime from the handlers latency, failures and the executor saturation
+        ``lane_capacity`` - messages waiting on the lane of a resource locked in "local" mode before the reader is
+                            paused
+        ``dedup`` - True (configured from the DEDUP_* variables) or an ``nsqworker.dedup.Deduplicator``, the routes
+                    registered with ``dedup=True`` then skip the messages they already handled
+        ``parallel_routes`` - run the routes matched for a message in parallel in the worker executor (on the IOLoop
+                              for coroutine routes), except the locked and ``sequential`` routes which still run one
+                              after the other in registration order. The message is finished once all of them are done
+        ``pools`` - named bulkheads of the routes registered with ``pool=name``: a dict of name to a
+                    ``nsqworker.bulkhead.Bulkhead``, to its max_concurrency or to a (max_concurrency, max_waiting) tuple
+        ``metrics`` - optional ``nsqworker.metrics.MetricsAggregator`` the route metrics are recorded to, by default
+                      the one shared by the handlers of the process, configured from the METRICS_* variables
+        ``trace`` - optional callable, called on the IOLoop with every handled message and its
+                    ``nsqworker.timing.MessageTimings`` (e.g. to send a trace span per message from
+                    ``MessageTimings.spans``), must not block
+        ``profiler`` - True (configured from the PROFILER_* variables) or an ``nsqworker.profiler.RouteProfiler``,
+                       samples the stacks of the threads running blocking routes, see ``profile_stacks``
+        ``backlog`` - True (configured from the BACKLOG_* variables) or an ``nsqworker.backlog.BacklogMonitor``,
+                      polls the channel backlog from the nsqd /stats into the metrics gauges, ``backlog_stats`` and the
+                      ``adaptive`` controller
         """
+        if worker_mode not in WORKER_MODES:
+            raise ValueError("Unknown worker_mode {}, expected one of {}".format(worker_mode, sorted(WORKER_MODES)))
+        coroutine_routes = self._coroutine_routes()
+        if worker_mode != "async" and coroutine_routes:
+            raise ValueError("Coroutine routes ({}) need the async worker_mode".format(
+                ", ".join(r.name for r in coroutine_routes)))
+        if worker_mode == "process" and self._batch_routes():
+            raise ValueError("Batch routes can't run in the process worker_mode")
+        if worker_mode == "process" and parallel_routes:
+            raise ValueError("parallel_routes isn't supported in the process worker_mode")
+        self._bulkheads = self._create_bulkheads(pools or {})
+        if worker_mode == "process" and self._bulkheads:
+            raise ValueError("Route bulkheads aren't supported in the process worker_mode")
+        if worker_mode == "process" and profiler:
+            raise ValueError("The route profiler isn't supported in the process worker_mode")
+
         super(NSQHandler, self).__init__()
         self.logger = self.__class__.get_logger()
         self.io_loop = ioloop.IOLoop.instance()
+        self.metrics = metrics if metrics is not None else process_aggregator()
+        self.metrics.start()
+        self._trace = trace
+        self._profiler = RouteProfiler.from_env(self.logger) if profiler is True else profiler or None
+        if self._profiler is not None:
+            self._profiler.start()
+            if threading.current_thread() is threading.main_thread():
+                self._profiler.install_signal()
         self.topic = topic
         self.channel = channel
-        self.locker = _locker.RedisLocker(service_name, self.logger)
+        # one connection per executor and bulkhead thread, plus the lock lease watchdog
+        threads = adaptive.max_concurrency if adaptive is not None else concurrency
+        threads += sum(b.max_concurrency for b in set(self._bulkheads.values()))
+        self._redis_access = RedisAccess(_locker.REDIS_HOST, _locker.REDIS_PORT, _locker.REDIS_PASSWORD,
+                                         max_connections=threads + 2)
+        self.locker = _locker.RedisLocker(service_name, self.logger, self._redis_access)
         self.raven_client = raven_client
         self._message_preprocessor = message_preprocessor if message_preprocessor else _identity
 
-        self._persistor = MessagePersistor(self.logger)
+        self._persistor = MessagePersistor(self.logger, self._redis_access)
+        self._breakers = self._create_breakers()
+        self._deduplicator = Deduplicator.from_env(self._redis_access, self.logger) if dedup is True else dedup or None
+        self._route_batchers = self._create_route_batchers(max_in_flight)
+        self.parallel_routes = parallel_routes
+        self._respond_lock = threading.Lock()
+        if self._bulkheads and BULKHEAD_REPORT_INTERVAL:
+            ioloop.PeriodicCallback(self._report_bulkheads, BULKHEAD_REPORT_INTERVAL * 1000).start()
         self.register_nsq_topics_from_env([topic])
-        ThreadWorker(
-            message_handler=self.handle_message,
+        self.worker_mode = worker_mode
+        worker_kwargs = dict(kwargs, adaptive=adaptive, lane_capacity=lane_capacity, on_timings=self._report_timings)
+        if self._has_lane_routes():
+            worker_kwargs.update(shard_key=self._shard_key)
+        if worker_mode == "process":
+            worker_kwargs.update(on_fork=self._on_process_fork, publish=self._publish_relayed)
+        self.worker = WORKER_MODES[worker_mode](
+            message_handler=self.handle_message_async if worker_mode == "async" else self.handle_message,
             exception_handler=self.handle_exception,
             timeout=timeout,
             concurrency=concurrency,
             max_in_flight=max_in_flight,
-            topic=topic, channel=channel, service_name=service_name, **kwargs
-        ).subscribe_worker()
+            topic=topic, channel=channel, service_name=service_name, **worker_kwargs
+        )
+        self.worker.subscribe_worker()
+        self._backlog = self._start_backlog(backlog)
 
         # self.routes = []
 
+    def _start_backlog(self, backlog):
+        if backlog is True:
+            backlog = BacklogMonitor.from_env(self.topic, self.channel, metrics=self.metrics, logger=self.logger)
+        if not backlog:
+            return None
+
+        if backlog.metrics is None:
+            backlog.metrics = self.metrics
+        if self.worker.adaptive is not None:
+            backlog.add_listener(self.worker.adaptive.on_backlog)
+        backlog.start()
+        return backlog
+
+    def backlog_stats(self):
+        """Last backlog of the channel polled from nsqd, see ``nsqworker.backlog.BacklogStats``, None if unknown
+
+        :rtype: dict
+        """
+        stats = self._backlog.stats if self._backlog is not None else None
+        return stats.as_dict() if stats is not None else None
+
+    def _on_process_fork(self, relay):
+        """Called in every pool process of the "process" worker mode, publishes are relayed to the parent process
+
+        :type relay: nsqworker.process_pool.PublishRelay
+        """
+        self.writer = relay
+        self.io_loop = relay
+        # the parent process batches and spools the relayed publishes
+        self._batcher = None
+        self._outbox = None
+        self._publish_lock = threading.Lock()
+
+    def _publish_relayed(self, topic, payload, delay):
+        if isinstance(payload, list):
+            self.send_messages(topic, payload)
+        else:
+            self.send_message(topic, payload, delay=delay)
+
     @classmethod
     def register_nsq_topics_from_env(cls, topic_names):
         nsqd_http = os.environ.get("NSQD_HTTP_ADDRESSES")
@@ -169,114 +540,714 @@ class NSQHandler(NSQWriter):
     def get_logger(cls, name=None):
         logger = logging.getLogger(name or cls.__name__)
         if not logger.handlers:
-            formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
-
-            handler = logging.StreamHandler(stream=sys.stdout)
-            handler.setFormatter(formatter)
-            handler.setLevel(logging.INFO)
-
-            logger.addHandler(handler)
+            logger.addHandler(stream_handler("%(asctime)s - %(levelname)s - %(message)s"))
             logger.setLevel(logging.INFO)
             logger.propagate = 0
 
         return logger
 
+    def extract(self, body):
+        """Returns the parsed body of a message, given an nsq.Message the body is decoded once and shared by all
+        routes
+
+        :type body: bytes | nsq.Message
+        :rtype: nsqworker.parsed_message.ParsedMessage
+        """
+        if isinstance(body, nsq.Message):
+            return parse_message(body)
+        return ParsedMessage(body)
+
+    def _event(self, message):
+        """Parsed body of a message the lock keys are read from, through ``extract`` if a subclass overrides it
+        """
+        if type(self).extract is NSQHandler.extract:
+            return parse_message(message)
+        return self.extract(message.body)
+
     @classmethod
-    def register_route(cls, matcher_func, handler_func, is_idempotent):
-        """Register route
+    def register_route(cls, matcher_func, handler_func, is_idempotent=False, **options):
+        """Register route, ``options`` are the ``nsqworker.routing.Route`` options
+
+        Routes are compiled into ``cls.route_table``, ``cls.routes`` keeps the registered tuples
         """
         if getattr(cls, "routes", None) is None:
             cls.routes = []
+        if getattr(cls, "route_table", None) is None:
+            cls.route_table = RouteTable()
 
         # Don't use bound methods - convert to bare function
-        if getattr(handler_func, "im_self", None) is not None:
+        if getattr(handler_func, "__self__", None) is not None:
             handler_func = handler_func.__func__
 
         cls.routes.append((matcher_func, handler_func, is_idempotent))
+        cls.route_table.add(matcher_func, handler_func, is_idempotent, **options)
+
+    def _matched_routes(self, message):
+        """Returns the routes matching a message, along with its event name and JSON body (None if not JSON)
+
+        :rtype: (list[nsqworker.routing.Route], str, dict)
+        """
+        parsed = parse_message(message)
+        routes = self.__class__.route_table.match(parsed)
+
+        jsn = parsed.json if isinstance(parsed.json, dict) else None
+        event_name = jsn.get('name', "<undefined>") if jsn is not None else "<undefined>"
+
+        return routes, event_name, jsn
+
+    @classmethod
+    def _has_lane_routes(cls):
+        route_table = getattr(cls, "route_table", None)
+        return route_table is not None and any(
+            getattr(r.handler_func, "lane_lock_options", None) is not None for r in route_table.routes)
+
+    @classmethod
+    def _batch_routes(cls):
+        route_table = getattr(cls, "route_table", None)
+        return [r for r in route_table.routes if r.is_batch] if route_table is not None else []
+
+    @classmethod
+    def _coroutine_routes(cls):
+        """Routes whose handler is a coroutine, batch routes excepted (they always run from the IOLoop)
+        """
+        route_table = getattr(cls, "route_table", None)
+        routes = route_table.routes if route_table is not None else []
+        return [r for r in routes if not r.is_batch and is_coroutine_function(r.handler_func)]
+
+    def _create_route_batchers(self, max_in_flight):
+        batchers = {}
+        for route in self._batch_routes():
+            if route.batch_size > max_in_flight:
+                self.logger.warning("Batches of route {} are limited to max_in_flight ({}) messages".format(
+                    route.name, max_in_flight))
+            batchers[route] = RouteBatcher(lambda items, route=route: self._run_batch_route(route, items),
+                                           route.batch_size, route.batch_wait, self.io_loop, self.logger)
+        return batchers
+
+    @classmethod
+    def _create_bulkheads(cls, pools):
+        """Bulkheads of the routes registered with ``max_concurrency`` or ``pool``
+
+        :rtype: dict[nsqworker.routing.Route, Bulkhead]
+        """
+        pools = {name: _bulkhead(name, pool) for name, pool in pools.items()}
+        route_table = getattr(cls, "route_table", None)
+        bulkheads = {}
+        for route in route_table.routes if route_table is not None else []:
+            if route.pool is not None:
+                if route.pool not in pools:
+                    raise ValueError("Route {} uses the unknown pool {}".format(route.name, route.pool))
+                bulkheads[route] = pools[route.pool]
+            elif route.max_concurrency is not None:
+                bulkheads[route] = Bulkhead(route.name, route.max_concurrency, max_waiting=route.max_waiting)
+
+        return bulkheads
+
+    def _create_breakers(self):
+        """
+        :rtype: dict[nsqworker.routing.Route, CircuitBreaker]
+        """
+        route_table = getattr(self.__class__, "route_table", None)
+        return {route: CircuitBreaker(route.name, route.circuit_breaker, on_state_change=self._on_circuit_change)
+                for route in (route_table.routes if route_table is not None else []) if route.circuit_breaker}
+
+    def _on_circuit_change(self, route_name, previous, state):
+        self.logger.warning("[CIRCUIT] [topic={}] [channel={}] [route={}] circuit {} -> {}".format(
+            self.topic, self.channel, route_name, previous, state))
+        self.metrics.count("CIRCUIT_{}".format(state), self.topic, self.channel, "circuit_breaker", route_name)
+
+    def circuit_breaker_stats(self):
+        """State, calls and error rate over the window of every route circuit breaker
+
+        :rtype: dict
+        """
+        return {route.name: breaker.stats() for route, breaker in self._breakers.items()}
+
+    def bulkhead_stats(self):
+        """Occupancy of the bulkheads per route, see ``Bulkhead.stats``
+
+        :rtype: dict
+        """
+        stats = {}
+        for bulkhead in set(self._bulkheads.values()):
+            stats.update(bulkhead.stats())
+        return stats
+
+    def _report_bulkheads(self):
+        for route_name, stats in sorted(self.bulkhead_stats().items()):
+            self.logger.info("[BULKHEAD] [topic={}] [channel={}] [route={}] [pool={}] [running={}] [waiting={}] "
+                             "[shed={}] [occupancy={:.2f}]".format(self.topic, self.channel, route_name, stats["pool"],
+                                                                   stats["running"], stats["waiting"], stats["shed"],
+                                                                   stats["occupancy"]))
+
+    def profile_stacks(self, reset=False):
+        """Folded stacks sampled by the route profiler (``route;event;frame... count`` lines), None without one
+
+        :rtype: str
+        """
+        return self._profiler.folded(reset=reset) if self._profiler is not None else None
+
+    def _profiled(self, route, event_name):
+        if self._profiler is None:
+            return _not_profiled
+        return self._profiler.tag(route.name, event_name)
+
+    def _report_timings(self, message, timings):
+        """Record the stage timings of a handled message, see ``nsqworker.timing.MessageTimings.stages``
+        """
+        for stage, duration_ms in timings.stages().items():
+            self.metrics.observe_stage(duration_ms, stage, self.topic, self.channel)
+        if self._trace is not None:
+            self._trace(message, timings)
+
+    def _shard_key(self, message):
+        """Lane key of a message, from the first matching route locked in "local" mode, None if there is none
+        """
+        routes, event_name, _ = self._matched_routes(message)
+        for route in routes:
+            nsq_lock_options = getattr(route.handler_func, "lane_lock_options", None)
+            if nsq_lock_options is None:
+                continue
+            resource_id = self._event(message).get(nsq_lock_options.path_to_id)
+            if resource_id is not None:
+                return "{}:{}".format(event_name, resource_id)
+
+        return None
+
+    def _skip_route(self, jsn, route, route_id):
+        """Persisted messages are only handled by the routes they were persisted for
+        """
+        if jsn is not None and self._persistor.is_persisted_message(jsn):
+            if not self._persistor.is_route_message(jsn, self.channel, route.name):
+                return True
+
+            self.logger.info("[%s] Route %s in channel %s will handle persisted message", route_id, route.name,
+                             self.channel)
+
+        return False
+
+    def _start_route(self, message, route, event_name, route_id):
+        if sampled(route_id):
+            self.logger.info("[%s] [START] [topic=%s] [channel=%s] [event=%s] [route=%s] [try_num=%s]", route_id,
+                             self.topic, self.channel, event_name, route.name, message.attempts,
+                             extra=dict(fields=dict(route_id=route_id, stage="START", topic=self.topic,
+                                                    channel=self.channel, event=event_name, route=route.name,
+                                                    try_num=message.attempts)))
+        return current_milli_time()
+
+    def _requeue_failed(self, message, route, route_id):
+        """In case of failure and route is idempotent re-queue the message until retry limit is reached
+
+        :return: True if the message was re-queued
+        """
+        if not (route.is_idempotent and message.attempts <= RETRY_LIMIT):
+            return False
+
+        self.logger.info(
+            "[{}] trying to re-queue failed message, current attempts: [{}] ".format(route_id, message.attempts))
+        if self._requeue(message, backoff=True, delay=-1):
+            self.logger.info("[{}] message re-queued successfully".format(route_id))
+        return True
+
+    def _requeue(self, message, **kwargs):
+        """Re-queue a message unless another route already responded to it (e.g. routes failing in parallel)
+
+        :return: True if the message was re-queued
+        """
+        with self._respond_lock:
+            if message.has_responded():
+                return False
+            message.requeue(**kwargs)
+            return True
+
+    @staticmethod
+    def _failure_retry_policy(route, jsn, following=None):
+        """The retry policy of a failed route, None if the message is re-queued whole instead. Once the policy is
+        exhausted the message is persisted as failed.
+
+        An idempotent route without a policy is retried on its own with ``RETRY_LIMIT`` retries once other routes of
+        the message ran (``following`` not None), as re-queuing the whole message would run them again
+        :rtype: RetryPolicy
+        """
+        if jsn is None:
+            return None
+        if route.retry_policy is None and route.is_idempotent and following is not None:
+            return _IDEMPOTENT_RETRY_POLICY
+        return route.retry_policy
+
+    def _retry_failed(self, message, route, policy, jsn, e, route_id):
+        """Publish a delayed retry of a failed route with a retry policy, the other routes of the message don't run
+        again
+
+        :return: True if a retry was published
+        """
+        if policy is None:
+            return False
+        attempt = retry_attempt(jsn) + 1
+        if attempt > policy.max_attempts:
+            return False
+
+        delay_ms = policy.delay_ms(attempt)
+        self.logger.warning("[{}] Route {} failed with error {}, retry {}/{} in {}ms".format(
+            route_id, route.name, e, attempt, policy.max_attempts, delay_ms))
+        self.send_message(self.topic, retry_body(jsn, self.channel, [route.name], attempt), delay=delay_ms,
+                          on_delivery=partial(self._on_retry_delivery, message, route, e, route_id))
+        return True
+
+    def _on_retry_delivery(self, message, route, e, route_id, error):
+        if error is None:
+            return
+        self.logger.error("[{}] Publishing retry of route {} failed: {}".format(route_id, route.name, error))
+        # called on the IOLoop
+        self.worker.executor.submit(self._persist_failed, message, route, e, route_id)
+
+    def _defer_contended(self, message, route, jsn, e, route_id, following=None):
+        """The route resource is locked, or the message is handled, by someone else: the route and the ``following``
+        routes are deferred by ``e.delay_ms`` in a copy of the message addressed to them, so the routes which already
+        ran don't run again. With ``following`` None (no other route of the message ran), or if the message isn't a
+        JSON object, the whole message is re-queued without backoff instead, which doesn't count as an attempt.
+
+        :return: the status of the route, "DEFERRED" or "REQUEUED"
+        """
+        if jsn is None or following is None:
+            self.logger.info("[{}] Route {} can't run yet: {}, re-queuing message in {}ms".format(
+                route_id, route.name, e, e.delay_ms))
+            self._requeue(message, backoff=False, time_ms=int(e.delay_ms), contended=True)
+            return "REQUEUED"
+
+        route_names = [route.name] + [r.name for r in following]
+        self.logger.info("[{}] Route {} can't run yet: {}, deferring routes {} by {}ms".format(
+            route_id, route.name, e, ", ".join(route_names), e.delay_ms))
+        body = retry_body(jsn, self.channel, route_names, retry_attempt(jsn), contentions(jsn) + 1)
+        self.send_message(self.topic, body, delay=int(e.delay_ms),
+                          on_delivery=partial(self._on_retry_delivery, message, route, e, route_id))
+        return "DEFERRED"
+
+    def _dedup_key(self, message, route):
+        if self._deduplicator is None or not route.dedup:
+            return None
+        return self._deduplicator.message_key(message, route.name, self.channel)
+
+    def _claim_route(self, message, route, event_name, dedup_key, route_id):
+        """Returns False if the route already handled the message
+
+        :raise: ``DuplicateInProgressError`` if another consumer is handling it
+        """
+        if dedup_key is None or self._deduplicator.claim(dedup_key):
+            return True
+
+        self.logger.info("[{}] Route {} already handled message {}, skipping".format(route_id, route.name, message.id))
+        self.metrics.count("DUPLICATE", self.topic, self.channel, event_name, route.name)
+        return False
+
+    def _dedup_done(self, dedup_key, succeeded):
+        if dedup_key is None:
+            return
+        if succeeded:
+            self._deduplicator.done(dedup_key)
+        else:
+            self._deduplicator.failed(dedup_key)
+
+    def _handle_route_exception(self, message, route, e, route_id):
+        msg = "[{}] Handler {} failed handling message {} with error {}".format(
+            route_id, route.name, message.body, e)
+
+        self.logger.error(msg)
+        self.handle_exception(message, e, tags={"route": route.name, "error": "new NSQ failed event"})
+
+    def _persist_failed(self, message, route, e, route_id):
+        if not self._persistor.enabled:
+            return
+
+        new = self._persistor.persist_message(self.topic, self.channel, route.name, message.body, repr(e))
+        if new is None:
+            self.logger.info("[{}] Persisting failed message".format(route_id))
+        elif new:
+            self.logger.info("[{}] Persisted failed message".format(route_id))
+        else:
+            self.logger.info("[{}] Updated existing failed message".format(route_id))
+
+    def _end_route(self, message, route, event_name, route_id, status, start_time):
+        duration = current_milli_time() - start_time
+        self.metrics.observe(duration, status, self.topic, self.channel, event_name, route.name)
+
+        # the END line of a failure is logged even when its message isn't sampled
+        if status == "OK" and not sampled(route_id):
+            return
+        self.logger.info("[%s] [END] [topic=%s] [channel=%s] [event=%s] [route=%s] [try_num=%s] [status=%s] [time=%s]",
+                         route_id, self.topic, self.channel, event_name, route.name, message.attempts, status,
+                         duration, extra=dict(fields=dict(route_id=route_id, stage="END", topic=self.topic,
+                                                          channel=self.channel, event=event_name, route=route.name,
+                                                          try_num=message.attempts, status=status, time_ms=duration)))
+
+    def _runnable_routes(self, jsn, routes, route_id):
+        """Split the matched routes of a message into the routes run now and its batch routes
+
+        :rtype: (list[nsqworker.routing.Route], list[nsqworker.routing.Route])
+        """
+        runnable, batch_routes = [], []
+        for route in routes:
+            if self._skip_route(jsn, route, route_id):
+                continue
+            (batch_routes if route.is_batch else runnable).append(route)
+
+        return runnable, batch_routes
+
+    def _parallel_routes(self, routes):
+        """Split the routes of a message into a chain run in order and the routes run in parallel to it
+
+        :rtype: (list[nsqworker.routing.Route], list[nsqworker.routing.Route])
+        """
+        if not self.parallel_routes:
+            return routes, []
+        return [r for r in routes if r.sequential], [r for r in routes if not r.sequential]
+
+    def _submit_route(self, message, route, event_name, jsn, route_id):
+        """Run a route off the message thread, on its bulkhead if it has one
+
+        :return: None if the route was shed by its full bulkhead
+        :rtype: concurrent.futures.Future
+        """
+        bulkhead = self._bulkheads.get(route)
+        if bulkhead is None:
+            return self.worker.executor.submit(self._run_route, message, route, event_name, jsn, route_id, [])
+        try:
+            return bulkhead.submit(route.name, self._run_route, message, route, event_name, jsn, route_id, [])
+        except BulkheadFullError as e:
+            self._shed_route(message, route, event_name, jsn, e, route_id)
+            return None
+
+    def _run_chained(self, message, route, event_name, jsn, route_id, following):
+        """Run a route of the chain, the message thread waits for it on its bulkhead if it has one
+
+        :return: False if the route was deferred and the next routes should run once it is delivered again
+        """
+        bulkhead = self._bulkheads.get(route)
+        if bulkhead is None:
+            return self._run_route(message, route, event_name, jsn, route_id, following)
+        try:
+            future = bulkhead.submit(route.name, self._run_route, message, route, event_name, jsn, route_id, following)
+        except BulkheadFullError as e:
+            return self._shed_route(message, route, event_name, jsn, e, route_id)
+        return future.result()
+
+    @gen.coroutine
+    def _run_chained_async(self, message, route, event_name, jsn, route_id, following):
+        """Same as ``_run_chained`` on the IOLoop
+        """
+        bulkhead = self._bulkheads.get(route)
+        if bulkhead is None:
+            proceed = yield self._run_route_async(message, route, event_name, jsn, route_id, following)
+            raise gen.Return(proceed)
+        try:
+            future = bulkhead.run_async(route.name, self._run_route_async, message, route, event_name, jsn, route_id,
+                                        following)
+        except BulkheadFullError as e:
+            raise gen.Return(self._shed_route(message, route, event_name, jsn, e, route_id))
+        proceed = yield future
+        raise gen.Return(proceed)
+
+    def _start_route_async(self, message, route, event_name, jsn, route_id):
+        """Same as ``_submit_route`` on the IOLoop
+
+        :rtype: tornado.concurrent.Future
+        """
+        bulkhead = self._bulkheads.get(route)
+        if bulkhead is None:
+            return self._run_route_async(message, route, event_name, jsn, route_id, [])
+        try:
+            return bulkhead.run_async(route.name, self._run_route_async, message, route, event_name, jsn, route_id, [])
+        except BulkheadFullError as e:
+            self._shed_route(message, route, event_name, jsn, e, route_id)
+            return None
+
+    def _shed_route(self, message, route, event_name, jsn, e, route_id, status="SHED"):
+        """A route can't run now (full bulkhead, open circuit), a copy of the message addressed to this route only is
+        published with a delay (the whole message is re-queued if it isn't a JSON object)
+
+        :return: False if the whole message was re-queued
+        """
+        self.metrics.count(status, self.topic, self.channel, event_name, route.name)
+        if jsn is None:
+            self._defer_contended(message, route, jsn, e, route_id)
+            return False
+
+        self.logger.warning("[{}] Route {} can't run yet: {}, deferring it by {}ms".format(
+            route_id, route.name, e, e.delay_ms))
+        self.send_message(self.topic, retry_body(jsn, self.channel, [route.name], retry_attempt(jsn)), delay=e.delay_ms,
+                          on_delivery=partial(self._on_retry_delivery, message, route, e, route_id))
+        return True
+
+    def _shed_open_circuit(self, message, route, event_name, jsn, route_id):
+        """The circuit of a route is open, the message is deferred or persisted without calling the handler
+
+        :return: False if the whole message was re-queued
+        """
+        breaker = self._breakers[route]
+        e = CircuitOpenError(route.name, breaker.retry_after_ms())
+        if breaker.options.on_open != CIRCUIT_OPEN_PERSIST:
+            return self._shed_route(message, route, event_name, jsn, e, route_id, status="CIRCUIT_SHED")
+
+        self.logger.info("[{}] Route {} skipped: {}".format(route_id, route.name, e))
+        self.metrics.count("CIRCUIT_SHED", self.topic, self.channel, event_name, route.name)
+        self._persist_failed(message, route, e, route_id)
+        return True
+
+    def _circuit_allows(self, route):
+        breaker = self._breakers.get(route)
+        return breaker is None or breaker.allow()
+
+    def _record_outcome(self, route, succeeded, start_time):
+        breaker = self._breakers.get(route)
+        if breaker is not None:
+            breaker.record(succeeded, current_milli_time() - start_time)
+
+    def _run_route(self, message, route, event_name, jsn, route_id, following=None):
+        """Run a route handler for a message
+
+        ``following`` - the routes run after this one, deferred along with it if its resource is busy, None if no
+                        other route of the message ran (the whole message is re-queued then)
+        :return: False if the route was deferred and the next routes should run once it is delivered again
+        """
+        if not self._circuit_allows(route):
+            return self._shed_open_circuit(message, route, event_name, jsn, route_id)
+
+        dedup_key = self._dedup_key(message, route)
+        try:
+            if not self._claim_route(message, route, event_name, dedup_key, route_id):
+                return True
+        except DuplicateInProgressError as e:
+            # re-queued whole: a copy of the message would get a de-duplication key of its own
+            self._defer_contended(message, route, jsn, e, route_id)
+            return False
+
+        status = "OK"
+        start_time = self._start_route(message, route, event_name, route_id)
+        # the lock release, the de-duplication state and the failed message persistence are sent together
+        with self._redis_access.batch():
+            try:
+                with self._profiled(route, event_name):
+                    route.handler_func(self, self._message_preprocessor(message))
+
+            except _locker.LockContendedError as e:
+                self._dedup_done(dedup_key, False)
+                status = self._defer_contended(message, route, jsn, e, route_id, following)
+                self._end_route(message, route, event_name, route_id, status, start_time)
+                return False
+
+            except Exception as e:
+                self._dedup_done(dedup_key, False)
+                self._record_outcome(route, False, start_time)
+                self.worker.stats.route_failed(message)
+                policy = self._failure_retry_policy(route, jsn, following)
+                if self._retry_failed(message, route, policy, jsn, e, route_id):
+                    status = "RETRYING"
+                elif policy is None and self._requeue_failed(message, route, route_id):
+                    return True
+                else:
+                    status = "FAILED"
+                    self._handle_route_exception(message, route, e, route_id)
+                    self._persist_failed(message, route, e, route_id)
+
+            else:
+                self._dedup_done(dedup_key, True)
+                self._record_outcome(route, True, start_time)
+
+        self._end_route(message, route, event_name, route_id, status, start_time)
+        return True
 
     def route_message(self, message):
         """Basic message router
 
-        Handlers for the same route will be run sequentially
+        Handlers for the same route will be run sequentially, with ``parallel_routes`` only the locked and
+        ``sequential`` routes are, the other routes are run in parallel in the worker executor
 
         type message: nsq.Message
+        :return: a future resolved once the parallel and batch routes of the message are done, None if it has none
         """
-        m_body = message.body
-        handlers = []
+        routes, event_name, jsn = self._matched_routes(message)
+
+        if len(routes) == 0:
+            self.logger.debug("No handlers found for message %s.", message.body)
+            return
+
+        route_id = gen_random_string()
+        routes, batch_routes = self._runnable_routes(jsn, routes, route_id)
+        routes, parallel = self._parallel_routes(routes)
+        deferred = [self._submit_route(message, route, event_name, jsn, route_id) for route in parallel]
+        deferred = [future for future in deferred if future is not None]
 
-        for matcher_func, handler_func, is_idempotent in self.__class__.routes:
+        # the whole message is re-queued if its first route is contended while no other route runs
+        for i, route in enumerate(routes):
+            following = routes[i + 1:] + batch_routes if i > 0 or parallel else None
+            if not self._run_chained(message, route, event_name, jsn, route_id, following):
+                # the next routes are run once the message is delivered again
+                break
+        else:
+            deferred.extend(self._defer_batch_routes(message, batch_routes, event_name, jsn, route_id))
 
-            if matcher_func(m_body) is True:
-                handlers.append((handler_func, is_idempotent))
+        return _all_done(deferred) if deferred else None
 
-        if len(handlers) == 0:
-            self.logger.debug("No handlers found for message {}.".format(message.body))
-            return
+    def _defer_batch_routes(self, message, routes, event_name, jsn, route_id):
+        """Add a message to the batches of its batch routes, can be called from any thread
 
-        event_name = "<undefined>"
-        jsn = None
+        :return: a future per batch route, resolved once its batch was handled
+        :rtype: list[concurrent.futures.Future]
+        """
+        futures = []
+        for route in routes:
+            future = concurrent.futures.Future()
+            item = _BatchItem(message, event_name, jsn, route_id,
+                              self._start_route(message, route, event_name, route_id))
+            self.io_loop.add_callback(self._route_batchers[route].add, item, future)
+            futures.append(future)
+        return futures
+
+    @gen.coroutine
+    def _run_batch_route(self, route, items):
+        """Run a batch route handler from the IOLoop, then end the route of every message of the batch
+
+        :type items: list[_BatchItem]
+        """
+        messages = [self._message_preprocessor(item.message) for item in items]
         try:
-            jsn = json.loads(m_body)
-            event_name = jsn['name']
-        except Exception:
-            pass
+            results = yield self._run_route_handler(route, messages, "<batch>")
+            results = _batch_results(results, len(items))
+        except Exception as e:
+            results = [e] * len(items)
 
-        route_id = gen_random_string()
+        yield self.worker.executor.submit(self._end_batch_route, route, items, results)
 
-        for handler, is_idempotent in handlers:
-            status = "OK"
+    def _end_batch_route(self, route, items, results):
+        # the failed messages are persisted in a single pipeline
+        with self._redis_access.batch():
+            for item, result in zip(items, results):
+                message = item.message
+                status = "OK"
+                if isinstance(result, Exception):
+                    self.worker.stats.route_failed(message)
+                    policy = self._failure_retry_policy(route, item.jsn)
+                    if self._retry_failed(message, route, policy, item.jsn, result, item.route_id):
+                        status = "RETRYING"
+                    # a message which isn't a JSON object is re-queued whole, unless another route re-queued it
+                    elif policy is None and (
+                            message.has_responded() or self._requeue_failed(message, route, item.route_id)):
+                        continue
+                    else:
+                        status = "FAILED"
+                        self._handle_route_exception(message, route, result, item.route_id)
+                        self._persist_failed(message, route, result, item.route_id)
 
-            if jsn is not None and self._persistor.is_persisted_message(jsn):
-                if self._persistor.is_route_message(jsn, self.channel, handler.__name__):
+                self._end_route(message, route, item.event_name, item.route_id, status, item.start_time)
 
-                    self.logger.info("[{}] Route {} in channel {} will handle persisted message".format(
-                        route_id, self.topic, self.channel, handler.__name__, self.channel
-                    ))
+    def _run_route_handler(self, route, message, event_name):
+        """Start a route handler from the IOLoop, coroutine handlers run on the loop and blocking handlers in the
+        worker executor (or the route bulkhead)
 
-                else:
-                    continue
+        :rtype: tornado.concurrent.Future
+        """
+        if is_coroutine_function(route.handler_func):
+            return gen.convert_yielded(route.handler_func(self, message))
 
-            self.logger.info("[{}] [START] [topic={}] [channel={}] [event={}] [route={}] [try_num={}]".format(
-                route_id, self.topic, self.channel, event_name, handler.__name__, message.attempts))
-            start_time = current_milli_time()
+        bulkhead = self._bulkheads.get(route)
+        executor = bulkhead.executor if bulkhead is not None else self.worker.executor
+        if self._profiler is not None:
+            return executor.submit(self._profiler.run_tagged, route.name, event_name, route.handler_func, self, message)
+        return executor.submit(route.handler_func, self, message)
+
+    @gen.coroutine
+    def _run_route_async(self, message, route, event_name, jsn, route_id, following=None):
+        """Same as ``_run_route`` on the IOLoop, the blocking redis and persistence calls run in the worker executor
+        """
+        if not self._circuit_allows(route):
+            proceed = yield self.worker.executor.submit(
+                self._shed_open_circuit, message, route, event_name, jsn, route_id)
+            raise gen.Return(proceed)
+
+        dedup_key = self._dedup_key(message, route)
+        if dedup_key is not None:
             try:
-                handler(self, self._message_preprocessor(message))
+                claimed = yield self.worker.executor.submit(
+                    self._claim_route, message, route, event_name, dedup_key, route_id)
+            except DuplicateInProgressError as e:
+                # re-queued whole: a copy of the message would get a de-duplication key of its own
+                self._defer_contended(message, route, jsn, e, route_id)
+                raise gen.Return(False)
+            if not claimed:
+                raise gen.Return(True)
 
-            except Exception as e:
-                # In case of failure and route is idempotent re-queue the message until retry limit is reached
-                if is_idempotent and message.attempts <= RETRY_LIMIT:
-                    self.logger.info(
-                        "[{}] trying to re-queue failed message, current attempts: [{}] ".format(route_id,
-                                                                                                 message.attempts))
-                    message.requeue(backoff=True, delay=-1)
-                    self.logger.info(
-                        "[{}] message re-queued successfully".format(route_id))
-                    continue
+        status = "OK"
+        start_time = self._start_route(message, route, event_name, route_id)
+        try:
+            yield self._run_route_handler(route, self._message_preprocessor(message), event_name)
+
+        except _locker.LockContendedError as e:
+            if dedup_key is not None:
+                yield self.worker.executor.submit(self._dedup_done, dedup_key, False)
+            status = self._defer_contended(message, route, jsn, e, route_id, following)
+            self._end_route(message, route, event_name, route_id, status, start_time)
+            raise gen.Return(False)
 
+        except Exception as e:
+            if dedup_key is not None:
+                yield self.worker.executor.submit(self._dedup_done, dedup_key, False)
+            self._record_outcome(route, False, start_time)
+            self.worker.stats.route_failed(message)
+            policy = self._failure_retry_policy(route, jsn, following)
+            if self._retry_failed(message, route, policy, jsn, e, route_id):
+                status = "RETRYING"
+            elif policy is None and self._requeue_failed(message, route, route_id):
+                raise gen.Return(True)
+            else:
                 status = "FAILED"
-                msg = "[{}] Handler {} failed handling message {} with error {}".format(
-                    route_id, handler.__name__, message.body, e)
-
-                self.logger.error(msg)
-                self.handle_exception(message, e, tags={"route": handler.__name__, "error": "new NSQ failed event"})
-                if self._persistor.enabled:
-                    new = self._persistor.persist_message(self.topic, self.channel, handler.__name__, m_body,
-                                                          repr(e))
-                    if new:
-                        self.logger.info("[{}] Persisted failed message".format(route_id))
-                    else:
-                        self.logger.info("[{}] Updated existing failed message".format(route_id))
+                self._handle_route_exception(message, route, e, route_id)
+                yield self.worker.executor.submit(self._persist_failed, message, route, e, route_id)
 
-            measure_nsq_latency(duration=float(current_milli_time() - start_time),
-                                topic=self.topic, channel=self.channel,
-                                event=event_name, route=handler.__name__)
-            measure_nsq_stats(status=status, topic=self.topic, channel=self.channel,
-                              event=event_name, route=handler.__name__)
+        else:
+            if dedup_key is not None:
+                yield self.worker.executor.submit(self._dedup_done, dedup_key, True)
+            self._record_outcome(route, True, start_time)
 
-            self.logger.info(
-                "[{}] [END] [topic={}] [channel={}] [event={}] [route={}] [try_num={}] [status={}] [time={}]".format(
-                    route_id, self.topic, self.channel, event_name, handler.__name__, message.attempts, status,
-                    str(current_milli_time() - start_time)))
+        self._end_route(message, route, event_name, route_id, status, start_time)
+        raise gen.Return(True)
+
+    @gen.coroutine
+    def route_message_async(self, message):
+        """Message router of the "async" worker mode
+
+        Same as ``route_message`` but runs on the IOLoop, with ``parallel_routes`` the routes which aren't locked nor
+        ``sequential`` run concurrently with the chain of the others
+
+        type message: nsq.Message
+        :return: a future resolved once the batch routes of the message are done, None if it has none
+        """
+        routes, event_name, jsn = self._matched_routes(message)
+
+        if len(routes) == 0:
+            self.logger.debug("No handlers found for message %s.", message.body)
+            return
+
+        route_id = gen_random_string()
+        routes, batch_routes = self._runnable_routes(jsn, routes, route_id)
+        routes, parallel = self._parallel_routes(routes)
+        # the whole message is re-queued if its first route is contended while no other route runs
+        alone = not parallel
+        parallel = [self._start_route_async(message, route, event_name, jsn, route_id) for route in parallel]
+        parallel = [future for future in parallel if future is not None]
+
+        batches = None
+        for i, route in enumerate(routes):
+            following = routes[i + 1:] + batch_routes if i > 0 or not alone else None
+            proceed = yield self._run_chained_async(message, route, event_name, jsn, route_id, following)
+            if not proceed:
+                # the next routes are run once the message is delivered again
+                break
+        else:
+            batches = self._defer_batch_routes(message, batch_routes, event_name, jsn, route_id)
+
+        yield parallel
+        # the message waits for its batches out of its lane
+        raise gen.Return(_all_done(batches) if batches else None)
 
     def handle_message(self, message):
         """
@@ -284,9 +1255,24 @@ class NSQHandler(NSQWriter):
         :type message: nsq.Message
         """
 
-        self.logger.debug("Received message: {}".format(message.body))
-        self.route_message(message)
-        self.logger.debug("Finished handling message: {}".format(message.body))
+        self.logger.debug("Received message: %s", message.body)
+        deferred = self.route_message(message)
+        self.logger.debug("Finished handling message: %s", message.body)
+        # a message waiting for parallel or batch routes is finished by the worker once they are done
+        return deferred
+
+    @gen.coroutine
+    def handle_message_async(self, message):
+        """
+        Message handler of the "async" worker mode
+        :type message: nsq.Message
+        """
+
+        self.logger.debug("Received message: %s", message.body)
+        deferred = yield self.route_message_async(message)
+        self.logger.debug("Finished handling message: %s", message.body)
+        # a message waiting for batch routes is finished by the worker once they are done
+        raise gen.Return(deferred)
 
     def handle_exception(self, message, e, notify=True, tags=None):
         """
@@ -1,33 +1,135 @@
 import argparse
+import inspect
 import logging
-import sys
+import threading
+import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
 
 import nsq
 from tornado import gen
 from tornado import ioloop
-from tornado.concurrent import run_on_executor
+from tornado.concurrent import is_future, run_on_executor
 
 try:
     from errors import TimeoutError
 except ModuleNotFoundError:
     from nsqworker.errors import TimeoutError
 
+from .adaptive import AdaptiveController, ConcurrencyLimit, WorkerStats
+from .lanes import KeyedLanes
+from .logs import stream_handler
+from .process_pool import ProcessPool
+from .timer_wheel import TimerWheel
+from .timing import MessageTimings
+
+# nsqd default --msg-timeout, used until a connection reports the negotiated one
+DEFAULT_MSG_TIMEOUT_MS = 60000
+# messages whose contention re-queues are remembered by the reader until they are delivered again
+MAX_CONTENDED_MESSAGES = 10000
+
+
+def is_coroutine_function(func):
+    """True for ``async def`` functions and ``tornado.gen.coroutine`` decorated functions (bound or not)
+    """
+    return inspect.iscoroutinefunction(func) or gen.is_coroutine_function(func)
+
+
+class Reader(nsq.Reader):
+    """``nsq.Reader`` keeping the message timeout negotiated with nsqd (the lowest one over its connections)
+
+    A message re-queued with ``message.requeue(contended=True)`` (its resource was busy, it didn't fail) isn't
+    counted as an attempt: when it is delivered again to this reader ``message.attempts`` leaves out these re-queues,
+    counted by ``message.contentions``, so they don't use up ``max_tries``.
+    The counts are kept in the memory of this reader (for the last MAX_CONTENDED_MESSAGES messages): a message
+    delivered again to another consumer, after a restart or after its timeout counts its contentions as attempts.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Reader, self).__init__(*args, **kwargs)
+        msg_timeout = kwargs.get("msg_timeout")
+        self.msg_timeout_ms = int(msg_timeout * 1000) if msg_timeout else DEFAULT_MSG_TIMEOUT_MS
+        self._negotiated_msg_timeouts = {}
+        # message id to its contention re-queues, messages are re-queued from the handler threads
+        self._contentions = OrderedDict()
+        self._contentions_lock = threading.Lock()
+
+    def _handle_message(self, conn, message):
+        with self._contentions_lock:
+            message.contentions = self._contentions.pop(message.id, 0)
+        message.attempts = max(1, message.attempts - message.contentions)
+        message.on(nsq.event.REQUEUE, self._on_message_requeue)
+        return super(Reader, self)._handle_message(conn, message)
+
+    def _on_message_requeue(self, message, contended=False, **kwargs):
+        # the previous contentions of a message re-queued on failure still don't count as attempts
+        contentions = message.contentions + 1 if contended else message.contentions
+        if not contentions:
+            return
+        with self._contentions_lock:
+            self._contentions[message.id] = contentions
+            if len(self._contentions) > MAX_CONTENDED_MESSAGES:
+                self._contentions.popitem(last=False)
+
+    def _on_connection_identify_response(self, conn, data, **kwargs):
+        if isinstance(data, dict) and data.get("msg_timeout"):
+            self._negotiated_msg_timeouts[conn.id] = int(data["msg_timeout"])
+            self.msg_timeout_ms = min(self._negotiated_msg_timeouts.values())
+        return super(Reader, self)._on_connection_identify_response(conn, data, **kwargs)
+
+
+class _InFlight(object):
+    __slots__ = ("touch_timer", "timeout_timer")
+
+    def __init__(self):
+        self.touch_timer = None
+        self.timeout_timer = None
+
 
 class ThreadWorker:
+    # the handler can't be stopped, on timeout the exception handler is called while the handler keeps running
+    soft_timeout = True
+
     def __init__(self, message_handler=None, exception_handler=None,
-                 concurrency=1, max_in_flight=1, timeout=None, service_name="no_name", **kwargs):
+                 concurrency=1, max_in_flight=1, timeout=None, service_name="no_name", adaptive=None,
+                 shard_key=None, lane_capacity=10, on_timings=None, **kwargs):
+        """
+        ``adaptive`` - optional ``nsqworker.adaptive.AdaptiveOptions``, when given max_in_flight and concurrency are
+                       only the starting point of an ``AdaptiveController`` adjusting them within the given bounds
+        ``shard_key`` - optional function returning the key of a message (or None), messages sharing a key are handled
+                        one at a time in the order they were received, the reader is paused (RDY 0) while a key has
+                        ``lane_capacity`` messages waiting
+        ``on_timings`` - optional callable, called on the IOLoop with every message once it was responded to, along
+                         with its ``nsqworker.timing.MessageTimings``
+        """
         self.io_loop = ioloop.IOLoop.instance()
-        self.executor = ThreadPoolExecutor(concurrency)
         self.concurrency = concurrency
+        self.stats = WorkerStats()
+        # limits the messages running in the executor when its size is adjusted at runtime
+        self.concurrency_limit = None
+        if adaptive is not None:
+            self.executor = ThreadPoolExecutor(adaptive.max_concurrency)
+            self.concurrency_limit = ConcurrencyLimit(
+                min(adaptive.max_concurrency, max(adaptive.min_concurrency, concurrency)))
+        else:
+            self.executor = ThreadPoolExecutor(concurrency)
         self.max_in_flight = max_in_flight
         self.kwargs = kwargs
         self.message_handler = message_handler
         self.exception_handler = exception_handler
         self.timeout = timeout
         self.service_name = service_name
+        self.reader = None
+        self._paused_max_in_flight = None
+        # touches and timeouts of all the in flight messages
+        self.timers = TimerWheel(logger=ThreadWorker.get_logger())
 
         self.logger = ThreadWorker.get_logger()
+        self.adaptive = AdaptiveController(self, adaptive, self.logger) if adaptive is not None else None
+        self.shard_key = shard_key
+        self.lanes = KeyedLanes(lane_capacity, on_full=self.pause, on_drained=self.resume,
+                                logger=self.logger) if shard_key is not None else None
+        self.on_timings = on_timings
 
     @staticmethod
     def get_logger():
@@ -41,21 +143,69 @@ class ThreadWorker:
             if not isinstance(level, int):
                 raise ValueError('Invalid log level: %s' % args.loglevel)
 
-            formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-
-            handler = logging.StreamHandler(stream=sys.stdout)
-            handler.setFormatter(formatter)
-            handler.setLevel(level)
-
-            logger.addHandler(handler)
+            logger.addHandler(stream_handler("%(asctime)s - %(name)s - %(levelname)s - %(message)s", level))
             logger.setLevel(level)
             logger.propagate = 0
 
         return logger
 
+    @property
+    def touch_interval_ms(self):
+        """Messages are touched twice per the message timeout negotiated with nsqd
+        """
+        msg_timeout_ms = self.reader.msg_timeout_ms if self.reader is not None else DEFAULT_MSG_TIMEOUT_MS
+        return max(1000, msg_timeout_ms // 2)
+
+    @property
+    def paused(self):
+        return self._paused_max_in_flight is not None
+
+    def pause(self):
+        """Stop receiving messages (RDY 0) until ``resume`` is called, the in flight messages are still handled
+        """
+        if self.reader is None or self.paused:
+            return
+        self.logger.info("Pausing the reader")
+        self._paused_max_in_flight = self.reader.max_in_flight
+        self.reader.set_max_in_flight(0)
+
+    def resume(self):
+        if not self.paused:
+            return
+        self.logger.info("Resuming the reader")
+        max_in_flight, self._paused_max_in_flight = self._paused_max_in_flight, None
+        self.reader.set_max_in_flight(max_in_flight)
+
     @run_on_executor
     def _run_threaded_handler(self, message):
-        self.message_handler(message)
+        message.timings.start()
+        return self.message_handler(message)
+
+    @property
+    def queue_depth(self):
+        """Number of messages waiting for an executor thread
+        """
+        waiting = self.concurrency_limit.waiting if self.concurrency_limit is not None else 0
+        return waiting + self.executor._work_queue.qsize()
+
+    @gen.coroutine
+    def _run_limited_handler(self, message):
+        yield self.concurrency_limit.acquire()
+        try:
+            result = yield self._run_threaded_handler(message)
+        finally:
+            self.concurrency_limit.release()
+        raise gen.Return(result)
+
+    def _run_executor_handler(self, message):
+        if self.concurrency_limit is not None:
+            return self._run_limited_handler(message)
+        return self._run_threaded_handler(message)
+
+    def _run_handler(self, message):
+        """Start the message handler, returns a future resolved when it is done
+        """
+        return self._run_executor_handler(message)
 
     @gen.coroutine
     def _message_handler(self, message):
@@ -64,6 +214,9 @@ class ThreadWorker:
         """
         self.logger.debug("Received message %s", message.id)
         message.enable_async()
+        message.timings = MessageTimings(message.timestamp)
+
+        in_flight = _InFlight()
 
         def touch():
             self.logger.debug("Sending touch event for message %s", message.id)
@@ -71,12 +224,12 @@ class ThreadWorker:
                 message.touch()
             except AssertionError:
                 self.logger.debug("touch() raised an exception - ignore it")
+            in_flight.touch_timer = self.timers.schedule(self.touch_interval_ms, touch)
 
-        p = ioloop.PeriodicCallback(touch, 30000)
-        p.start()
+        in_flight.touch_timer = self.timers.schedule(self.touch_interval_ms, touch)
 
         def timeout_handler():
-            p.stop()
+            self.timers.cancel(in_flight.touch_timer)
 
             error = \
                 "Message handler {} in {} for message {} exceeded timeout: {}".format(self.message_handler,
@@ -87,36 +240,150 @@ class ThreadWorker:
             if self.exception_handler is not None:
                 self.exception_handler(message, TimeoutError(error))
 
-        timeout = None
-        if self.timeout is not None:
-            timeout = self.io_loop.call_later(self.timeout, timeout_handler)
+        def run():
+            # a message waiting in its lane doesn't count against the timeout
+            if self.timeout is not None and self.soft_timeout:
+                in_flight.timeout_timer = self.timers.schedule(self.timeout * 1000, timeout_handler)
+            return self._run_handler(message)
 
+        self.stats.in_flight += 1
+        start_time = time.monotonic()
+        failed = False
         try:
-            result = self._run_threaded_handler(message)
+            key = self.shard_key(message) if self.shard_key is not None else None
+            result = self.lanes.submit(key, run) if key is not None else run()
             yield result
-            result.exception()
+            deferred = result.result()
+            if is_future(deferred):
+                # the handler returned while the message is still being handled elsewhere (e.g. a batch route), it
+                # stays in flight and touched without holding a thread
+                yield deferred
         except Exception as e:
+            failed = True
             self.logger.debug("Message handler for message %s raised an exception", message.id)
             if self.exception_handler is not None:
                 self.exception_handler(message, e)
         finally:
-            p.stop()
-            if timeout is not None:
-                self.io_loop.remove_timeout(timeout)
+            self.stats.in_flight -= 1
+            self.stats.message_done(message, (time.monotonic() - start_time) * 1000, failed)
+            self.timers.cancel(in_flight.touch_timer)
+            self.timers.cancel(in_flight.timeout_timer)
+            message.timings.handle_done()
             if not message.has_responded():
                 message.finish()
+            message.timings.finish()
+            self._report_timings(message)
 
         self.logger.debug("Finished handling message %s", message.id)
 
+    def _report_timings(self, message):
+        if self.on_timings is None:
+            return
+        try:
+            self.on_timings(message, message.timings)
+        except Exception:
+            self.logger.exception("Reporting the timings of message %s failed", message.id)
+
     def subscribe_worker(self):
         kwargs = {k: v for k, v in self.kwargs.items()}
 
         kwargs["message_handler"] = self._message_handler
         kwargs["max_in_flight"] = self.max_in_flight
 
-        self.reader = nsq.Reader(**kwargs)
+        if self.adaptive is not None:
+            kwargs["max_in_flight"] = min(self.adaptive.options.max_in_flight,
+                                          max(self.adaptive.options.min_in_flight, self.max_in_flight))
+
+        self.reader = Reader(**kwargs)
+        if self.adaptive is not None:
+            self.adaptive.start()
 
         self.logger.info("Added an handler for NSQD messages on [service_name={}] [topic={}], [channel={}].".format(
             self.service_name, self.kwargs["topic"], self.kwargs["channel"]))
         self.logger.info("Handling messages with {} threads and {} max_in_flight.".format(
             self.concurrency, self.max_in_flight))
+
+
+class AsyncWorker(ThreadWorker):
+    """A worker running coroutine message handlers directly on the IOLoop
+
+    The message handler can be an ``async def`` function or a ``tornado.gen.coroutine``, it gets the same touch,
+    timeout, finish and exception handling as in ``ThreadWorker``, without holding an executor thread.
+    The number of messages handled at once is bound by ``max_in_flight`` only.
+    A blocking (non coroutine) message handler is still run in the executor thread pool (``concurrency`` threads).
+    """
+
+    def _run_handler(self, message):
+        if is_coroutine_function(self.message_handler):
+            message.timings.start()
+            return gen.convert_yielded(self.message_handler(message))
+
+        return self._run_executor_handler(message)
+
+    def subscribe_worker(self):
+        super(AsyncWorker, self).subscribe_worker()
+        self.logger.info("Coroutine handlers are run on the IOLoop.")
+
+
+class ProcessWorker(ThreadWorker):
+    """A worker running the message handler in a pool of ``concurrency`` forked processes
+
+    The handler gets a ``ProcessMessage`` holding the message id, body, attempts and timestamp, its
+    ``finish``/``requeue`` calls are applied to the message on the IOLoop once it returns.
+    A handler exceeding ``timeout`` is stopped: its process is killed and replaced, and the exception handler is
+    called with an ``nsqworker.errors.TimeoutError``.
+    ``on_fork`` is called in every new pool process with a ``PublishRelay``, see ``NSQHandler``.
+    """
+    soft_timeout = False
+
+    def __init__(self, message_handler=None, exception_handler=None, concurrency=1, max_in_flight=1, timeout=None,
+                 service_name="no_name", on_fork=None, publish=None, **kwargs):
+        super(ProcessWorker, self).__init__(message_handler=message_handler, exception_handler=exception_handler,
+                                            concurrency=concurrency, max_in_flight=max_in_flight, timeout=timeout,
+                                            service_name=service_name, **kwargs)
+        self.on_fork = on_fork
+        self.publish = publish
+        self.pool = None
+        # the pool size is fixed, an adaptive controller only adjusts max_in_flight
+        self.concurrency_limit = None
+
+    @property
+    def queue_depth(self):
+        return self.pool.waiting if self.pool is not None else 0
+
+    @gen.coroutine
+    def _run_handler(self, message):
+        submitted = time.monotonic()
+        try:
+            result = yield self.pool.submit(message, self.timeout)
+        except Exception:
+            # killed or died without a result, the time waiting for a free process is part of the handler stage
+            message.timings.start(submitted)
+            raise
+        message.timings.start(result.started)
+        message.timings.add_lock_time(result.lock_ms)
+        message.failed_routes = result.failed_routes
+
+        for topic, payload, delay in result.published:
+            self.publish(topic, payload, delay)
+
+        if result.response is not None and not message.has_responded():
+            action, action_kwargs = result.response
+            getattr(message, action)(**action_kwargs)
+
+        if result.error is not None:
+            raise result.error
+
+    def subscribe_worker(self):
+        # fork before the reader opens its connections
+        self.pool = ProcessPool(self.message_handler, self.concurrency, io_loop=self.io_loop,
+                                on_fork=self.on_fork, logger=self.logger, timers=self.timers)
+        super(ProcessWorker, self).subscribe_worker()
+        self.logger.info("Messages are handled in {} worker processes.".format(self.concurrency))
+
+
+WORKER_MODES = {
+    "thread": ThreadWorker,
+    "async": AsyncWorker,
+    "process": ProcessWorker,
+}
@@ -1,17 +1,50 @@
 import functools
 import logging
 import os
-import sys
+import random
+import threading
+from collections import deque
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
 
 import nsq
-from nsq import Error
+from nsq import Error, protocol
 from tornado import ioloop
+from tornado.concurrent import Future
+
+from .errors import PublishError
+from .logs import stream_handler
+from .outbox import OUTBOX_DIR, OUTBOX_DRAIN_BATCH, OUTBOX_DRAIN_INTERVAL_MS, Outbox
+from .publish_batcher import PublishBatcher
 
 BYTES_MAX_SIZE = os.environ.get('BYTES_MAX_SIZE', '1048576')
 if not BYTES_MAX_SIZE.isdigit():
     raise EnvironmentError("Please set a number to the BYTES_MAX_SIZE")
 BYTES_MAX_SIZE = int(BYTES_MAX_SIZE)
 
+# Opt-in publish batching: single message publishes are coalesced into mpub batches for PUB_BATCH_LINGER_MS
+PUB_BATCH_LINGER_MS = os.environ.get('PUB_BATCH_LINGER_MS', '0')
+PUB_BATCH_MAX_COUNT = os.environ.get('PUB_BATCH_MAX_COUNT', '100')
+if not (PUB_BATCH_LINGER_MS.isdigit() and PUB_BATCH_MAX_COUNT.isdigit()):
+    raise EnvironmentError("Please set a number to PUB_BATCH_LINGER_MS and PUB_BATCH_MAX_COUNT")
+PUB_BATCH_LINGER_MS = int(PUB_BATCH_LINGER_MS)
+PUB_BATCH_MAX_COUNT = int(PUB_BATCH_MAX_COUNT)
+
+# Failed publishes are retried with exponential backoff and jitter, between PUB_RETRY_BASE_DELAY_MS and
+# PUB_RETRY_MAX_DELAY_MS, up to PUB_RETRY_MAX_ATTEMPTS times (0 - no limit) and as long as the payloads waiting for
+# a retry take less than PUB_RETRY_MAX_BUFFERED_BYTES
+PUB_RETRY_BASE_DELAY_MS = os.environ.get('PUB_RETRY_BASE_DELAY_MS', '1000')
+PUB_RETRY_MAX_DELAY_MS = os.environ.get('PUB_RETRY_MAX_DELAY_MS', '30000')
+PUB_RETRY_MAX_ATTEMPTS = os.environ.get('PUB_RETRY_MAX_ATTEMPTS', '0')
+PUB_RETRY_MAX_BUFFERED_BYTES = os.environ.get('PUB_RETRY_MAX_BUFFERED_BYTES', str(100 * 1024 * 1024))
+if not all(v.isdigit() for v in (PUB_RETRY_BASE_DELAY_MS, PUB_RETRY_MAX_DELAY_MS, PUB_RETRY_MAX_ATTEMPTS,
+                                  PUB_RETRY_MAX_BUFFERED_BYTES)):
+    raise EnvironmentError("Please set a number to the PUB_RETRY_* variables")
+PUB_RETRY_BASE_DELAY_MS = int(PUB_RETRY_BASE_DELAY_MS)
+PUB_RETRY_MAX_DELAY_MS = int(PUB_RETRY_MAX_DELAY_MS)
+PUB_RETRY_MAX_ATTEMPTS = int(PUB_RETRY_MAX_ATTEMPTS)
+PUB_RETRY_MAX_BUFFERED_BYTES = int(PUB_RETRY_MAX_BUFFERED_BYTES)
+
 # Fetch NSQD addres
 NSQD_TCP_ADDRESSES = os.environ.get('NSQD_TCP_ADDRESSES', "").split(",")
 if "" in NSQD_TCP_ADDRESSES:
@@ -20,89 +53,397 @@ if len(NSQD_TCP_ADDRESSES) == 0:
     raise EnvironmentError("Please set a number to the NSQD_TCP_ADDRESSES")
 
 
+def _payload_size(payload):
+    if isinstance(payload, list):
+        return sum(len(m) for m in payload)
+    return len(payload)
+
+
+class _InvalidPayloadError(protocol.SendError):
+    """A publish command couldn't be built from the payload (e.g. it isn't bytes), retrying it won't help
+    """
+    pass
+
+
+class FailoverWriter(nsq.Writer):
+    """``nsq.Writer`` which can publish while avoiding a given connection, used to retry failed publishes on
+    another nsqd
+    """
+
+    def publish(self, topic, payload, delay_ms=None, callback=None, avoid=None):
+        """Publish a message (pub / dpub) or a list of messages (mpub) on a random open connection, other than the
+        connection with id `avoid` unless it is the only one open
+        """
+        open_connections = [conn for conn in self.conns.values() if conn.connected()]
+        preferred = [conn for conn in open_connections if conn.id != avoid]
+        if not open_connections:
+            callback(None, protocol.SendError('no open connections'))
+            return
+
+        conn = random.choice(preferred or open_connections)
+        command = 'mpub' if isinstance(payload, list) else 'dpub' if delay_ms is not None else 'pub'
+        try:
+            if command == 'mpub':
+                cmd = protocol.mpub(topic, payload)
+            elif command == 'dpub':
+                cmd = protocol.dpub(topic, delay_ms, payload)
+            else:
+                cmd = protocol.pub(topic, payload)
+        except Exception as e:
+            # an invalid payload (e.g. not bytes) fails this publish only, the connection is fine
+            logging.exception('[%s] failed to build %s' % (conn.id, command))
+            callback(None, _InvalidPayloadError('invalid %s' % command, e))
+            return
+
+        try:
+            conn.send(cmd)
+        except Exception:
+            logging.exception('[%s] failed to send %s' % (conn.id, command))
+            callback(None, protocol.SendError('send error'))
+            conn.close()
+            return
+        # the responses of a connection come in the order of its commands
+        conn.callback_queue.append(callback)
+
+
+def _resolve_future(future, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(None)
+
+
+class _DeliveryCountDown(object):
+    """Calls `on_delivery` once `count` messages were delivered
+    """
+
+    def __init__(self, count, on_delivery):
+        self.count = count
+        self.on_delivery = on_delivery
+
+    def __call__(self, error):
+        self.count -= 1
+        if self.count == 0:
+            self.on_delivery(error)
+
+
 class NSQWriter(object):
-    def __init__(self):
+    def __init__(self, batch_linger_ms=PUB_BATCH_LINGER_MS, batch_max_count=PUB_BATCH_MAX_COUNT,
+                 batch_max_bytes=BYTES_MAX_SIZE, outbox_dir=OUTBOX_DIR):
+        """
+        ``batch_linger_ms`` - when set, ``send_message`` calls without delay are buffered per topic for up to
+                              this long and published together with one ``mpub``
+        ``batch_max_count``, ``batch_max_bytes`` - a batch is published as soon as it reaches these limits
+        ``outbox_dir`` - when set, messages are spooled to disk under this directory before being published, a failed
+                         publish is retried from disk by a background drainer, which also publishes the messages left
+                         there by a previous run
+        """
         self.logger = self.__class__.get_logger()
         self.writer = self.get_writer()
         self.io_loop = ioloop.IOLoop.current()
 
+        self._retry_buffered_bytes = 0
+
+        # publishes waiting to be handed to the IOLoop, drained by a single callback
+        self._publish_lock = threading.Lock()
+        self._publish_queue = deque()
+        self._publish_scheduled = False
+
+        self._batcher = None
+        if batch_linger_ms:
+            self._batcher = PublishBatcher(self._publish_batch, self.io_loop, batch_linger_ms, batch_max_count,
+                                           batch_max_bytes, self.logger)
+
+        self._outbox = None
+        if outbox_dir:
+            self._outbox = Outbox(outbox_dir, logger=self.logger)
+            self._outbox_callbacks = {}
+            # record id to the failed publish attempts of the spooled messages waiting for a retry
+            self._outbox_attempts = {}
+            self._outbox_draining = 0
+            # the outbox files are read and acknowledged off the IOLoop, by a single thread, one read at a time
+            self._outbox_io = ThreadPoolExecutor(1, thread_name_prefix="outbox")
+            self._outbox_reading = False
+            self._outbox_drainer = ioloop.PeriodicCallback(self._drain_outbox, OUTBOX_DRAIN_INTERVAL_MS)
+            self._outbox_drainer.start()
+
     def get_writer(self):
         if len(NSQD_TCP_ADDRESSES) == 0:
             self.logger.warning("Writer functionality is DISABLED. To enable it please provide NSQD_TCP_ADDRESSES.")
             return None
 
-        return nsq.Writer(nsqd_tcp_addresses=NSQD_TCP_ADDRESSES)
+        return FailoverWriter(nsqd_tcp_addresses=NSQD_TCP_ADDRESSES)
 
     @classmethod
     def get_logger(cls, name=None):
         logger = logging.getLogger(name or cls.__name__)
         if not logger.handlers:
-            formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-
-            handler = logging.StreamHandler(stream=sys.stdout)
-            handler.setFormatter(formatter)
-            handler.setLevel(logging.INFO)
-
-            logger.addHandler(handler)
+            logger.addHandler(stream_handler("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
             logger.setLevel(logging.INFO)
             logger.propagate = 0
 
         return logger
 
-    def send_message(self, topic, message, delay=None):
+    def send_message(self, topic, message, delay=None, on_delivery=None):
         """ A wrapper around io_loop.add_callback and writer.pub for sending a message
 
         :type topic: str
         :type message: str
         :type delay: int
+        :param on_delivery: optional callable, called on the IOLoop with None once nsqd acknowledged the message,
+                            or with a ``PublishError`` if the message was dropped
         """
         if self.writer is None:
             raise RuntimeError("Please provide an nsq.Writer object in order to send messages.")
 
-        callback = functools.partial(self.finish_pub, topic=topic, payload=message)
-
         bytes_size = len(message)
         if bytes_size > BYTES_MAX_SIZE:
             raise ValueError("Message is too big. message={} in topic={}".format(message, topic))
 
-        self.logger.info("Sending message using send_message")
+        self.logger.debug("Sending message using send_message")
 
-        if delay is not None:
-            self.io_loop.add_callback(self.writer.dpub, topic, delay, message, callback)
-        else:
-            self.io_loop.add_callback(self.writer.pub, topic, message, callback)
+        if self._outbox is not None:
+            on_delivery = self._spool(topic, message, delay, on_delivery)
+
+        self._schedule_pub(topic, message, delay, [on_delivery])
 
-    def send_messages(self, topic, messages):
+    def send_messages(self, topic, messages, on_delivery=None):
         """ A wrapper around io_loop.add_callback and writer.mpub for sending multiple messages at once
 
         :type topic: str
         :type messages: list[str]
+        :param on_delivery: optional callable, called on the IOLoop with None once nsqd acknowledged the messages,
+                            or with a ``PublishError`` if the messages were dropped
         """
         if self.writer is None:
             raise RuntimeError("Please provide an nsq.Writer object in order to send messages.")
 
-        self.logger.info("Sending message using send_messages")
-        callback = functools.partial(self.finish_pub, topic=topic, payload=messages)
-        self.io_loop.add_callback(self.writer.mpub, topic, messages, callback)
+        self.logger.debug("Sending message using send_messages")
+
+        callbacks = [on_delivery]
+        if self._outbox is not None:
+            on_delivery = _DeliveryCountDown(len(messages), on_delivery) if on_delivery is not None else None
+            callbacks = [self._spool(topic, m, None, on_delivery) for m in messages]
+
+        self._schedule_pub(topic, messages, None, callbacks)
+
+    def publish(self, topic, message, delay=None):
+        """ Publish a message, can be called from any thread
+
+        :type topic: str
+        :type message: str
+        :type delay: int
+        :return: a ``concurrent.futures.Future`` resolved once nsqd acknowledged the message, or failed with a
+                 ``PublishError`` if the message was dropped
+        :rtype: concurrent.futures.Future
+        """
+        future = futures.Future()
+        self.send_message(topic, message, delay=delay, on_delivery=functools.partial(_resolve_future, future))
+        return future
+
+    def publish_async(self, topic, message, delay=None):
+        """ Same as ``publish`` for coroutines running on the writer IOLoop, returns an awaitable tornado Future
+
+        :rtype: tornado.concurrent.Future
+        """
+        future = Future()
+        self.send_message(topic, message, delay=delay, on_delivery=functools.partial(_resolve_future, future))
+        return future
+
+    def _schedule_pub(self, topic, payload, delay, callbacks):
+        """Hand a publish to the IOLoop, publishes scheduled before the IOLoop got to them share a single callback
+        """
+        with self._publish_lock:
+            self._publish_queue.append((topic, payload, delay, callbacks))
+            if self._publish_scheduled:
+                return
+            self._publish_scheduled = True
+
+        self.io_loop.add_callback(self._flush_publish_queue)
+
+    def _flush_publish_queue(self):
+        with self._publish_lock:
+            queue, self._publish_queue = self._publish_queue, deque()
+            self._publish_scheduled = False
+
+        for topic, payload, delay, callbacks in queue:
+            # a failing publish doesn't stop the ones queued after it, its callbacks get the error
+            try:
+                if delay is None and self._batcher is not None and not isinstance(payload, list):
+                    self._batcher.add(topic, payload, callbacks[0])
+                else:
+                    self._pub(topic, payload, delay, callbacks)
+            except Exception as e:
+                self.logger.exception("Publishing to topic {} failed".format(topic))
+                self._notify_delivery(callbacks, PublishError("Publish to topic {} failed: {}".format(topic, e)))
+
+    def _spool(self, topic, message, delay, on_delivery):
+        """Write a message to the outbox, returns the delivery callback acknowledging it
+        """
+        record_id = self._outbox.append(topic, message, delay)
+        return functools.partial(self._spooled_delivered, record_id, topic, message, on_delivery)
+
+    def _spooled_delivered(self, record_id, topic, payload, on_delivery, error):
+        on_delivery = self._outbox_callbacks.pop(record_id, on_delivery)
+        if error is None:
+            self._outbox_attempts.pop(record_id, None)
+            self._outbox_io.submit(self._ack_spooled, record_id)
+            if on_delivery is not None:
+                on_delivery(None)
+            return
+
+        attempt = self._outbox_attempts.pop(record_id, 0) + 1
+        if PUB_RETRY_MAX_ATTEMPTS and attempt >= PUB_RETRY_MAX_ATTEMPTS:
+            # acknowledged so the drainer doesn't publish it again
+            self._outbox_io.submit(self._ack_spooled, record_id)
+            self._drop_pub(topic, payload, [on_delivery], PublishError(
+                "Publish to topic {} failed {} times, last error: {}".format(topic, attempt, error)))
+            return
+
+        # the message stays in the outbox, the drainer publishes it again once it is released after the backoff
+        self._outbox_attempts[record_id] = attempt
+        if on_delivery is not None:
+            self._outbox_callbacks[record_id] = on_delivery
+        self.io_loop.call_later(self.retry_delay(attempt), self._outbox.release, record_id)
+
+    def _ack_spooled(self, record_id):
+        try:
+            self._outbox.ack(record_id)
+        except Exception:
+            self.logger.exception("Acknowledging outbox record {} failed".format(record_id))
+
+    def _drain_outbox(self):
+        """Publish the outbox messages which are not acknowledged nor being published
+        """
+        limit = OUTBOX_DRAIN_BATCH - self._outbox_draining
+        if self.writer is None or self._outbox_reading or limit <= 0:
+            return
+
+        self._outbox_reading = True
+        self.io_loop.add_future(self._outbox_io.submit(self._outbox.pending, limit), self._publish_pending)
+
+    def _publish_pending(self, future):
+        self._outbox_reading = False
+        try:
+            records = future.result()
+        except Exception:
+            self.logger.exception("Reading the outbox failed")
+            return
+
+        for record_id, topic, payload, delay in records:
+            self._outbox_draining += 1
+            self._pub(topic, payload, delay, [functools.partial(self._outbox_drained, record_id, topic, payload)])
+
+    def _outbox_drained(self, record_id, topic, payload, error):
+        self._outbox_draining -= 1
+        self._spooled_delivered(record_id, topic, payload, None, error)
+
+    def _publish_batch(self, topic, messages, callbacks):
+        self._pub(topic, messages, None, callbacks)
+
+    def _pub(self, topic, payload, delay, callbacks, attempt=1, avoid=None):
+        """Publish a message (pub / dpub) or a list of messages (mpub), must be called on the IOLoop
 
-    def finish_pub(self, conn, data, topic, payload):
+        `attempt` counts the publish attempts of the payload, `avoid` is the id of the connection the previous attempt
+        failed on
+        """
+        callback = functools.partial(self.finish_pub, topic=topic, payload=payload, delay=delay, callbacks=callbacks,
+                                     attempt=attempt)
+
+        if isinstance(self.writer, FailoverWriter):
+            self.writer.publish(topic, payload, delay_ms=delay, callback=callback, avoid=avoid)
+        elif isinstance(payload, list):
+            self.writer.mpub(topic, payload, callback)
+        elif delay is not None:
+            self.writer.dpub(topic, delay, payload, callback)
+        else:
+            self.writer.pub(topic, payload, callback)
+
+    def _retry_pub(self, topic, payload, delay, callbacks, attempt, avoid):
+        self._retry_buffered_bytes -= _payload_size(payload)
+        self._pub(topic, payload, delay, callbacks, attempt=attempt, avoid=avoid)
+
+    @staticmethod
+    def retry_delay(attempt):
+        """Backoff before the retry following publish attempt number `attempt`, in seconds
+
+        Exponential from PUB_RETRY_BASE_DELAY_MS up to PUB_RETRY_MAX_DELAY_MS, half of it randomized
+        """
+        backoff = min(PUB_RETRY_MAX_DELAY_MS, PUB_RETRY_BASE_DELAY_MS * 2 ** min(attempt - 1, 32))
+        return (backoff / 2.0 + random.uniform(0, backoff / 2.0)) / 1000.0
+
+    def finish_pub(self, conn, data, topic, payload, delay=None, callbacks=None, attempt=1):
         """
         This method should serve as a callback to the publish/multi-publish method
         It should parse the arguments to decide if the publish was successful or not
-        If the publish was not successful, after a pre-defined sleep period, try and resend the message/multi-message
+        If the publish was not successful, after a backoff period, try and resend the message/multi-message on another
+        connection. The payload is dropped once PUB_RETRY_MAX_ATTEMPTS or PUB_RETRY_MAX_BUFFERED_BYTES is reached.
         """
-        delay = 1
-
         # Parse conn and data to decide whether message failed or not
         if isinstance(data, Error) or conn is None or (data != b'OK' and data != 'OK'):
-            # Message failed, re-send
-            self.logger.error('[connection=%s] failed to PUBLISH [topic=%s], [data=%s]', conn.id if conn else 'NA',
-                              topic, data)
-            self.logger.error("Message failed, waiting {} seconds before trying again..".format(delay))
-            # Take a short break and then try to resend the message
-            if isinstance(payload, str):
-                self.io_loop.call_later(delay, self.send_message, topic, payload)
-            elif isinstance(payload, list):
-                self.io_loop.call_later(delay, self.send_messages, topic, payload)
+            conn_id = conn.id if conn else None
+            self.logger.error('[connection=%s] failed to PUBLISH [topic=%s], [data=%s], [attempt=%s]',
+                              conn_id or 'NA', topic, data, attempt)
+
+            if self._outbox is not None:
+                # spooled messages are retried by the outbox drainer with the same backoff and attempts limit, the
+                # payloads aren't kept in memory meanwhile
+                self._notify_delivery(callbacks, PublishError("Publish to topic {} failed: {}".format(topic, data)))
+                return
+
+            if isinstance(data, _InvalidPayloadError):
+                self._drop_pub(topic, payload, callbacks, PublishError(
+                    "Publish to topic {} failed: {}".format(topic, data)))
+                return
+            size = _payload_size(payload)
+            if PUB_RETRY_MAX_ATTEMPTS and attempt >= PUB_RETRY_MAX_ATTEMPTS:
+                self._drop_pub(topic, payload, callbacks, PublishError(
+                    "Publish to topic {} failed {} times, last error: {}".format(topic, attempt, data)))
+                return
+            if self._retry_buffered_bytes + size > PUB_RETRY_MAX_BUFFERED_BYTES:
+                self._drop_pub(topic, payload, callbacks, PublishError(
+                    "Publish retry buffer is full ({} bytes), last error: {}".format(self._retry_buffered_bytes, data)))
+                return
+
+            retry_delay = self.retry_delay(attempt)
+            self.logger.error("Message failed, waiting {:.2f} seconds before trying again..".format(retry_delay))
+            # Take a break and then try to resend the message
+            self._retry_buffered_bytes += size
+            self.io_loop.call_later(retry_delay, self._retry_pub, topic, payload, delay, callbacks, attempt + 1,
+                                    conn_id)
         else:
-            self.logger.debug("Sent message {}.".format(payload))
+            self.logger.debug("Sent message %s.", payload)
+            self._notify_delivery(callbacks, None)
+
+    def _drop_pub(self, topic, payload, callbacks, error):
+        self.logger.error("Dropping message(s) to topic {}: {}".format(topic, error))
+        try:
+            self.on_publish_dropped(topic, payload, error)
+        except Exception:
+            self.logger.exception("on_publish_dropped failed")
+        self._notify_delivery(callbacks, error)
+
+    def on_publish_dropped(self, topic, payload, error):
+        """
+        Called when a message (or a list of messages) is given up on, override to count or store dropped messages
+        :type topic: str
+        :type error: PublishError
+        """
+        pass
+
+    @property
+    def retry_buffered_bytes(self):
+        """Size of the payloads currently waiting for a publish retry
+        """
+        return self._retry_buffered_bytes
+
+    def _notify_delivery(self, callbacks, error):
+        for callback in callbacks or ():
+            if callback is None:
+                continue
+            try:
+                callback(error)
+            except Exception:
+                self.logger.exception("Delivery callback failed")
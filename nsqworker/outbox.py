@@ -0,0 +1,289 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+
+# Disk-backed outbox of NSQWriter: messages are spooled under OUTBOX_DIR before being published and removed once
+# nsqd acknowledged them, unacknowledged messages are published again by a background drainer (and on startup)
+OUTBOX_DIR = os.environ.get('OUTBOX_DIR', "")
+OUTBOX_SEGMENT_BYTES = os.environ.get('OUTBOX_SEGMENT_BYTES', str(64 * 1024 * 1024))
+OUTBOX_DRAIN_INTERVAL_MS = os.environ.get('OUTBOX_DRAIN_INTERVAL_MS', '1000')
+OUTBOX_DRAIN_BATCH = os.environ.get('OUTBOX_DRAIN_BATCH', '100')
+if not all(v.isdigit() for v in (OUTBOX_SEGMENT_BYTES, OUTBOX_DRAIN_INTERVAL_MS, OUTBOX_DRAIN_BATCH)):
+    raise EnvironmentError("Please set a number to the OUTBOX_* variables")
+OUTBOX_SEGMENT_BYTES = int(OUTBOX_SEGMENT_BYTES)
+OUTBOX_DRAIN_INTERVAL_MS = int(OUTBOX_DRAIN_INTERVAL_MS)
+OUTBOX_DRAIN_BATCH = int(OUTBOX_DRAIN_BATCH)
+
+# payload size, crc32 of topic + payload, dpub delay (-1 for none), topic size
+_RECORD_HEADER = struct.Struct(">IIqH")
+_ACK = struct.Struct(">Q")
+_NO_DELAY = -1
+
+
+def _to_bytes(data):
+    return data if isinstance(data, bytes) else data.encode("utf-8")
+
+
+class _Segment(object):
+    def __init__(self, directory, seq):
+        self.seq = seq
+        self.path = os.path.join(directory, "{:020d}.log".format(seq))
+        self.ack_path = os.path.join(directory, "{:020d}.ack".format(seq))
+        self.count = 0
+        self.size = 0
+        self.acked_count = 0
+        # every record before this offset is acknowledged
+        self.acked_below = 0
+        # offset to end offset of the records acknowledged after acked_below, only the acks out of order are kept
+        self.acked_ends = {}
+        self.in_flight = 0
+        # every record before this offset is acknowledged or in flight
+        self.scan_from = 0
+        self.sealed = False
+        self.log_file = None
+        self.ack_file = None
+
+    def records(self, start=0):
+        """Iterate over the (offset, topic, payload, delay) of the complete records of the segment from offset
+        `start`, stops at the first incomplete or corrupted record
+        """
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(_RECORD_HEADER.size)
+                if len(header) < _RECORD_HEADER.size:
+                    return
+                payload_size, crc, delay, topic_size = _RECORD_HEADER.unpack(header)
+                topic = f.read(topic_size)
+                payload = f.read(payload_size)
+                if len(topic) < topic_size or len(payload) < payload_size or zlib.crc32(topic + payload) != crc:
+                    return
+
+                yield offset, topic.decode("utf-8"), payload, (None if delay == _NO_DELAY else delay)
+                offset += _RECORD_HEADER.size + topic_size + payload_size
+
+    def is_acked(self, offset):
+        return offset < self.acked_below or offset in self.acked_ends
+
+    def mark_acked(self, offset, end):
+        self.acked_count += 1
+        if offset != self.acked_below:
+            self.acked_ends[offset] = end
+            return
+        self.acked_below = end
+        while self.acked_below in self.acked_ends:
+            self.acked_below = self.acked_ends.pop(self.acked_below)
+
+    @property
+    def fully_acked(self):
+        return self.acked_count >= self.count
+
+    def scan(self):
+        """Count the complete and acknowledged records and truncate what follows them (a record partially written by
+        a crash)
+        """
+        acked = set()
+        if os.path.exists(self.ack_path):
+            with open(self.ack_path, "rb") as f:
+                data = f.read()
+            acked = set(_ACK.unpack_from(data, i)[0] for i in range(0, len(data) - _ACK.size + 1, _ACK.size))
+
+        self.count = 0
+        end = 0
+        for offset, topic, payload, _ in self.records():
+            self.count += 1
+            end = offset + _RECORD_HEADER.size + len(_to_bytes(topic)) + len(payload)
+            if offset in acked:
+                self.mark_acked(offset, end)
+
+        self.size = end
+        if os.path.getsize(self.path) > end:
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+
+    def close(self):
+        for f in (self.log_file, self.ack_file):
+            if f is not None:
+                f.close()
+        self.log_file = self.ack_file = None
+
+    def delete(self):
+        self.close()
+        for path in (self.path, self.ack_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class Outbox(object):
+    """Append-only, segment based local spool of the messages waiting to be published
+
+    Records are appended to the current segment file, acknowledgements to a matching ``.ack`` file, a segment is
+    deleted once it is full and all its records were acknowledged. Only record counters and the offsets of the
+    records acknowledged out of order are kept in memory, payloads are read back from disk when they have to be
+    published again. Thread safe.
+    A record id is a (segment sequence, offset, end offset) tuple.
+    """
+
+    def __init__(self, directory, segment_bytes=OUTBOX_SEGMENT_BYTES, fsync=False, logger=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.logger = logger or logging.getLogger("Outbox")
+        self._lock = threading.Lock()
+        self._segments = {}
+        self._in_flight = set()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._load()
+        self._current = self._new_segment()
+
+    def _load(self):
+        """Load the segments left by a previous run, they are sealed and drained before being deleted
+        """
+        seqs = sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".log"))
+        for seq in seqs:
+            segment = _Segment(self.directory, seq)
+            segment.sealed = True
+            segment.scan()
+
+            if segment.fully_acked:
+                segment.delete()
+            else:
+                self._segments[seq] = segment
+                self.logger.info("Outbox segment {} has {} messages to publish".format(
+                    seq, segment.count - segment.acked_count))
+
+    def _new_segment(self):
+        seq = max(self._segments) + 1 if self._segments else 0
+        segment = _Segment(self.directory, seq)
+        segment.log_file = open(segment.path, "ab")
+        self._segments[seq] = segment
+        return segment
+
+    def append(self, topic, payload, delay=None):
+        """Spool a message, the record is considered in flight until it is acknowledged or released
+
+        :return: the record id
+        """
+        topic = _to_bytes(topic)
+        payload = _to_bytes(payload)
+        header = _RECORD_HEADER.pack(len(payload), zlib.crc32(topic + payload),
+                                     _NO_DELAY if delay is None else delay, len(topic))
+
+        with self._lock:
+            segment = self._current
+            if segment.size >= self.segment_bytes:
+                self._seal(segment)
+                segment = self._current = self._new_segment()
+
+            offset = segment.size
+            segment.log_file.write(header + topic + payload)
+            segment.log_file.flush()
+            if self.fsync:
+                os.fsync(segment.log_file.fileno())
+            segment.size += len(header) + len(topic) + len(payload)
+            segment.count += 1
+
+            record_id = (segment.seq, offset, segment.size)
+            self._in_flight.add(record_id)
+            segment.in_flight += 1
+
+        return record_id
+
+    def _discard_in_flight(self, record_id, segment):
+        if record_id in self._in_flight:
+            self._in_flight.discard(record_id)
+            if segment is not None:
+                segment.in_flight -= 1
+
+    def ack(self, record_id):
+        """Mark a record as published, writes to the ``.ack`` file so it shouldn't be called from the IOLoop
+        """
+        seq, offset, end = record_id
+        with self._lock:
+            segment = self._segments.get(seq)
+            self._discard_in_flight(record_id, segment)
+            if segment is None or segment.is_acked(offset):
+                return
+
+            segment.mark_acked(offset, end)
+            if segment.sealed and segment.fully_acked:
+                del self._segments[seq]
+                segment.delete()
+                return
+
+            if segment.ack_file is None:
+                segment.ack_file = open(segment.ack_path, "ab")
+            segment.ack_file.write(_ACK.pack(offset))
+            segment.ack_file.flush()
+
+    def release(self, record_id):
+        """The publish of a record failed, the record is returned by ``pending`` again
+        """
+        seq, offset, _ = record_id
+        with self._lock:
+            segment = self._segments.get(seq)
+            self._discard_in_flight(record_id, segment)
+            if segment is not None:
+                segment.scan_from = min(segment.scan_from, offset)
+
+    def _seal(self, segment):
+        segment.sealed = True
+        if segment.log_file is not None:
+            segment.log_file.close()
+            segment.log_file = None
+        if segment.fully_acked:
+            del self._segments[segment.seq]
+            segment.delete()
+
+    def pending(self, limit):
+        """Returns up to `limit` unacknowledged records which are not in flight, oldest first, and marks them in flight
+
+        Reads the segment files from the first record which may be pending, it shouldn't be called from the IOLoop.
+        :rtype: list[((int, int, int), str, bytes, int)]
+        """
+        with self._lock:
+            segments = sorted((s for s in self._segments.values() if s.count - s.acked_count - s.in_flight > 0),
+                              key=lambda s: s.seq)
+
+        records = []
+        for segment in segments:
+            if len(records) >= limit:
+                break
+
+            scan_start = scan_end = segment.scan_from
+            for offset, topic, payload, delay in segment.records(scan_start):
+                scan_end = offset + _RECORD_HEADER.size + len(_to_bytes(topic)) + len(payload)
+                record_id = (segment.seq, offset, scan_end)
+                with self._lock:
+                    if segment.is_acked(offset) or record_id in self._in_flight:
+                        continue
+                    self._in_flight.add(record_id)
+                    segment.in_flight += 1
+                records.append((record_id, topic, payload, delay))
+                if len(records) >= limit:
+                    break
+
+            with self._lock:
+                # unless a record before scan_end was released meanwhile
+                if segment.scan_from == scan_start:
+                    segment.scan_from = scan_end
+
+        return records
+
+    @property
+    def backlog(self):
+        """Number of spooled messages not acknowledged yet
+        """
+        with self._lock:
+            return sum(s.count - s.acked_count for s in self._segments.values())
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                segment.close()
@@ -0,0 +1,76 @@
+import json
+
+import mdict
+
+_MISSING = object()
+
+
+class ParsedMessage(object):
+    """Lazily decoded view over an NSQ message body
+
+    The body is decoded at most once, on first access, and the same object is shared by the matchers,
+    the lock wrapper, the persistor and the handlers of a message.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self._json = _MISSING
+        self._mdict = _MISSING
+
+    @property
+    def json(self):
+        """The decoded JSON body, None if the body is not valid JSON
+        """
+        if self._json is _MISSING:
+            try:
+                self._json = json.loads(self.body)
+            except (ValueError, TypeError):
+                self._json = None
+
+        return self._json
+
+    @property
+    def mdict(self):
+        """The decoded JSON body wrapped with ``mdict.MDict``, None if the body is not valid JSON
+        """
+        if self._mdict is _MISSING:
+            self._mdict = None
+            if self.json is not None:
+                try:
+                    self._mdict = mdict.MDict(self.json)
+                except (ValueError, TypeError):
+                    pass
+
+        return self._mdict
+
+    @property
+    def is_json(self):
+        return self.json is not None
+
+    @property
+    def name(self):
+        """The event name, None for non JSON messages or messages without a name
+        """
+        return self.get("name")
+
+    def get(self, field, default=None):
+        """Get a (possibly nested) field of the JSON body, see ``mdict.MDict.get``
+        """
+        if self.mdict is None:
+            return default
+
+        return self.mdict.get(field, default=default)
+
+
+def parse_message(message):
+    """Returns the ParsedMessage of an nsq.Message, creating and caching it on the message on first use
+
+    :type message: nsq.Message
+    :rtype: ParsedMessage
+    """
+    parsed = getattr(message, "parsed", None)
+    if parsed is None:
+        parsed = ParsedMessage(message.body)
+        message.parsed = parsed
+
+    return parsed
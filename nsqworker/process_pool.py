@@ -0,0 +1,295 @@
+import logging
+import multiprocessing
+import pickle
+import signal
+
+from tornado import gen, ioloop, queues
+from tornado.concurrent import Future
+
+from .timing import MessageTimings
+
+try:
+    from errors import TimeoutError
+except ModuleNotFoundError:
+    from nsqworker.errors import TimeoutError
+
+
+class ProcessDiedError(Exception):
+    pass
+
+
+class RemoteHandlerError(Exception):
+    """Raised in place of a handler exception which can't be sent back from the pool process
+    """
+    pass
+
+
+class ProcessMessage(object):
+    """Stand-in for ``nsq.Message`` inside a pool process
+
+    ``finish``/``requeue`` calls are recorded and applied to the real message on the IOLoop of the parent
+    process, touches are sent by the parent while the handler runs.
+    """
+
+    def __init__(self, id, body, attempts, timestamp):
+        self.id = id
+        self.body = body
+        self.attempts = attempts
+        self.timestamp = timestamp
+        self.response = None
+        # see ``nsqworker.adaptive.WorkerStats.route_failed``
+        self.failed_routes = 0
+        # the handler start and lock time, sent back to the timings of the message in the parent
+        self.timings = MessageTimings(timestamp)
+
+    def enable_async(self):
+        pass
+
+    def is_async(self):
+        return True
+
+    def has_responded(self):
+        return self.response is not None
+
+    def finish(self):
+        assert not self.has_responded()
+        self.response = ("finish", {})
+
+    def requeue(self, **kwargs):
+        assert not self.has_responded()
+        self.response = ("requeue", kwargs)
+
+    def touch(self):
+        pass
+
+
+class ProcessResult(object):
+    def __init__(self, error, response, published, failed_routes=0, started=None, lock_ms=0.0):
+        """
+        ``started`` - the ``time.monotonic`` stamp of the handler start in the pool process
+        ``lock_ms`` - the time the routes spent acquiring and releasing their locks
+        """
+        self.error = error
+        self.response = response
+        self.published = published
+        self.failed_routes = failed_routes
+        self.started = started
+        self.lock_ms = lock_ms
+
+
+class PublishRelay(object):
+    """Records the publishes of an ``NSQWriter`` running inside a pool process
+
+    Installed in place of the writer (and of its IOLoop, which doesn't run in the pool process), the recorded
+    publishes are sent back with the handler result and published by the parent process.
+    """
+
+    def __init__(self):
+        self.published = []
+
+    def add_callback(self, callback, *args, **kwargs):
+        callback(*args, **kwargs)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        pass
+
+    def pub(self, topic, message, callback=None):
+        self.published.append((topic, message, None))
+
+    def dpub(self, topic, delay, message, callback=None):
+        self.published.append((topic, message, delay))
+
+    def mpub(self, topic, messages, callback=None):
+        self.published.append((topic, messages, None))
+
+    def drain(self):
+        published, self.published = self.published, []
+        return published
+
+
+def _picklable_error(e):
+    try:
+        pickle.dumps(e)
+        return e
+    except Exception:
+        return RemoteHandlerError(repr(e))
+
+
+def _process_main(conn, message_handler, on_fork):
+    """Pool process loop, runs the message handler for every message sent by the parent
+    """
+    # the parent process handles the signals and terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    relay = PublishRelay()
+    if on_fork is not None:
+        on_fork(relay)
+
+    while True:
+        try:
+            header = conn.recv()
+            if header is None:
+                return
+            body = conn.recv_bytes()
+        except (EOFError, OSError):
+            return
+
+        message = ProcessMessage(body=body, **header)
+        error = None
+        message.timings.start()
+        try:
+            message_handler(message)
+        except Exception as e:
+            error = _picklable_error(e)
+
+        conn.send(ProcessResult(error, message.response, relay.drain(), message.failed_routes,
+                                message.timings.started, message.timings.lock_ms))
+
+
+class _PoolProcess(object):
+    def __init__(self, context, message_handler, on_fork, io_loop):
+        self.io_loop = io_loop
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_process_main, args=(child_conn, message_handler, on_fork))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+        self.future = None
+        self.io_loop.add_handler(self.conn.fileno(), self._on_readable, ioloop.IOLoop.READ)
+
+    def run(self, message):
+        self.future = Future()
+        header = dict(id=message.id, attempts=message.attempts, timestamp=message.timestamp)
+        try:
+            self.conn.send(header)
+            # the body is sent as is, without pickling
+            self.conn.send_bytes(message.body if isinstance(message.body, bytes) else message.body.encode())
+        except (OSError, ValueError) as e:
+            self._resolve(exception=ProcessDiedError("Failed sending message to pool process: {}".format(e)))
+
+        return self.future
+
+    def _on_readable(self, fd, events):
+        try:
+            result = self.conn.recv()
+        except (EOFError, OSError):
+            self.io_loop.remove_handler(self.conn.fileno())
+            self._resolve(exception=ProcessDiedError(
+                "Pool process {} exited with code {}".format(self.process.pid, self.process.exitcode)))
+            return
+
+        self._resolve(result=result)
+
+    def _resolve(self, result=None, exception=None):
+        future, self.future = self.future, None
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        try:
+            self.io_loop.remove_handler(self.conn.fileno())
+        except (KeyError, ValueError, OSError):
+            pass
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join(1)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.kill()
+
+
+class ProcessPool(object):
+    """A pool of forked processes running a message handler
+
+    A process whose handler exceeds the timeout is killed and replaced by a new one.
+    Results, exceptions and the responses recorded by the handler come back to the IOLoop.
+    """
+
+    def __init__(self, message_handler, size, io_loop=None, on_fork=None, logger=None, timers=None):
+        """
+        ``timers`` - optional ``TimerWheel`` scheduling the handler timeouts, IOLoop timeouts are used otherwise
+        """
+        self.message_handler = message_handler
+        self.size = size
+        self.on_fork = on_fork
+        self.io_loop = io_loop or ioloop.IOLoop.current()
+        self.logger = logger or logging.getLogger("ProcessPool")
+        self.timers = timers
+        self._context = multiprocessing.get_context("fork")
+        self._idle = queues.Queue()
+        self._processes = set()
+        # messages waiting for an idle process
+        self.waiting = 0
+
+        for _ in range(size):
+            self._idle.put_nowait(self._spawn())
+
+    def _spawn(self):
+        process = _PoolProcess(self._context, self.message_handler, self.on_fork, self.io_loop)
+        self._processes.add(process)
+        return process
+
+    def _replace(self, process):
+        self._processes.discard(process)
+        process.kill()
+        self._idle.put_nowait(self._spawn())
+
+    @gen.coroutine
+    def submit(self, message, timeout=None):
+        """Run the message handler for `message` in an idle pool process
+
+        :rtype: ProcessResult
+        :raise: ``TimeoutError`` if the handler exceeded `timeout` (the process is killed),
+                ``ProcessDiedError`` if the process died while handling the message
+        """
+        self.waiting += 1
+        try:
+            process = yield self._idle.get()
+        finally:
+            self.waiting -= 1
+
+        timeout_handle = None
+        if timeout is not None:
+            def on_timeout():
+                self.logger.error("Pool process {} exceeded timeout {}s on message {}, killing it".format(
+                    process.process.pid, timeout, message.id))
+                process._resolve(exception=TimeoutError(
+                    "Message handler exceeded timeout {}s for message {}".format(timeout, message.id)))
+
+            if self.timers is not None:
+                timeout_handle = self.timers.schedule(timeout * 1000, on_timeout)
+            else:
+                timeout_handle = self.io_loop.call_later(timeout, on_timeout)
+
+        try:
+            result = yield process.run(message)
+        except (TimeoutError, ProcessDiedError):
+            self._replace(process)
+            raise
+        finally:
+            if timeout_handle is not None and self.timers is not None:
+                self.timers.cancel(timeout_handle)
+            elif timeout_handle is not None:
+                self.io_loop.remove_timeout(timeout_handle)
+
+        self._idle.put_nowait(process)
+        raise gen.Return(result)
+
+    def close(self):
+        for process in list(self._processes):
+            process.stop()
+        self._processes.clear()
@@ -0,0 +1,185 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+# Sampling profiler of NSQHandler routes, see ``RouteProfiler``
+# milliseconds between two samples of the threads running a route
+PROFILER_INTERVAL_MS = os.environ.get('PROFILER_INTERVAL_MS', '10')
+# frames kept per sampled stack, the innermost ones
+PROFILER_MAX_DEPTH = os.environ.get('PROFILER_MAX_DEPTH', '64')
+# file the folded stacks are written to on PROFILER_SIGNAL, {pid} is replaced with the process id
+PROFILER_OUTPUT = os.environ.get('PROFILER_OUTPUT', '/tmp/nsqworker-{pid}.folded')
+# name of the signal writing the folded stacks, empty to disable
+PROFILER_SIGNAL = os.environ.get('PROFILER_SIGNAL', 'SIGUSR2')
+if not PROFILER_INTERVAL_MS.isdigit() or int(PROFILER_INTERVAL_MS) < 1:
+    raise EnvironmentError("Please set a positive number to the profiler interval")
+if not PROFILER_MAX_DEPTH.isdigit():
+    raise EnvironmentError("Please set a number to the profiler max depth")
+if PROFILER_SIGNAL and not isinstance(getattr(signal, PROFILER_SIGNAL, None), signal.Signals):
+    raise EnvironmentError("Please set a signal name to PROFILER_SIGNAL")
+PROFILER_INTERVAL_MS = int(PROFILER_INTERVAL_MS)
+PROFILER_MAX_DEPTH = int(PROFILER_MAX_DEPTH)
+
+
+class RouteProfiler(object):
+    """Samples the stacks of the threads running a route handler every ``interval_ms``
+
+    A sample is counted under the route and event the thread is running (see ``tag``), the counts are returned
+    as folded stacks (``route;event;frame;frame... count`` lines, the input of flamegraph.pl or speedscope).
+    Only the tagged threads are walked, idle threads and coroutines waiting on the IOLoop cost nothing.
+    """
+
+    def __init__(self, interval_ms=PROFILER_INTERVAL_MS, max_depth=PROFILER_MAX_DEPTH, output=PROFILER_OUTPUT,
+                 logger=None):
+        self.interval_ms = interval_ms
+        self.max_depth = max_depth
+        self.output = output
+        self.logger = logger or logging.getLogger("RouteProfiler")
+        # thread id to the (route, event) it is running
+        self._tags = {}
+        self._samples = Counter()
+        self._frame_names = {}
+        self._lock = threading.Lock()
+        # set by the signal handler, the sampler thread writes the file
+        self._write_requested = False
+        self._thread = None
+
+    @classmethod
+    def from_env(cls, logger=None):
+        return cls(logger=logger)
+
+    def tag(self, route_name, event_name):
+        """Context manager counting the samples of the calling thread under a route and event
+        """
+        return _Tag(self._tags, route_name, event_name)
+
+    def run_tagged(self, route_name, event_name, fn, *args):
+        with self.tag(route_name, event_name):
+            return fn(*args)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="RouteProfiler")
+        self._thread.daemon = True
+        self._thread.start()
+        self.logger.info("Profiling routes every {}ms".format(self.interval_ms))
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        interval = self.interval_ms / 1000.0
+        thread = threading.current_thread()
+        while self._thread is thread:
+            time.sleep(interval)
+            self.sample()
+            if self._write_requested:
+                self._write_requested = False
+                self._write_requested_profile()
+
+    def sample(self):
+        """Count the current stack of every tagged thread
+        """
+        tags = list(self._tags.items())
+        if not tags:
+            return
+        frames = sys._current_frames()
+        stacks = []
+        for thread_id, (route_name, event_name) in tags:
+            frame = frames.get(thread_id)
+            if frame is not None:
+                stacks.append(self._fold(route_name, event_name, frame))
+
+        with self._lock:
+            self._samples.update(stacks)
+
+    def _fold(self, route_name, event_name, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(self._frame_name(frame.f_code))
+            frame = frame.f_back
+        names.append(event_name)
+        names.append(route_name)
+        return ";".join(reversed(names))
+
+    def _frame_name(self, code):
+        name = self._frame_names.get(code)
+        if name is None:
+            name = self._frame_names[code] = "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+        return name
+
+    def folded(self, reset=False):
+        """Folded stacks of the samples taken since the start (or the last reset)
+
+        :rtype: str
+        """
+        with self._lock:
+            samples = self._samples
+            if reset:
+                self._samples = Counter()
+        return "".join("{} {}\n".format(stack, count) for stack, count in sorted(samples.items()))
+
+    def route_samples(self):
+        """Samples per route, a route's share of the samples is its share of the time the threads spent in routes
+
+        :rtype: dict[str, int]
+        """
+        per_route = Counter()
+        with self._lock:
+            for stack, count in self._samples.items():
+                per_route[stack.split(";", 1)[0]] += count
+        return dict(per_route)
+
+    def write(self, path=None, reset=True):
+        """Write the folded stacks to ``path`` (by default ``output``), returns the path
+        """
+        path = (path or self.output).format(pid=os.getpid())
+        with open(path, "w") as f:
+            f.write(self.folded(reset=reset))
+        self.logger.info("Wrote route profile to {}".format(path))
+        return path
+
+    def install_signal(self, signal_name=PROFILER_SIGNAL):
+        """Write the folded stacks on ``signal_name``, must be called from the main thread
+
+        The file is written by the sampler thread (see ``start``) within ``interval_ms``, the signal handler only
+        requests it: it can interrupt the main thread anywhere, e.g. while it holds a lock or a file open.
+        """
+        if not signal_name:
+            return
+        signal.signal(getattr(signal, signal_name), self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._write_requested = True
+
+    def _write_requested_profile(self):
+        try:
+            self.write()
+        except Exception as e:
+            self.logger.warning("Writing route profile failed with error: {}".format(e))
+
+
+class _Tag(object):
+    __slots__ = ("tags", "tag", "thread_id", "previous")
+
+    def __init__(self, tags, route_name, event_name):
+        self.tags = tags
+        self.tag = (route_name, event_name)
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.previous = self.tags.get(self.thread_id)
+        self.tags[self.thread_id] = self.tag
+
+    def __exit__(self, *exc_info):
+        if self.previous is None:
+            self.tags.pop(self.thread_id, None)
+        else:
+            self.tags[self.thread_id] = self.previous
@@ -0,0 +1,72 @@
+import logging
+
+# MPUB body: message count + (size + body) per message
+MPUB_HEADER_SIZE = 4
+MPUB_MESSAGE_OVERHEAD = 4
+
+
+class _Batch(object):
+    def __init__(self):
+        self.messages = []
+        self.callbacks = []
+        self.size = MPUB_HEADER_SIZE
+        self.timeout = None
+
+
+class PublishBatcher(object):
+    """Coalesces single message publishes into per topic ``mpub`` batches
+
+    A batch is flushed after ``linger_ms`` from its first message, or as soon as adding a message would exceed
+    ``max_count`` messages or ``max_bytes`` of MPUB body. Must be used from the IOLoop thread.
+    """
+
+    def __init__(self, flush, io_loop, linger_ms, max_count, max_bytes, logger=None):
+        """
+        ``flush`` - called with (topic, messages, callbacks) for every batch, ``callbacks`` holds the delivery
+                    callback of each message (or None)
+        """
+        self._flush_batch = flush
+        self.io_loop = io_loop
+        self.linger_ms = linger_ms
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger("PublishBatcher")
+        self._batches = {}
+
+    def add(self, topic, message, callback=None):
+        message_size = len(message) + MPUB_MESSAGE_OVERHEAD
+
+        batch = self._batches.get(topic)
+        if batch is not None and (len(batch.messages) >= self.max_count or
+                                  batch.size + message_size > self.max_bytes):
+            self.flush(topic)
+            batch = None
+
+        if batch is None:
+            batch = _Batch()
+            batch.timeout = self.io_loop.call_later(self.linger_ms / 1000.0, self.flush, topic)
+            self._batches[topic] = batch
+
+        batch.messages.append(message)
+        batch.callbacks.append(callback)
+        batch.size += message_size
+
+        if len(batch.messages) >= self.max_count:
+            self.flush(topic)
+
+    def flush(self, topic):
+        batch = self._batches.pop(topic, None)
+        if batch is None:
+            return
+
+        self.io_loop.remove_timeout(batch.timeout)
+        self.logger.debug("Flushing {} messages ({} bytes) to topic {}".format(len(batch.messages), batch.size, topic))
+        self._flush_batch(topic, batch.messages, batch.callbacks)
+
+    def flush_all(self):
+        for topic in list(self._batches):
+            self.flush(topic)
+
+    @property
+    def pending(self):
+        return sum(len(b.messages) for b in self._batches.values())
@@ -0,0 +1,70 @@
+import json
+import random
+
+# a dpub delay can't exceed the nsqd --max-req-timeout (1 hour by default)
+MAX_RETRY_DELAY_MS = 3600000
+# number of the retry carried by a retry message
+RETRY_ATTEMPT_FIELD = "retry_attempt"
+# number of times a message was deferred because its resource was busy, carried by a deferred message
+CONTENTIONS_FIELD = "contentions"
+
+
+class RetryPolicy(object):
+    """Retries of a failed route, given with ``nsqhandler.route(..., retry_policy=...)``
+
+    A failed route is retried on its own up to ``max_attempts`` times: ``base_delay_ms`` after the first failure,
+    doubled on every retry up to ``max_delay_ms``. With ``jitter`` the delay is picked between half and all of it.
+    """
+
+    def __init__(self, max_attempts=3, base_delay_ms=1000, max_delay_ms=60000, jitter=True):
+        if max_attempts < 0 or base_delay_ms < 0:
+            raise ValueError("max_attempts and base_delay_ms can't be negative")
+        if not 0 < max_delay_ms <= MAX_RETRY_DELAY_MS:
+            raise ValueError("max_delay_ms should be positive and at most {}".format(MAX_RETRY_DELAY_MS))
+
+        self.max_attempts = max_attempts
+        self.base_delay_ms = base_delay_ms
+        self.max_delay_ms = max_delay_ms
+        self.jitter = jitter
+
+    def delay_ms(self, attempt):
+        """Delay before the retry number ``attempt`` (1 for the first retry)
+
+        :rtype: int
+        """
+        delay = min(self.max_delay_ms, self.base_delay_ms * 2 ** min(max(attempt - 1, 0), 32))
+        if self.jitter:
+            delay = random.randint(delay // 2, delay)
+        return int(delay)
+
+
+def retry_attempt(jsn):
+    """Number of the retry carried by a message body, 0 for a message which isn't a retry
+
+    :type jsn: dict
+    """
+    return jsn.get(RETRY_ATTEMPT_FIELD, 0) if jsn is not None else 0
+
+
+def contentions(jsn):
+    """Number of times the message carried by a body was deferred because its resource was busy
+
+    :type jsn: dict
+    """
+    return jsn.get(CONTENTIONS_FIELD, 0) if jsn is not None else 0
+
+
+def retry_body(jsn, channel, route_names, attempt, contentions=None):
+    """Body of the message retrying some routes: the original event, addressed to the routes through the
+    ``recipients`` field of persisted messages (see ``MessagePersistor.is_route_message``)
+
+    :type jsn: dict
+    :type route_names: list[str]
+    :rtype: bytes
+    """
+    body = dict(jsn)
+    body["recipients"] = {channel: list(route_names)}
+    body[RETRY_ATTEMPT_FIELD] = attempt
+    if contentions is not None:
+        body[CONTENTIONS_FIELD] = contentions
+    return json.dumps(body).encode("utf-8")
@@ -0,0 +1,59 @@
+import logging
+
+from tornado import gen
+
+
+class RouteBatcher(object):
+    """Collects the messages of a batch route
+
+    ``run_batch`` is called with the collected items once ``max_size`` items were added, or ``max_wait`` seconds after
+    the first item of a batch, the future given with each item is resolved once ``run_batch`` is done.
+    Must be used from the IOLoop thread.
+    """
+
+    def __init__(self, run_batch, max_size, max_wait, io_loop, logger=None):
+        """
+        ``run_batch`` - called with a list of items, returns a future
+        """
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.io_loop = io_loop
+        self.logger = logger or logging.getLogger("RouteBatcher")
+        self._items = []
+        self._futures = []
+        self._timeout = None
+
+    def add(self, item, future):
+        """
+        :type future: concurrent.futures.Future
+        """
+        self._items.append(item)
+        self._futures.append(future)
+        if len(self._items) == 1:
+            self._timeout = self.io_loop.call_later(self.max_wait, self.flush)
+        if len(self._items) >= self.max_size:
+            self.flush()
+
+    def flush(self):
+        if not self._items:
+            return
+
+        self.io_loop.remove_timeout(self._timeout)
+        items, futures = self._items, self._futures
+        self._items, self._futures, self._timeout = [], [], None
+        self._run(items, futures)
+
+    @gen.coroutine
+    def _run(self, items, futures):
+        try:
+            yield self.run_batch(items)
+        except Exception:
+            self.logger.exception("Running a batch of {} messages failed".format(len(items)))
+        finally:
+            for future in futures:
+                future.set_result(None)
+
+    @property
+    def pending(self):
+        return len(self._items)
@@ -0,0 +1,111 @@
+from .basic_matchers import apply_matcher
+
+
+class Route(object):
+    """A registered (matcher, handler) pair
+
+    ``position`` is the registration order, handlers of a message always run in this order.
+    ``dedup`` - skip the messages already handled by this route (see ``nsqworker.dedup``)
+    ``batch_size`` / ``batch_wait`` - set for batch routes, the handler gets up to ``batch_size`` messages collected
+                                      for at most ``batch_wait`` seconds (see ``nsqhandler.batch_route``)
+    ``retry_policy`` - optional ``nsqworker.retry.RetryPolicy``, a failure is retried for this route only
+    ``sequential`` - never run in parallel with the other routes of a message (see ``NSQHandler(parallel_routes=)``)
+    ``max_concurrency`` / ``pool`` - run on a bulkhead of its own / on a named one (see ``nsqworker.bulkhead``)
+    ``max_waiting`` - the messages waiting for the route's own bulkhead beyond which it is shed
+    ``circuit_breaker`` - optional ``nsqworker.circuit_breaker.CircuitBreakerOptions``
+    """
+
+    def __init__(self, matcher_func, handler_func, is_idempotent, position, dedup=False, batch_size=None,
+                 batch_wait=None, retry_policy=None, sequential=False, max_concurrency=None, max_waiting=None,
+                 pool=None, circuit_breaker=None):
+        self.matcher_func = matcher_func
+        self.handler_func = handler_func
+        self.is_idempotent = is_idempotent
+        self.position = position
+        self.dedup = dedup
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.retry_policy = retry_policy
+        self.sequential = sequential
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.pool = pool
+        self.circuit_breaker = circuit_breaker
+
+    @property
+    def is_batch(self):
+        return self.batch_size is not None
+
+    @property
+    def name(self):
+        return self.handler_func.__name__
+
+
+class RouteTable(object):
+    """Routes of an NSQHandler class, compiled for dispatch
+
+    Matchers exposing an ``index_key = (field, value)`` attribute (see ``basic_matchers.json_matcher``) are put
+    in a hash index keyed on the field value, so they cost a single dict lookup per message no matter how many
+    of them are registered. If the matcher also sets ``index_exact``, an index hit is the match result,
+    otherwise the matcher is still called for the candidates returned by the index.
+    Every other matcher (lambdas, regexes) is kept in a fallback list and called for every message.
+    """
+
+    def __init__(self):
+        self.routes = []
+        self._index = {}
+        self._fallback = []
+
+    def add(self, matcher_func, handler_func, is_idempotent=False, **options):
+        """Register a route, ``options`` are the ``Route`` options
+
+        :rtype: Route
+        """
+        route = Route(matcher_func, handler_func, is_idempotent, len(self.routes), **options)
+        self.routes.append(route)
+
+        index_key = getattr(matcher_func, "index_key", None)
+        if index_key is not None and self._is_hashable(index_key[1]):
+            field, value = index_key
+            self._index.setdefault(field, {}).setdefault(value, []).append(route)
+        else:
+            self._fallback.append(route)
+
+        return route
+
+    def match(self, parsed):
+        """Returns the routes matching a message, in registration order
+
+        :type parsed: nsqworker.parsed_message.ParsedMessage
+        :rtype: list[Route]
+        """
+        matched = [r for r in self._fallback if apply_matcher(r.matcher_func, parsed) is True]
+
+        if self._index and parsed.mdict is not None:
+            for field, by_value in self._index.items():
+                try:
+                    candidates = by_value.get(parsed.get(field), ())
+                except TypeError:
+                    # unhashable field value (dict / list), can't equal any of the indexed values
+                    continue
+
+                for r in candidates:
+                    if getattr(r.matcher_func, "index_exact", False) or apply_matcher(r.matcher_func, parsed) is True:
+                        matched.append(r)
+
+            if len(matched) > 1:
+                matched.sort(key=lambda r: r.position)
+
+        return matched
+
+    def __len__(self):
+        return len(self.routes)
+
+    @staticmethod
+    def _is_hashable(value):
+        try:
+            hash(value)
+        except TypeError:
+            return False
+
+        return True
@@ -0,0 +1,84 @@
+import logging
+import time
+
+from tornado import ioloop
+
+
+class Timer(object):
+    __slots__ = ("deadline_tick", "slot", "callback", "args")
+
+    def __init__(self, deadline_tick, slot, callback, args):
+        self.deadline_tick = deadline_tick
+        self.slot = slot
+        self.callback = callback
+        self.args = args
+
+
+class TimerWheel(object):
+    """Hashed timer wheel driven by a single ``PeriodicCallback``
+
+    Timers are hashed by deadline tick into ``slots`` buckets, every tick only the bucket of the current tick is
+    visited, so scheduling and cancelling are O(1) and the per tick cost doesn't grow with the number of timers far
+    from their deadline. Timers fire with ``tick_ms`` resolution (never early), on the IOLoop thread.
+    """
+
+    def __init__(self, tick_ms=100, slots=600, logger=None):
+        self.tick_ms = tick_ms
+        self.logger = logger or logging.getLogger("TimerWheel")
+        self._slots = [set() for _ in range(slots)]
+        self._count = 0
+        self._start = time.monotonic()
+        self._tick = 0
+        self._periodic = ioloop.PeriodicCallback(self._on_tick, tick_ms)
+
+    def _now_tick(self):
+        return int((time.monotonic() - self._start) * 1000 / self.tick_ms)
+
+    def schedule(self, delay_ms, callback, *args):
+        """Call `callback(*args)` in `delay_ms` milliseconds, returns a timer which can be cancelled
+        """
+        # round up, a timer never fires early
+        deadline_tick = self._now_tick() + max(1, -(-int(delay_ms) // self.tick_ms))
+        slot = deadline_tick % len(self._slots)
+        timer = Timer(deadline_tick, slot, callback, args)
+        self._slots[slot].add(timer)
+        self._count += 1
+
+        if not self._periodic.is_running():
+            self._tick = self._now_tick()
+            self._periodic.start()
+
+        return timer
+
+    def cancel(self, timer):
+        if timer is None:
+            return
+        bucket = self._slots[timer.slot]
+        if timer in bucket:
+            bucket.discard(timer)
+            self._count -= 1
+
+    def _on_tick(self):
+        now_tick = self._now_tick()
+        # catch up with the ticks missed while the IOLoop was busy, visiting each bucket at most once
+        first = max(self._tick + 1, now_tick - len(self._slots) + 1)
+        for tick in range(first, now_tick + 1):
+            bucket = self._slots[tick % len(self._slots)]
+            expired = [t for t in bucket if t.deadline_tick <= now_tick]
+            for timer in expired:
+                if timer not in bucket:
+                    # cancelled by a callback fired before it
+                    continue
+                bucket.discard(timer)
+                self._count -= 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    self.logger.exception("Timer callback {} failed".format(timer.callback))
+
+        self._tick = now_tick
+        if self._count == 0:
+            self._periodic.stop()
+
+    def __len__(self):
+        return self._count
@@ -0,0 +1,99 @@
+import threading
+import time
+
+# stages of the handling of a message, see ``MessageTimings.stages``
+STAGE_QUEUE = "queue"
+STAGE_WAIT = "wait"
+STAGE_LOCK = "lock"
+STAGE_HANDLER = "handler"
+STAGE_TOTAL = "total"
+STAGES = (STAGE_QUEUE, STAGE_WAIT, STAGE_LOCK, STAGE_HANDLER, STAGE_TOTAL)
+
+
+class MessageTimings(object):
+    """Time stamps of the handling of a message, set as ``message.timings`` by the worker when it receives it
+
+    The stamps are taken with ``time.monotonic``, except for the queue time: the nsqd ``timestamp`` of the message
+    is compared to the wall clock, so it's only as accurate as the clocks of the nsqd and worker hosts agree.
+    In the "process" worker mode the pool process sends back its start stamp and lock time, the monotonic clock is
+    shared by the processes of a host.
+    """
+    __slots__ = ("published", "received_at", "received", "started", "handled", "finished", "lock_ms", "_lock")
+
+    def __init__(self, timestamp=None):
+        """
+        ``timestamp`` - the nsqd timestamp of the message, nanoseconds since the epoch
+        """
+        self.published = timestamp / 1e9 if timestamp else None
+        self.received_at = time.time()
+        self.received = time.monotonic()
+        self.started = None
+        self.handled = None
+        self.finished = None
+        self.lock_ms = 0.0
+        # the parallel routes of a message add their lock time from several threads
+        self._lock = threading.Lock()
+
+    def start(self, at=None):
+        """The handler started, after the message waited for its lane and an executor thread (or pool process)
+
+        ``at`` - the ``time.monotonic`` stamp of the start, now by default
+        """
+        if self.started is None:
+            self.started = at if at is not None else time.monotonic()
+
+    def add_lock_time(self, duration_ms):
+        """Time a route spent acquiring or releasing its lock
+        """
+        with self._lock:
+            self.lock_ms += duration_ms
+
+    def handle_done(self):
+        """The routes of the message are done, it is about to be responded to
+        """
+        self.handled = time.monotonic()
+
+    def finish(self):
+        """The message was responded to (finished or re-queued)
+        """
+        self.finished = time.monotonic()
+
+    def stages(self):
+        """Milliseconds spent in every stage reached by the message:
+
+        - ``queue`` - from the publish to the receipt by the worker (including the previous attempts)
+        - ``wait`` - from the receipt to the start of the handler, waiting for a lane or an executor thread
+        - ``lock`` - acquiring and releasing the route locks
+        - ``handler`` - running the routes (batch routes include the wait for their batch), without the lock time
+        - ``total`` - from the receipt to the response
+
+        :rtype: dict[str, float]
+        """
+        stages = {}
+        if self.published is not None:
+            stages[STAGE_QUEUE] = max(0.0, (self.received_at - self.published) * 1000)
+        if self.started is not None:
+            stages[STAGE_WAIT] = (self.started - self.received) * 1000
+            if self.handled is not None:
+                stages[STAGE_LOCK] = self.lock_ms
+                stages[STAGE_HANDLER] = max(0.0, (self.handled - self.started) * 1000 - self.lock_ms)
+        if self.finished is not None:
+            stages[STAGE_TOTAL] = (self.finished - self.received) * 1000
+        return stages
+
+    def spans(self):
+        """The consecutive stages of the message as trace spans, the lock time is part of the handler span
+
+        :return: (stage, start time in seconds since the epoch, duration in milliseconds) tuples
+        :rtype: list[(str, float, float)]
+        """
+        spans = []
+        if self.published is not None:
+            spans.append((STAGE_QUEUE, self.published, max(0.0, (self.received_at - self.published) * 1000)))
+        previous = self.received
+        for stage, stamp in ((STAGE_WAIT, self.started), (STAGE_HANDLER, self.handled)):
+            if stamp is None:
+                break
+            spans.append((stage, self.received_at + (previous - self.received), (stamp - previous) * 1000))
+            previous = stamp
+        return spans
@@ -0,0 +1,75 @@
+import collections
+import collections.abc
+import logging
+import os
+
+import pytest
+
+# tornado 4.5 and pynsq import the container ABCs from collections, removed in python 3.10
+for _name in ("Callable", "Iterable", "Mapping", "MutableMapping", "MutableSet", "Sequence"):
+    if not hasattr(collections, _name):
+        setattr(collections, _name, getattr(collections.abc, _name))
+
+# read at import time by the locker and the writer, nothing is connected to in the tests
+os.environ.setdefault("REDIS_HOST", "127.0.0.1")
+os.environ.setdefault("REDIS_PORT", "6379")
+os.environ.setdefault("NSQD_TCP_ADDRESSES", "127.0.0.1:4150")
+os.environ.setdefault("NSQD_HTTP_ADDRESSES", "127.0.0.1:4151")
+
+# the worker logger parses --loglevel from the command line (the pytest one) unless it already has a handler
+logging.getLogger("ThreadWorker").addHandler(logging.NullHandler())
+
+
+class StubConnection(object):
+    """Open nsqd connection of a ``FailoverWriter``, records the commands sent on it and answers them with ``ack``
+    """
+
+    def __init__(self, id="stub:4150"):
+        self.id = id
+        self.callback_queue = []
+        self.sent = []
+        self.closed = False
+
+    def connected(self):
+        return not self.closed
+
+    def send(self, cmd):
+        self.sent.append(cmd)
+
+    def close(self):
+        self.closed = True
+
+    def ack(self, data=b"OK"):
+        """Answer the oldest command waiting for a response
+        """
+        self.callback_queue.pop(0)(self, data)
+
+
+@pytest.fixture
+def nsqd():
+    """Replaces the connections of a writer with a ``StubConnection``
+    """
+    def connect(writer):
+        conn = StubConnection()
+        writer.conns = {conn.id: conn}
+        return conn
+
+    return connect
+
+
+@pytest.fixture
+def create_handler(monkeypatch):
+    """Creates an ``NSQHandler`` subclass instance on topic "topic" and channel "channel", its routes loaded
+    """
+    from nsqworker.nsqhandler import NSQHandler, load_routes
+
+    # nsqd isn't running, the topic isn't created
+    monkeypatch.setattr(NSQHandler, "register_nsq_topics_from_env", classmethod(lambda cls, topic_names: None))
+
+    def create(cls, **kwargs):
+        # the routes of a class are loaded once, whatever the number of handlers created from it
+        if "route_table" not in cls.__dict__:
+            load_routes(cls)
+        return cls("topic", "channel", **kwargs)
+
+    return create
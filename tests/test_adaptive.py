@@ -0,0 +1,148 @@
+import threading
+
+import nsq
+import pytest
+
+from nsqworker.adaptive import AdaptiveController, AdaptiveOptions, ConcurrencyLimit, WorkerStats
+from nsqworker.backlog import BacklogStats
+
+
+def new_message(id=b"0123456789abcdef"):
+    return nsq.Message(id, b"{}", 0, 1)
+
+
+def test_message_with_several_failed_routes_counts_once():
+    stats = WorkerStats()
+    failed, handled = new_message(b"0000000000000001"), new_message(b"0000000000000002")
+
+    for _ in range(3):
+        stats.route_failed(failed)
+    stats.message_done(failed, 10, False)
+    stats.message_done(handled, 30, False)
+
+    assert failed.failed_routes == 3
+    assert (stats.handled, stats.failed) == (2, 1)
+    assert stats.error_rate == 0.5 and stats.avg_latency_ms == 20
+
+
+def test_route_failures_from_several_threads_are_all_counted():
+    stats = WorkerStats()
+    message = new_message()
+
+    def fail_routes():
+        for _ in range(1000):
+            stats.route_failed(message)
+
+    threads = [threading.Thread(target=fail_routes) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats.message_done(message, 1, False)
+
+    assert message.failed_routes == 8000
+    assert stats.error_rate == 1.0
+
+
+def test_concurrency_limit_wakes_waiters_on_release_and_resize():
+    limit = ConcurrencyLimit(1)
+    first, second, third = limit.acquire(), limit.acquire(), limit.acquire()
+
+    assert first.done() and not second.done() and limit.waiting == 2
+    limit.release()
+    assert second.done() and not third.done()
+    limit.set_limit(2)
+    assert third.done() and limit.active == 2
+
+
+class FakeReader(object):
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+
+    def set_max_in_flight(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+
+
+class FakeWorker(object):
+    paused = False
+
+    def __init__(self, max_in_flight=20, concurrency=4, queue_depth=0):
+        self.stats = WorkerStats()
+        self.reader = FakeReader(max_in_flight)
+        self.concurrency = concurrency
+        self.concurrency_limit = ConcurrencyLimit(concurrency)
+        self.queue_depth = queue_depth
+
+
+@pytest.fixture
+def options():
+    return AdaptiveOptions(min_in_flight=1, max_in_flight=100, min_concurrency=1, max_concurrency=8,
+                           target_latency_ms=100, max_error_rate=0.5, max_drain_seconds=60)
+
+
+def done(worker, count, latency_ms=10, failed=False):
+    for i in range(count):
+        worker.stats.message_done(new_message(b"%016d" % i), latency_ms, failed)
+
+
+def test_failures_back_off(options):
+    worker = FakeWorker()
+    done(worker, 10, failed=True)
+
+    AdaptiveController(worker, options).adjust()
+
+    assert worker.reader.max_in_flight == 15 and worker.concurrency_limit.limit == 3
+    assert worker.stats.handled == 0
+
+
+def test_slow_handlers_back_off(options):
+    worker = FakeWorker()
+    done(worker, 10, latency_ms=500)
+
+    AdaptiveController(worker, options).adjust()
+
+    assert worker.reader.max_in_flight == 15
+
+
+def test_queueing_while_busy_grows_concurrency(options):
+    worker = FakeWorker(queue_depth=5)
+    done(worker, 10)
+    worker.stats.samples = worker.stats.busy_samples = 10
+
+    AdaptiveController(worker, options).adjust()
+
+    assert worker.concurrency_limit.limit == 5 and worker.reader.max_in_flight == 20
+
+
+def test_starved_reader_grows_max_in_flight(options):
+    worker = FakeWorker()
+    done(worker, 10)
+    worker.stats.in_flight = 20
+    worker.stats.samples = worker.stats.busy_samples = 10
+
+    AdaptiveController(worker, options).adjust()
+
+    assert worker.reader.max_in_flight == 22
+
+
+def test_lagging_channel_grows_max_in_flight(options):
+    worker = FakeWorker()
+    done(worker, 10)
+    worker.stats.samples = worker.stats.busy_samples = 10
+    controller = AdaptiveController(worker, options)
+    backlog = BacklogStats()
+    backlog.depth = 1000
+    controller.on_backlog(backlog)
+
+    controller.adjust()
+
+    assert controller.lagging and worker.reader.max_in_flight == 22
+
+
+def test_idle_executor_shrinks_concurrency(options):
+    worker = FakeWorker()
+    done(worker, 10)
+
+    AdaptiveController(worker, options).adjust()
+
+    assert worker.concurrency_limit.limit == 3 and worker.reader.max_in_flight == 20
@@ -0,0 +1,73 @@
+import json
+
+import pytest
+
+from nsqworker.backlog import BacklogMonitor, _response_data, channel_counters
+
+
+def nsqd_stats(message_count, depth, in_flight=0, deferred=0, clients=()):
+    return {"topics": [{"topic_name": "topic", "channels": [
+        {"channel_name": "other", "message_count": 1000, "depth": 1000},
+        {"channel_name": "channel", "message_count": message_count, "depth": depth, "in_flight_count": in_flight,
+         "deferred_count": deferred, "requeue_count": 3, "timeout_count": 1,
+         "clients": [{"finish_count": count} for count in clients]},
+    ]}]}
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def monitor():
+    return BacklogMonitor("topic", "channel", nsqd_http_addresses=["nsqd:4151"], clock=Clock())
+
+
+def test_channel_counters():
+    counters = channel_counters(nsqd_stats(100, 20, in_flight=5, deferred=5, clients=(40, 30)), "topic", "channel")
+
+    assert counters == dict(depth=20, in_flight=5, deferred=5, message_count=100, finish_count=70, requeue_count=3,
+                            timeout_count=1)
+    assert channel_counters(nsqd_stats(100, 20), "topic", "missing") is None
+    assert channel_counters({"topics": None}, "topic", "channel") is None
+
+
+def test_finish_count_doesnt_drop_when_a_client_disconnects():
+    before = channel_counters(nsqd_stats(100, 20, clients=(40, 40)), "topic", "channel")
+    after = channel_counters(nsqd_stats(110, 20, clients=(50,)), "topic", "channel")
+
+    assert after["finish_count"] - before["finish_count"] == 10
+
+
+def test_wrapped_responses_of_old_nsqd():
+    stats = nsqd_stats(100, 20)
+    body = json.dumps({"status_code": 200, "status_txt": "OK", "data": stats}).encode()
+
+    assert _response_data(body) == stats
+    assert _response_data(json.dumps(stats)) == stats
+
+
+def test_rates_are_computed_between_two_polls(monitor):
+    monitor._update({"nsqd:4151": channel_counters(nsqd_stats(100, 50), "topic", "channel")})
+    assert monitor.stats.publish_rate == 0.0 and monitor.stats.time_to_drain is None
+
+    monitor._clock.now += 10
+    monitor._update({"nsqd:4151": channel_counters(nsqd_stats(200, 30), "topic", "channel")})
+
+    stats = monitor.stats
+    assert (stats.depth, stats.publish_rate, stats.finish_rate) == (30, 10.0, 12.0)
+    assert stats.time_to_drain == 15.0
+
+
+def test_counters_going_back_are_skipped(monitor):
+    monitor._update({"nsqd:4151": channel_counters(nsqd_stats(100, 50), "topic", "channel")})
+    monitor._clock.now += 10
+    # the nsqd restarted, its depth was kept on disk
+    monitor._update({"nsqd:4151": channel_counters(nsqd_stats(10, 40), "topic", "channel")})
+
+    assert (monitor.stats.publish_rate, monitor.stats.finish_rate) == (0.0, 0.0)
+    assert monitor.stats.time_to_drain is None
@@ -0,0 +1,132 @@
+import json
+import threading
+
+import nsq
+import pytest
+from nsq import protocol
+
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.bulkhead import BULKHEAD_REQUEUE_DELAY_MS, Bulkhead
+from nsqworker.nsqhandler import NSQHandler, _bulkhead, route
+from nsqworker.retry import retry_body
+
+
+class PooledHandler(NSQHandler):
+    handled = []
+
+    @route(json_matcher("name", "report"), pool="reports")
+    def report(self, message):
+        self.handled.append("report")
+
+    @route(lambda body: body == b"raw report", pool="reports")
+    def raw_report(self, message):
+        self.handled.append("raw_report")
+
+    @route(json_matcher("name", "report"))
+    def audit(self, message):
+        self.handled.append("audit")
+
+
+def create_full_pool_handler(create_handler):
+    # no message can wait for the pool, every message is shed
+    return create_handler(PooledHandler, pools={"reports": Bulkhead("reports", 1, max_waiting=0, requeue_delay_ms=250)})
+
+
+def test_shed_route_is_published_to_itself(create_handler, nsqd):
+    handler = create_full_pool_handler(create_handler)
+    conn = nsqd(handler.writer)
+    PooledHandler.handled = []
+
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "report"}).encode(), 0, 1)
+    handler.route_message(message)
+    handler._flush_publish_queue()
+
+    assert PooledHandler.handled == ["audit"]
+    assert not message.has_responded()
+    assert conn.sent == [protocol.dpub("topic", 250, retry_body({"name": "report"}, "channel", ["report"], 0))]
+
+
+def test_shed_non_json_message_is_requeued_in_milliseconds(create_handler):
+    handler = create_full_pool_handler(create_handler)
+    requeued = []
+
+    message = nsq.Message(b"0123456789abcdef", b"raw report", 0, 1)
+    message.on(nsq.event.REQUEUE, lambda message, **kwargs: requeued.append(kwargs))
+    handler.route_message(message)
+
+    assert requeued == [dict(backoff=False, time_ms=250, contended=True)]
+
+
+class SaturatedHandler(NSQHandler):
+    handled = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    @route(json_matcher("name", "report"), max_concurrency=1, max_waiting=1)
+    def slow(self, message):
+        self.entered.set()
+        self.release.wait(5)
+        self.handled.append("slow")
+
+    @route(json_matcher("name", "report"), sequential=True)
+    def fast(self, message):
+        self.handled.append("fast")
+
+
+def test_saturated_route_is_shed_while_its_sibling_keeps_flowing(create_handler, nsqd):
+    handler = create_handler(SaturatedHandler, parallel_routes=True)
+    conn = nsqd(handler.writer)
+    SaturatedHandler.handled = []
+    body = json.dumps({"name": "report"}).encode()
+
+    try:
+        running = handler.route_message(nsq.Message(b"0123456789abcde1", body, 0, 1))
+        assert SaturatedHandler.entered.wait(5)
+        waiting = handler.route_message(nsq.Message(b"0123456789abcde2", body, 0, 1))
+        # one message already waits for the bulkhead
+        assert handler.route_message(nsq.Message(b"0123456789abcde3", body, 0, 1)) is None
+        handler._flush_publish_queue()
+
+        assert SaturatedHandler.handled == ["fast"] * 3
+        assert conn.sent == [protocol.dpub("topic", BULKHEAD_REQUEUE_DELAY_MS,
+                                           retry_body({"name": "report"}, "channel", ["slow"], 0))]
+    finally:
+        SaturatedHandler.release.set()
+
+    running.result(timeout=5)
+    waiting.result(timeout=5)
+    assert SaturatedHandler.handled == ["fast"] * 3 + ["slow"] * 2
+
+
+class OrderedHandler(NSQHandler):
+    handled = []
+
+    @route(json_matcher("name", "report"), max_concurrency=1)
+    def first(self, message):
+        self.handled.append(("first", threading.current_thread().name))
+
+    @route(json_matcher("name", "report"))
+    def second(self, message):
+        self.handled.append(("second", threading.current_thread().name))
+
+
+def test_bulkhead_route_runs_in_order_without_parallel_routes(create_handler):
+    handler = create_handler(OrderedHandler)
+    OrderedHandler.handled = []
+
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "report"}).encode(), 0, 1)
+    assert handler.route_message(message) is None
+
+    assert [name for name, _ in OrderedHandler.handled] == ["first", "second"]
+    assert OrderedHandler.handled[0][1].startswith("bulkhead-first")
+    assert OrderedHandler.handled[1][1] == threading.current_thread().name
+
+
+def test_pool_max_waiting():
+    assert _bulkhead("reports", (4, 100)).max_waiting == 100
+    assert _bulkhead("reports", 4).max_waiting is None
+
+
+def test_route_max_waiting_needs_max_concurrency():
+    with pytest.raises(ValueError):
+        route(json_matcher("name", "report"), pool="reports", max_waiting=1)
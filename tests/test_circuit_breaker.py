@@ -0,0 +1,63 @@
+import json
+
+import nsq
+
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.circuit_breaker import CircuitBreakerOptions
+from nsqworker.nsqhandler import NSQHandler, route
+from nsqworker.retry import retry_body
+
+
+class GatewayHandler(NSQHandler):
+    handled = []
+
+    @route(json_matcher("name", "charge"), circuit_breaker=CircuitBreakerOptions(min_calls=1, open_duration=30))
+    def charge(self, message):
+        self.handled.append("charge")
+
+    @route(lambda body: body == b"raw charge", circuit_breaker=CircuitBreakerOptions(min_calls=1, open_duration=30))
+    def raw_charge(self, message):
+        self.handled.append("raw_charge")
+
+    @route(json_matcher("name", "charge"))
+    def notify(self, message):
+        self.handled.append("notify")
+
+
+def create_open_circuit_handler(create_handler):
+    handler = create_handler(GatewayHandler)
+    for breaker in handler._breakers.values():
+        assert breaker.allow()
+        breaker.record(False, 1)
+    GatewayHandler.handled = []
+    return handler
+
+
+def test_open_circuit_route_is_deferred_alone(create_handler, nsqd):
+    handler = create_open_circuit_handler(create_handler)
+    conn = nsqd(handler.writer)
+
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "charge"}).encode(), 0, 1)
+    handler.route_message(message)
+    handler._flush_publish_queue()
+
+    assert GatewayHandler.handled == ["notify"]
+    assert not message.has_responded()
+    [cmd] = conn.sent
+    command, size_and_body = cmd.split(b"\n", 1)
+    topic, delay_ms = command.split(b" ")[1:]
+    assert topic == b"topic" and 29000 < int(delay_ms) <= 30000
+    assert size_and_body[4:] == retry_body({"name": "charge"}, "channel", ["charge"], 0)
+
+
+def test_open_circuit_non_json_message_is_requeued_in_milliseconds(create_handler):
+    handler = create_open_circuit_handler(create_handler)
+    requeued = []
+
+    message = nsq.Message(b"0123456789abcdef", b"raw charge", 0, 1)
+    message.on(nsq.event.REQUEUE, lambda message, **kwargs: requeued.append(kwargs))
+    handler.route_message(message)
+
+    assert GatewayHandler.handled == []
+    assert len(requeued) == 1 and 29000 < requeued[0]["time_ms"] <= 30000
+    assert not requeued[0]["backoff"] and requeued[0]["contended"]
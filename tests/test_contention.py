@@ -0,0 +1,152 @@
+import json
+
+import nsq
+import pytest
+from nsq import protocol
+
+from locker.redis_locker import LockContendedError
+from nsqworker import nsqworker
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.nsqhandler import NSQHandler, route
+from nsqworker.nsqworker import Reader
+from nsqworker.retry import retry_body
+
+
+@pytest.fixture
+def reader(monkeypatch):
+    monkeypatch.setattr(Reader, "_maybe_update_rdy", lambda self, conn: None)
+    # the worker handles its messages asynchronously
+    return Reader(topic="topic", channel="channel", nsqd_tcp_addresses=["127.0.0.1:4150"],
+                  message_handler=lambda message: message.enable_async(), max_tries=3)
+
+
+def deliver(reader, attempts, id=b"0123456789abcdef"):
+    message = nsq.Message(id, b"{}", 0, attempts)
+    reader._handle_message(None, message)
+    return message
+
+
+def test_contended_requeues_dont_count_as_attempts(reader):
+    for attempts in (1, 2, 3):
+        message = deliver(reader, attempts)
+        assert (message.attempts, message.contentions) == (1, attempts - 1)
+        message.requeue(backoff=False, time_ms=100, contended=True)
+
+    # a failure counts as an attempt
+    message = deliver(reader, 4)
+    message.requeue(delay=0)
+    message = deliver(reader, 5)
+    assert (message.attempts, message.contentions) == (2, 3)
+
+
+def test_contention_count_is_kept_by_the_reader_only(reader):
+    deliver(reader, 1).requeue(backoff=False, time_ms=100, contended=True)
+    reader._contentions.clear()
+
+    # delivered to another consumer, the re-queue counts as an attempt
+    message = deliver(reader, 2)
+    assert (message.attempts, message.contentions) == (2, 0)
+
+
+def test_contention_counts_are_bounded(reader, monkeypatch):
+    monkeypatch.setattr(nsqworker, "MAX_CONTENDED_MESSAGES", 2)
+    for i in range(3):
+        deliver(reader, 1, id=b"%016d" % i).requeue(backoff=False, time_ms=100, contended=True)
+
+    assert list(reader._contentions) == [b"%016d" % 1, b"%016d" % 2]
+
+
+class ContendedHandler(NSQHandler):
+    handled = []
+    contended = set()
+
+    @route(json_matcher("name", "event"))
+    def first(self, message):
+        self.run("first")
+
+    @route(json_matcher("name", "event"))
+    def second(self, message):
+        self.run("second")
+
+    @route(json_matcher("name", "event"))
+    def third(self, message):
+        self.run("third")
+
+    def run(self, name):
+        if name in self.contended:
+            raise LockContendedError("event:1", 400)
+        self.handled.append(name)
+
+
+def route_event(handler, body):
+    requeued = []
+    message = nsq.Message(b"0123456789abcdef", json.dumps(body).encode(), 0, 1)
+    message.on(nsq.event.REQUEUE, lambda message, **kwargs: requeued.append(kwargs))
+    handler.route_message(message)
+    handler._flush_publish_queue()
+    return message, requeued
+
+
+def test_contended_first_route_requeues_the_message(create_handler, nsqd):
+    handler = create_handler(ContendedHandler)
+    conn = nsqd(handler.writer)
+    ContendedHandler.handled, ContendedHandler.contended = [], {"first"}
+
+    _, requeued = route_event(handler, {"name": "event"})
+
+    assert ContendedHandler.handled == [] and conn.sent == []
+    assert requeued == [dict(backoff=False, time_ms=400, contended=True)]
+
+
+def test_contended_route_is_deferred_with_the_next_ones(create_handler, nsqd):
+    handler = create_handler(ContendedHandler)
+    conn = nsqd(handler.writer)
+    ContendedHandler.handled, ContendedHandler.contended = [], {"second"}
+
+    message, requeued = route_event(handler, {"name": "event"})
+
+    assert ContendedHandler.handled == ["first"] and requeued == [] and not message.has_responded()
+    assert conn.sent == [protocol.dpub("topic", 400, retry_body({"name": "event"}, "channel", ["second", "third"],
+                                                                0, 1))]
+
+
+def test_deferred_copy_carries_its_contention_count(create_handler, nsqd):
+    handler = create_handler(ContendedHandler)
+    conn = nsqd(handler.writer)
+    ContendedHandler.handled, ContendedHandler.contended = [], {"third"}
+    copy = json.loads(retry_body({"name": "event"}, "channel", ["second", "third"], 0, 1))
+    copy.update(persisted_message=True)
+
+    route_event(handler, copy)
+
+    assert ContendedHandler.handled == ["second"]
+    sent = json.loads(conn.sent[0].split(b"\n", 1)[1][4:])
+    assert sent["recipients"] == {"channel": ["third"]} and sent["contentions"] == 2
+
+
+class ParallelFailingHandler(NSQHandler):
+    @route(json_matcher("name", "event"), sequential=True)
+    def first(self, message):
+        raise LockContendedError("event:1", 400)
+
+    @route(json_matcher("name", "event"), is_idempotent=True)
+    def flaky(self, message):
+        raise ValueError("failed")
+
+
+def test_failed_parallel_route_is_retried_alone_along_the_deferred_copy(create_handler, nsqd):
+    handler = create_handler(ParallelFailingHandler, parallel_routes=True)
+    conn = nsqd(handler.writer)
+
+    requeued = []
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "event"}).encode(), 0, 1)
+    message.on(nsq.event.REQUEUE, lambda message, **kwargs: requeued.append(kwargs))
+    handler.route_message(message).result(timeout=5)
+    handler._flush_publish_queue()
+
+    # neither the deferred route nor the failed one runs again with the whole message
+    assert requeued == [] and not message.has_responded()
+    sent = [json.loads(cmd.split(b"\n", 1)[1][4:]) for cmd in conn.sent]
+    sent.sort(key=lambda body: body["recipients"]["channel"])
+    assert [(body["recipients"]["channel"], body["retry_attempt"], body.get("contentions")) for body in sent] == [
+        (["first"], 0, 1), (["flaky"], 1, None)]
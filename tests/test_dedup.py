@@ -0,0 +1,111 @@
+import time
+
+import nsq
+import pytest
+import redis
+
+from nsqworker.dedup import BloomFilter, Deduplicator, DuplicateInProgressError, RotatingBloomFilter
+
+
+class FakeRedisAccess(object):
+    def __init__(self):
+        self.values = {}
+        self.down = False
+
+    def claim(self, name, ttl):
+        if self.down:
+            raise redis.ConnectionError("redis is down")
+        if name in self.values:
+            return self.values[name]
+        self.values[name] = b"running"
+        return None
+
+    def set_expiring(self, name, value, ttl, on_result=None):
+        self.values[name] = value
+
+    def delete(self, name, on_result=None):
+        self.values.pop(name, None)
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add("added:{}".format(i))
+
+    assert all("added:{}".format(i) in bloom for i in range(10000))
+    false_positives = sum("missing:{}".format(i) in bloom for i in range(10000))
+    assert false_positives < 200
+
+
+def test_rotating_filter_forgets_after_two_windows():
+    bloom = RotatingBloomFilter(100, 0.01, window=0.05)
+    bloom.add("key")
+
+    time.sleep(0.06)
+    assert "key" in bloom
+    time.sleep(0.1)
+    assert "key" not in bloom
+
+
+class AlwaysSeen(object):
+    """Local filter answering every lookup with a false positive
+    """
+
+    def add(self, key):
+        pass
+
+    def __contains__(self, key):
+        return True
+
+
+def test_false_positive_without_redis_skips_the_message():
+    deduplicator = Deduplicator(window=60, capacity=100)
+    deduplicator._filter = AlwaysSeen()
+
+    assert not deduplicator.claim("channel:route:never handled")
+
+
+def test_false_positive_is_handled_once_redis_doesnt_know_the_message():
+    access = FakeRedisAccess()
+    deduplicator = Deduplicator(window=60, capacity=100, redis_access=access)
+    deduplicator._filter = AlwaysSeen()
+
+    assert deduplicator.claim("channel:route:never handled")
+
+
+def test_redis_failure_falls_back_to_the_local_filter():
+    access = FakeRedisAccess()
+    deduplicator = Deduplicator(window=60, capacity=100, redis_access=access)
+    deduplicator.done("channel:route:handled")
+    access.down = True
+
+    assert not deduplicator.claim("channel:route:handled")
+    assert deduplicator.claim("channel:route:new")
+
+
+def test_message_is_claimed_while_handled():
+    access = FakeRedisAccess()
+    first = Deduplicator(window=60, capacity=100, redis_access=access)
+    second = Deduplicator(window=60, capacity=100, redis_access=access)
+    key = first.message_key(nsq.Message(b"0123456789abcdef", b"{}", 0, 1), "route", "channel")
+
+    assert first.claim(key)
+    with pytest.raises(DuplicateInProgressError):
+        second.claim(key)
+
+    # a failure releases the claim, a success skips the duplicates
+    first.failed(key)
+    assert second.claim(key)
+    second.done(key)
+    assert not first.claim(key) and not second.claim(key)
+
+
+@pytest.mark.parametrize("key, same", [("id", False), ("content", True)])
+def test_message_key(key, same):
+    deduplicator = Deduplicator(key=key, window=60, capacity=100)
+    first = nsq.Message(b"0000000000000001", b'{"name": "event"}', 0, 1)
+    republished = nsq.Message(b"0000000000000002", b'{"name": "event"}', 0, 1)
+
+    assert deduplicator.message_key(first, "route", "channel").startswith("channel:route:")
+    assert (deduplicator.message_key(first, "route", "channel") ==
+            deduplicator.message_key(republished, "route", "channel")) is same
@@ -0,0 +1,80 @@
+from tornado import gen, ioloop
+from tornado.concurrent import Future
+
+from nsqworker.lanes import KeyedLanes
+
+
+def run(coroutine):
+    return ioloop.IOLoop.current().run_sync(coroutine, timeout=5)
+
+
+def test_tasks_of_a_lane_run_one_at_a_time_in_order():
+    lanes = KeyedLanes(capacity=10)
+    events = []
+
+    def task(key, i, delay):
+        @gen.coroutine
+        def run_task():
+            events.append(("start", key, i))
+            yield gen.sleep(delay)
+            events.append(("end", key, i))
+            raise gen.Return(i)
+        return run_task
+
+    @gen.coroutine
+    def submit():
+        # the first task of "a" is the slowest, the next ones still wait for it
+        futures = [lanes.submit("a", task("a", 0, 0.03)), lanes.submit("a", task("a", 1, 0)),
+                   lanes.submit("b", task("b", 0, 0.01)), lanes.submit("a", task("a", 2, 0))]
+        results = yield futures
+        raise gen.Return(results)
+
+    assert run(submit) == [0, 1, 0, 2]
+    a_events = [e for e in events if e[1] == "a"]
+    assert a_events == [("start", "a", 0), ("end", "a", 0), ("start", "a", 1), ("end", "a", 1),
+                        ("start", "a", 2), ("end", "a", 2)]
+    # lane "b" didn't wait for lane "a"
+    assert events.index(("end", "b", 0)) < events.index(("end", "a", 0))
+    assert len(lanes) == 0
+
+
+def test_failed_task_doesnt_stop_its_lane():
+    lanes = KeyedLanes(capacity=10)
+
+    def fail():
+        raise ValueError("failed")
+
+    @gen.coroutine
+    def submit():
+        failed = lanes.submit("a", fail)
+        done = lanes.submit("a", lambda: gen.maybe_future("done"))
+        try:
+            yield failed
+        except ValueError as e:
+            error = e
+        result = yield done
+        raise gen.Return((error, result))
+
+    error, result = run(submit)
+    assert isinstance(error, ValueError) and result == "done"
+
+
+def test_full_lane_pauses_until_half_drained():
+    calls = []
+    lanes = KeyedLanes(capacity=4, on_full=lambda: calls.append("full"), on_drained=lambda: calls.append("drained"))
+    blockers = [Future() for _ in range(4)]
+
+    @gen.coroutine
+    def submit():
+        futures = [lanes.submit("a", lambda blocker=blocker: blocker) for blocker in blockers]
+        assert calls == ["full"] and lanes.queued == 3
+        for i, blocker in enumerate(blockers):
+            blocker.set_result(i)
+            yield futures[i]
+            if i == 0:
+                # 3 tasks left, above half of the capacity
+                assert calls == ["full"]
+        raise gen.Return(None)
+
+    run(submit)
+    assert calls == ["full", "drained"]
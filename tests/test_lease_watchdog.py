@@ -0,0 +1,103 @@
+import time
+
+import redis
+
+from locker.lease_watchdog import LeaseWatchdog
+
+
+class FakePipeline(object):
+    def __init__(self, access):
+        self.access = access
+        self.extended = []
+
+    def execute(self):
+        if self.access.down:
+            raise redis.ConnectionError("redis is down")
+        return [1 if self.access.held.get(name) == token else 0 for name, token in self.extended]
+
+
+class FakeRedisAccess(object):
+    """Redis access extending the locks of ``held`` (name to token)
+    """
+
+    def __init__(self):
+        self.redis = self
+        self.held = {}
+        self.down = False
+        self.renewals = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def extend(self, name, token, ttl_ms, client=None):
+        self.renewals.append(name)
+        client.extended.append((name, token))
+
+
+def test_lease_is_renewed_once_a_third_of_its_ttl_elapsed():
+    access = FakeRedisAccess()
+    access.held["lock"] = b"token"
+    watchdog = LeaseWatchdog(access, tick=3600)
+    lease = watchdog.register("lock", b"token", 60)
+
+    assert watchdog.renew() == 0
+    time.sleep(0.03)
+    assert watchdog.renew() == 1 and not lease.lost
+    # renewed until the next third of the ttl
+    assert watchdog.renew() == 0
+
+
+def test_lease_taken_by_someone_else_is_lost():
+    access = FakeRedisAccess()
+    access.held["lock"] = b"token"
+    watchdog = LeaseWatchdog(access, tick=3600)
+    lease = watchdog.register("lock", b"token", 30)
+
+    time.sleep(0.02)
+    assert watchdog.renew() == 1
+    access.held["lock"] = b"other token"
+    time.sleep(0.02)
+    assert watchdog.renew() == 0 and lease.lost
+
+    # not renewed anymore
+    access.held["lock"] = b"token"
+    time.sleep(0.02)
+    assert watchdog.renew() == 0 and access.renewals == ["lock", "lock"]
+
+
+def test_renewal_is_retried_after_a_redis_error():
+    access = FakeRedisAccess()
+    access.held["lock"] = b"token"
+    watchdog = LeaseWatchdog(access, tick=3600)
+    lease = watchdog.register("lock", b"token", 30)
+
+    time.sleep(0.02)
+    access.down = True
+    assert watchdog.renew() == 0 and not lease.lost
+    access.down = False
+    assert watchdog.renew() == 1
+
+
+def test_released_lease_isnt_renewed():
+    access = FakeRedisAccess()
+    watchdog = LeaseWatchdog(access, tick=3600)
+    lease = watchdog.register("lock", b"token", 30)
+    watchdog.unregister(lease)
+
+    time.sleep(0.02)
+    assert watchdog.renew() == 0 and access.renewals == [] and not lease.lost
+
+
+def test_leases_are_renewed_in_the_background():
+    access = FakeRedisAccess()
+    access.held["first"], access.held["second"] = b"first token", b"second token"
+    watchdog = LeaseWatchdog(access, tick=0.01)
+    first = watchdog.register("first", b"first token", 30)
+    second = watchdog.register("second", b"second token", 30)
+
+    time.sleep(0.1)
+    watchdog.unregister(first)
+    watchdog.unregister(second)
+
+    assert access.renewals.count("first") >= 2 and access.renewals.count("second") >= 2
+    assert not first.lost and not second.lost
@@ -0,0 +1,76 @@
+import gc
+
+from nsqworker import metrics
+from nsqworker.metrics import MetricsAggregator
+
+
+def test_sink_sends_a_measure_per_series(monkeypatch):
+    stats, latencies = [], []
+    monkeypatch.setattr(metrics, "measure_nsq_stats", lambda **kwargs: stats.append(kwargs))
+    monkeypatch.setattr(metrics, "measure_nsq_latency", lambda **kwargs: latencies.append(kwargs))
+    monkeypatch.setattr(metrics, "_STATS_COUNT", True)
+    aggregator = MetricsAggregator(flush_interval=10, sink=metrics.auguryapi_sink)
+
+    for duration in (10, 20, 30):
+        aggregator.observe(duration, "OK", "topic", "channel", "event", "route")
+    aggregator.count("SHED", "topic", "channel", "event", "route")
+    aggregator.flush()
+
+    labels = dict(topic="topic", channel="channel", event="event", route="route")
+    assert sorted(stats, key=lambda s: s["status"]) == [dict(labels, status="OK", count=3),
+                                                        dict(labels, status="SHED", count=1)]
+    assert latencies == [dict(labels, duration=20.0)]
+
+
+def test_aggregators_are_reset_after_fork():
+    aggregator = MetricsAggregator(flush_interval=10)
+    aggregator.count("OK", "topic", "channel", "event", "route")
+
+    metrics._after_fork()
+
+    assert aggregator._shards == [] and aggregator._thread is None
+
+
+def test_fork_hook_doesnt_keep_aggregators_alive():
+    aggregator = MetricsAggregator(flush_interval=10)
+    assert aggregator in metrics._aggregators
+
+    count = len(metrics._aggregators)
+    del aggregator
+    gc.collect()
+    assert len(metrics._aggregators) == count - 1
+
+
+def test_measures_taking_kwargs_get_a_measure_per_message():
+    def explicit(status, count=1):
+        pass
+
+    def keyword_only(status, *, count):
+        pass
+
+    def forwarding(**kwargs):
+        pass
+
+    assert metrics._accepts_count(explicit) and metrics._accepts_count(keyword_only)
+    assert not metrics._accepts_count(forwarding)
+    assert not metrics._accepts_count(lambda status: None)
+
+
+def test_handlers_share_the_process_aggregator_served_once(monkeypatch, create_handler):
+    from nsqworker.nsqhandler import NSQHandler
+
+    served = []
+    monkeypatch.setattr(metrics, "_process_aggregator", None)
+    monkeypatch.setattr(metrics, "METRICS_HTTP_PORT", 9100)
+    monkeypatch.setattr(MetricsAggregator, "serve", lambda self, port: served.append(port))
+
+    class FirstHandler(NSQHandler):
+        pass
+
+    class SecondHandler(NSQHandler):
+        pass
+
+    first, second = create_handler(FirstHandler), create_handler(SecondHandler)
+
+    assert first.metrics is second.metrics is metrics.process_aggregator()
+    assert served == [9100]
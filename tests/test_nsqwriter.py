@@ -0,0 +1,79 @@
+import pytest
+from nsq import protocol
+
+from nsqworker.errors import PublishError
+from nsqworker.nsqwriter import FailoverWriter, NSQWriter
+
+
+@pytest.fixture
+def writer():
+    return FailoverWriter(nsqd_tcp_addresses=["127.0.0.1:4150"])
+
+
+def test_publish_queues_callback_once_sent(writer, nsqd):
+    conn = nsqd(writer)
+    responses = []
+
+    writer.publish("topic", b"body", callback=lambda conn, data: responses.append(data))
+
+    assert conn.sent == [protocol.pub("topic", b"body")]
+    conn.ack()
+    assert responses == [b"OK"]
+
+
+def test_publish_of_invalid_payload_fails_without_queuing(writer, nsqd):
+    conn = nsqd(writer)
+    responses = []
+
+    writer.publish("topic", u"not bytes", delay_ms=100, callback=lambda conn, data: responses.append(data))
+
+    assert len(responses) == 1 and isinstance(responses[0], protocol.SendError)
+    assert conn.sent == [] and conn.callback_queue == [] and not conn.closed
+
+
+def test_publish_send_failure_calls_back_once(writer, nsqd):
+    conn = nsqd(writer)
+    responses = []
+
+    def fail(cmd):
+        raise IOError("stream closed")
+
+    conn.send = fail
+    writer.publish("topic", b"body", callback=lambda conn, data: responses.append(data))
+
+    assert len(responses) == 1 and isinstance(responses[0], protocol.SendError)
+    assert conn.callback_queue == [] and conn.closed
+
+
+def test_invalid_payload_is_dropped_without_retries(nsqd):
+    writer = NSQWriter(outbox_dir=None)
+    nsqd(writer.writer)
+    delivered = []
+
+    writer.send_message("topic", u"not bytes", on_delivery=delivered.append)
+    writer._flush_publish_queue()
+
+    assert len(delivered) == 1 and isinstance(delivered[0], PublishError)
+    assert writer.retry_buffered_bytes == 0
+
+
+def test_failing_publish_doesnt_stop_the_queued_ones(nsqd):
+    writer = NSQWriter(outbox_dir=None)
+    conn = nsqd(writer.writer)
+    failing, delivered = writer.publish("topic", b"failing"), []
+
+    pub = writer._pub
+
+    def fail_first(topic, payload, delay, callbacks, **kwargs):
+        if payload == b"failing":
+            raise RuntimeError("failed")
+        pub(topic, payload, delay, callbacks, **kwargs)
+
+    writer._pub = fail_first
+    writer.send_message("topic", b"body", on_delivery=delivered.append)
+    writer._flush_publish_queue()
+
+    assert isinstance(failing.exception(timeout=0), PublishError)
+    assert conn.sent == [protocol.pub("topic", b"body")]
+    conn.ack()
+    assert delivered == [None]
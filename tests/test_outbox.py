@@ -0,0 +1,119 @@
+import threading
+
+from tornado import gen
+
+from nsqworker import nsqwriter
+from nsqworker.errors import PublishError
+from nsqworker.nsqwriter import NSQWriter
+from nsqworker.outbox import Outbox
+
+
+def wait_for_outbox_io(writer):
+    writer._outbox_io.submit(lambda: None).result(timeout=1)
+
+
+def test_in_order_acks_are_compacted(tmpdir):
+    outbox = Outbox(str(tmpdir))
+    record_ids = [outbox.append("topic", b"body %d" % i) for i in range(1000)]
+
+    for record_id in record_ids[1:]:
+        outbox.ack(record_id)
+    segment = outbox._current
+    assert len(segment.acked_ends) == 999 and outbox.backlog == 1
+
+    outbox.ack(record_ids[0])
+    assert segment.acked_ends == {} and segment.acked_below == segment.size and outbox.backlog == 0
+
+
+def test_pending_records_survive_a_restart(tmpdir):
+    outbox = Outbox(str(tmpdir))
+    first, second, third = [outbox.append("topic", body) for body in (b"first", b"second", b"third")]
+    outbox.ack(first)
+    outbox.ack(third)
+    outbox.close()
+
+    outbox = Outbox(str(tmpdir))
+    assert outbox.backlog == 1
+    assert [(topic, payload) for _, topic, payload, _ in outbox.pending(10)] == [("topic", b"second")]
+
+
+def test_outbox_is_read_off_the_ioloop(tmpdir, nsqd):
+    writer = NSQWriter(outbox_dir=str(tmpdir))
+    writer._outbox_drainer.stop()
+    conn = nsqd(writer.writer)
+    writer._outbox.release(writer._outbox.append("topic", b"body"))
+    pending, readers = writer._outbox.pending, []
+
+    def read_pending(limit):
+        readers.append(threading.current_thread())
+        return pending(limit)
+
+    writer._outbox.pending = read_pending
+    writer._drain_outbox()
+    writer.io_loop.run_sync(lambda: gen.sleep(0.05))
+
+    assert readers and readers[0] is not threading.current_thread()
+    assert len(conn.sent) == 1
+    conn.ack()
+    wait_for_outbox_io(writer)
+    assert writer._outbox.backlog == 0
+
+
+def test_acks_are_written_off_the_ioloop(tmpdir, nsqd):
+    writer = NSQWriter(outbox_dir=str(tmpdir))
+    writer._outbox_drainer.stop()
+    conn = nsqd(writer.writer)
+    ack, ackers = writer._outbox.ack, []
+
+    def ack_record(record_id):
+        ackers.append(threading.current_thread())
+        ack(record_id)
+
+    writer._outbox.ack = ack_record
+    delivered = writer.publish("topic", b"body")
+    writer._flush_publish_queue()
+    conn.ack()
+
+    assert delivered.result(timeout=1) is None
+    wait_for_outbox_io(writer)
+    assert ackers and ackers[0] is not threading.current_thread()
+    assert writer._outbox.backlog == 0
+
+
+def test_failed_spooled_publish_waits_for_its_backoff(tmpdir, nsqd, monkeypatch):
+    monkeypatch.setattr(NSQWriter, "retry_delay", staticmethod(lambda attempt: 0.05 * attempt))
+    writer = NSQWriter(outbox_dir=str(tmpdir))
+    writer._outbox_drainer.stop()
+    conn = nsqd(writer.writer)
+
+    writer.send_message("topic", b"body")
+    writer._flush_publish_queue()
+    conn.ack(b"E_PUB_FAILED")
+
+    # still in flight until the backoff is over
+    assert writer._outbox.pending(10) == []
+    writer.io_loop.run_sync(lambda: gen.sleep(0.1))
+    assert [payload for _, _, payload, _ in writer._outbox.pending(10)] == [b"body"]
+
+
+def test_spooled_publish_is_dropped_after_the_max_attempts(tmpdir, nsqd, monkeypatch):
+    monkeypatch.setattr(nsqwriter, "PUB_RETRY_MAX_ATTEMPTS", 2)
+    monkeypatch.setattr(NSQWriter, "retry_delay", staticmethod(lambda attempt: 0))
+    writer = NSQWriter(outbox_dir=str(tmpdir))
+    writer._outbox_drainer.stop()
+    conn = nsqd(writer.writer)
+    dropped = []
+    writer.on_publish_dropped = lambda topic, payload, error: dropped.append((topic, payload))
+
+    delivered = writer.publish("topic", b"body")
+    writer._flush_publish_queue()
+    conn.ack(b"E_PUB_FAILED")
+    writer.io_loop.run_sync(lambda: gen.sleep(0.01))
+    writer._drain_outbox()
+    writer.io_loop.run_sync(lambda: gen.sleep(0.05))
+    conn.ack(b"E_PUB_FAILED")
+
+    assert dropped == [("topic", b"body")]
+    assert isinstance(delivered.exception(timeout=1), PublishError)
+    wait_for_outbox_io(writer)
+    assert writer._outbox.backlog == 0
@@ -0,0 +1,78 @@
+import json
+
+import nsq
+import pytest
+
+from nsqworker.basic_matchers import (apply_matcher, json_matcher, multi_matcher, predicate_field_matcher,
+                                      regex_matcher)
+from nsqworker.nsqhandler import NSQHandler, route
+from nsqworker.parsed_message import ParsedMessage, parse_message
+
+
+def test_parsed_message_decodes_once():
+    parsed = ParsedMessage(json.dumps({"name": "event", "data": {"id": 7}}).encode())
+
+    assert parsed.is_json
+    assert parsed.name == "event"
+    assert parsed.get("data:id") == 7
+    assert parsed.get("data:missing", default=0) == 0
+    assert parsed.json is parsed.json
+    assert parsed.mdict is parsed.mdict
+
+
+@pytest.mark.parametrize("body", [b"not json", b"[1, 2]", b"\xff"])
+def test_parsed_message_without_json_object(body):
+    parsed = ParsedMessage(body)
+
+    assert parsed.get("name") is None
+    assert parsed.name is None
+
+
+def test_parse_message_is_cached_on_the_message():
+    message = nsq.Message(b"0123456789abcdef", b'{"name": "event"}', 0, 1)
+
+    assert parse_message(message) is parse_message(message)
+
+
+def test_matchers_accept_parsed_messages_and_bodies():
+    body = json.dumps({"name": "event", "flag": True}).encode()
+    parsed = ParsedMessage(body)
+
+    for message in (parsed, body):
+        assert json_matcher("name", "event")(message)
+        assert not json_matcher("name", "other")(message)
+        assert predicate_field_matcher("flag")(message)
+        assert predicate_field_matcher("missing", inverse=True)(message)
+        assert multi_matcher(json_matcher("name", "event"), predicate_field_matcher("flag"))(message)
+    assert regex_matcher(b".*event")(parsed)
+    assert not json_matcher("name", "event")(ParsedMessage(b"not json"))
+
+
+def test_unmarked_matchers_receive_the_body():
+    parsed = ParsedMessage(b"raw")
+
+    assert apply_matcher(lambda body: body == b"raw", parsed)
+    assert multi_matcher(lambda body: body == b"raw")(parsed)
+    assert multi_matcher(json_matcher("name", "event")).index_key == ("name", "event")
+
+
+class LegacyExtractHandler(NSQHandler):
+    extracted = []
+
+    def extract(self, body):
+        self.extracted.append(body)
+        return json.loads(body)
+
+    @route(json_matcher("name", "event"))
+    def handle(self, message):
+        pass
+
+
+def test_extract_takes_a_body(create_handler):
+    handler = create_handler(LegacyExtractHandler)
+    message = nsq.Message(b"0123456789abcdef", b'{"name": "event", "id": 3}', 0, 1)
+
+    assert NSQHandler.extract(handler, message.body).get("id") == 3
+    assert NSQHandler.extract(handler, message) is parse_message(message)
+    assert handler._event(message) == {"name": "event", "id": 3}
+    assert LegacyExtractHandler.extracted == [message.body]
@@ -0,0 +1,77 @@
+import os
+import time
+
+import nsq
+import pytest
+from tornado import gen, ioloop
+
+from nsqworker.errors import TimeoutError
+from nsqworker.process_pool import ProcessDiedError, ProcessPool
+
+
+def handler(message):
+    if message.body == b"sleep":
+        time.sleep(30)
+    if message.body == b"exit":
+        os._exit(1)
+    if message.body == b"fail":
+        raise ValueError("failed")
+    if message.body == b"lock":
+        message.timings.add_lock_time(5.0)
+        return
+    message.requeue(delay=int(message.body))
+
+
+def run(coroutine):
+    return ioloop.IOLoop.current().run_sync(coroutine, timeout=10)
+
+
+@pytest.fixture
+def pool():
+    pool = ProcessPool(handler, 1)
+    yield pool
+    pool.close()
+
+
+def test_handler_response_and_error_come_back(pool):
+    @gen.coroutine
+    def submit():
+        requeued = yield pool.submit(nsq.Message(b"0123456789abcdef", b"5", 0, 1))
+        failed = yield pool.submit(nsq.Message(b"0123456789abcdef", b"fail", 0, 1))
+        raise gen.Return((requeued, failed))
+
+    requeued, failed = run(submit)
+
+    assert requeued.error is None and requeued.response == ("requeue", {"delay": 5})
+    assert isinstance(failed.error, ValueError) and failed.response is None
+
+
+def test_process_exceeding_the_timeout_is_killed_and_replaced(pool):
+    process, = pool._processes
+    start = time.monotonic()
+
+    with pytest.raises(TimeoutError):
+        run(lambda: pool.submit(nsq.Message(b"0123456789abcdef", b"sleep", 0, 1), timeout=0.2))
+
+    assert time.monotonic() - start < 5
+    assert not process.alive
+    replacement, = pool._processes
+    assert replacement is not process and replacement.alive
+    result = run(lambda: pool.submit(nsq.Message(b"0123456789abcdef", b"1", 0, 1)))
+    assert result.response == ("requeue", {"delay": 1})
+
+
+def test_dead_process_is_replaced(pool):
+    with pytest.raises(ProcessDiedError):
+        run(lambda: pool.submit(nsq.Message(b"0123456789abcdef", b"exit", 0, 1)))
+
+    result = run(lambda: pool.submit(nsq.Message(b"0123456789abcdef", b"2", 0, 1)))
+    assert result.response == ("requeue", {"delay": 2})
+
+
+def test_handler_start_and_lock_time_come_back(pool):
+    submitted = time.monotonic()
+    result = run(lambda: pool.submit(nsq.Message(b"0123456789abcdef", b"lock", 0, 1)))
+
+    assert submitted <= result.started <= time.monotonic()
+    assert result.lock_ms == 5.0
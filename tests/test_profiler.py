@@ -0,0 +1,82 @@
+import os
+import signal
+import threading
+import time
+
+import pytest
+
+from nsqworker.profiler import RouteProfiler
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_only_tagged_threads_are_sampled():
+    profiler = RouteProfiler(interval_ms=1)
+    profiler.sample()
+    assert profiler.folded() == ""
+
+    with profiler.tag("report", "event"):
+        profiler.sample()
+        profiler.sample()
+
+    stack, count = profiler.folded().strip().rsplit(" ", 1)
+    assert stack.startswith("report;event;") and "test_profiler.py:test_only_tagged_threads_are_sampled" in stack
+    assert count == "2"
+    assert profiler.route_samples() == {"report": 2}
+
+
+def test_nested_tags_restore_the_outer_one():
+    profiler = RouteProfiler(interval_ms=1)
+    with profiler.tag("outer", "event"):
+        with profiler.tag("inner", "event"):
+            pass
+        profiler.sample()
+
+    assert profiler.route_samples() == {"outer": 1}
+
+
+def test_write_resets_the_samples(tmp_path):
+    profiler = RouteProfiler(interval_ms=1, output=str(tmp_path / "profile-{pid}.folded"))
+    with profiler.tag("report", "event"):
+        profiler.sample()
+
+    path = profiler.write()
+
+    assert path == str(tmp_path / "profile-{}.folded".format(os.getpid()))
+    with open(path) as f:
+        assert f.read().startswith("report;event;")
+    assert profiler.folded() == ""
+
+
+def test_signal_handler_only_requests_the_write(tmp_path):
+    profiler = RouteProfiler(interval_ms=1, output=str(tmp_path / "profile.folded"))
+
+    profiler._on_signal(signal.SIGUSR2, None)
+
+    assert profiler._write_requested and not os.path.exists(profiler.output)
+
+
+@pytest.mark.skipif(threading.current_thread() is not threading.main_thread(), reason="signals need the main thread")
+def test_signal_writes_the_profile_from_the_sampler_thread(tmp_path, monkeypatch):
+    profiler = RouteProfiler(interval_ms=1, output=str(tmp_path / "profile.folded"))
+    writers = []
+    write = profiler.write
+    monkeypatch.setattr(profiler, "write", lambda: writers.append(threading.current_thread().name) or write())
+    previous = signal.getsignal(signal.SIGUSR2)
+    profiler.start()
+    try:
+        profiler.install_signal("SIGUSR2")
+        os.kill(os.getpid(), signal.SIGUSR2)
+
+        assert wait_for(lambda: os.path.exists(profiler.output))
+        assert writers == ["RouteProfiler"]
+    finally:
+        signal.signal(signal.SIGUSR2, previous)
+        profiler.stop()
@@ -0,0 +1,59 @@
+import json
+
+import nsq
+from nsq import protocol
+
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.nsqhandler import NSQHandler, route
+from nsqworker.retry import RetryPolicy, retry_body
+
+
+class FailingHandler(NSQHandler):
+    @route(json_matcher("name", "failing"), retry_policy=RetryPolicy(max_attempts=2, base_delay_ms=500, jitter=False))
+    def fail(self, message):
+        raise ValueError("failed")
+
+
+class IdempotentFailingHandler(NSQHandler):
+    @route(json_matcher("name", "failing"), is_idempotent=True, retry_policy=RetryPolicy(max_attempts=2))
+    def fail(self, message):
+        raise ValueError("failed")
+
+
+def test_retry_body_is_published_as_bytes():
+    body = retry_body({"name": "failing"}, "channel", ["fail"], 1)
+
+    assert isinstance(body, bytes)
+    assert json.loads(body) == {"name": "failing", "recipients": {"channel": ["fail"]}, "retry_attempt": 1}
+    protocol.dpub("topic", 500, body)
+
+
+def test_failed_route_retry_is_sent(create_handler, nsqd):
+    handler = create_handler(FailingHandler)
+    conn = nsqd(handler.writer)
+    delivered = []
+    handler._on_retry_delivery = lambda message, route, e, route_id, error: delivered.append(error)
+
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "failing"}).encode(), 0, 1)
+    handler.route_message(message)
+    handler._flush_publish_queue()
+
+    assert conn.sent == [protocol.dpub("topic", 500, retry_body({"name": "failing"}, "channel", ["fail"], 1))]
+    conn.ack()
+    assert delivered == [None]
+
+
+def test_exhausted_retry_policy_persists_without_requeue(create_handler, nsqd):
+    handler = create_handler(IdempotentFailingHandler)
+    conn = nsqd(handler.writer)
+    persisted = []
+    handler._persist_failed = lambda message, route, e, route_id: persisted.append(route.name)
+
+    body = {"name": "failing", "recipients": {"channel": ["fail"]}, "retry_attempt": 2}
+    message = nsq.Message(b"0123456789abcdef", json.dumps(body).encode(), 0, 1)
+    handler.route_message(message)
+    handler._flush_publish_queue()
+
+    assert persisted == ["fail"]
+    assert not message.has_responded()
+    assert conn.sent == []
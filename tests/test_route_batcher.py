@@ -0,0 +1,120 @@
+import concurrent.futures
+import json
+
+import nsq
+from nsq import protocol
+from tornado import gen, ioloop
+
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.lanes import KeyedLanes
+from nsqworker.nsqhandler import NSQHandler, batch_route, route
+from nsqworker.retry import retry_body
+from nsqworker.route_batcher import RouteBatcher
+
+
+def wait(seconds):
+    ioloop.IOLoop.current().run_sync(lambda: gen.sleep(seconds))
+
+
+def new_batcher(batches, max_size=3, max_wait=0.05, fail=False):
+    @gen.coroutine
+    def run_batch(items):
+        batches.append(items)
+        if fail:
+            raise ValueError("failed")
+
+    return RouteBatcher(run_batch, max_size, max_wait, ioloop.IOLoop.current())
+
+
+def test_full_batch_runs_right_away():
+    batches = []
+    batcher = new_batcher(batches)
+    futures = [concurrent.futures.Future() for _ in range(4)]
+
+    for i, future in enumerate(futures):
+        batcher.add(i, future)
+
+    assert batches == [[0, 1, 2]] and batcher.pending == 1
+    assert [f.done() for f in futures] == [True, True, True, False]
+
+
+def test_partial_batch_runs_after_max_wait():
+    batches = []
+    batcher = new_batcher(batches)
+    future = concurrent.futures.Future()
+
+    batcher.add("item", future)
+    assert batches == []
+    wait(0.1)
+
+    assert batches == [["item"]] and future.done() and batcher.pending == 0
+
+
+def test_failed_batch_still_resolves_its_futures():
+    batches = []
+    batcher = new_batcher(batches, max_size=1, fail=True)
+    future = concurrent.futures.Future()
+
+    batcher.add("item", future)
+
+    assert future.result(timeout=0) is None
+
+
+class BatchHandler(NSQHandler):
+    handled = []
+
+    @route(json_matcher("name", "event"))
+    def single(self, message):
+        self.handled.append("single")
+
+    @batch_route(json_matcher("name", "event"), max_size=2, max_wait=0.05, is_idempotent=True)
+    def store(self, messages):
+        self.handled.append("store")
+        return [ValueError("failed") if json.loads(m.body).get("fail") else None for m in messages]
+
+
+def new_message(i, body):
+    return nsq.Message(b"%016d" % i, json.dumps(body).encode(), 0, 1)
+
+
+def test_failed_batch_message_is_retried_for_the_batch_route_only(create_handler, nsqd):
+    handler = create_handler(BatchHandler, max_in_flight=2)
+    conn = nsqd(handler.writer)
+    BatchHandler.handled = []
+    failed, handled = new_message(1, {"name": "event", "fail": True}), new_message(2, {"name": "event"})
+    requeued = []
+    failed.on(nsq.event.REQUEUE, lambda message, **kwargs: requeued.append(kwargs))
+
+    done = [handler.route_message(message) for message in (failed, handled)]
+    wait(0.01)
+    for future in done:
+        future.result(timeout=1)
+    handler._flush_publish_queue()
+
+    assert BatchHandler.handled == ["single", "single", "store"]
+    assert requeued == [] and not failed.has_responded()
+    body, = [json.loads(cmd.split(b"\n", 1)[1][4:]) for cmd in conn.sent]
+    assert body == json.loads(retry_body({"name": "event", "fail": True}, "channel", ["store"], 1))
+    assert conn.sent[0].startswith(b"DPUB topic ")
+
+
+class LaneBatchHandler(BatchHandler):
+    handled = []
+
+
+def test_message_waits_for_its_batch_out_of_its_lane(create_handler):
+    handler = create_handler(LaneBatchHandler, worker_mode="async", max_in_flight=2)
+    handler.worker.shard_key = lambda message: "lane"
+    handler.worker.lanes = KeyedLanes(10)
+    LaneBatchHandler.handled = []
+    first, second = new_message(1, {"name": "event"}), new_message(2, {"name": "event"})
+
+    @gen.coroutine
+    def handle_both():
+        # the batch of 2 only runs once the second message got through the lane of the first
+        yield [handler.worker._message_handler(first), handler.worker._message_handler(second)]
+
+    ioloop.IOLoop.current().run_sync(handle_both, timeout=0.04)
+
+    assert LaneBatchHandler.handled == ["single", "single", "store"]
+    assert first.has_responded() and second.has_responded()
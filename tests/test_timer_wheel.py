@@ -0,0 +1,84 @@
+import time
+
+from tornado import gen, ioloop
+
+from nsqworker.timer_wheel import TimerWheel
+
+
+def wait(seconds):
+    ioloop.IOLoop.current().run_sync(lambda: gen.sleep(seconds))
+
+
+def test_timers_fire_in_deadline_order_never_early():
+    wheel = TimerWheel(tick_ms=10, slots=8)
+    fired = []
+    start = time.monotonic()
+
+    for delay_ms in (50, 20, 120):
+        wheel.schedule(delay_ms, lambda delay_ms: fired.append((delay_ms, time.monotonic() - start)), delay_ms)
+    assert len(wheel) == 3
+
+    wait(0.25)
+
+    assert [delay_ms for delay_ms, _ in fired] == [20, 50, 120]
+    assert all(elapsed * 1000 >= delay_ms for delay_ms, elapsed in fired)
+    # the wheel stops ticking once it has no timers
+    assert len(wheel) == 0 and not wheel._periodic.is_running()
+
+
+def test_cancelled_timer_doesnt_fire():
+    wheel = TimerWheel(tick_ms=10)
+    fired = []
+
+    kept = wheel.schedule(20, fired.append, "kept")
+    cancelled = wheel.schedule(20, fired.append, "cancelled")
+    wheel.cancel(cancelled)
+    wheel.cancel(None)
+    wait(0.1)
+
+    assert fired == ["kept"]
+    wheel.cancel(kept)
+    assert len(wheel) == 0
+
+
+def test_timer_cancelled_by_an_earlier_callback():
+    wheel = TimerWheel(tick_ms=10)
+    fired = []
+    timers = []
+
+    def first():
+        fired.append("first")
+        for timer in timers:
+            wheel.cancel(timer)
+
+    wheel.schedule(20, first)
+    timers.append(wheel.schedule(20, fired.append, "second"))
+    wait(0.1)
+
+    assert fired in (["first"], ["second", "first"])
+    assert len(wheel) == 0
+
+
+def test_timer_beyond_a_wheel_turn_waits_for_its_deadline():
+    wheel = TimerWheel(tick_ms=20, slots=4)
+    fired = []
+
+    # hashed into the same slot as a 40ms timer, a full turn later
+    wheel.schedule(120, fired.append, "late")
+    wheel.schedule(40, fired.append, "early")
+    wait(0.08)
+    assert fired == ["early"]
+
+    wait(0.1)
+    assert fired == ["early", "late"]
+
+
+def test_failing_callback_doesnt_stop_the_others():
+    wheel = TimerWheel(tick_ms=10)
+    fired = []
+
+    wheel.schedule(10, lambda: 1 / 0)
+    wheel.schedule(10, fired.append, "after")
+    wait(0.05)
+
+    assert fired == ["after"]
@@ -0,0 +1,34 @@
+from nsqworker.timing import STAGE_HANDLER, STAGE_LOCK, STAGE_TOTAL, STAGE_WAIT, MessageTimings
+
+
+def timings(received, started, handled, finished, lock_ms=0.0):
+    message_timings = MessageTimings()
+    message_timings.received = received
+    message_timings.start(started)
+    message_timings.add_lock_time(lock_ms)
+    message_timings.handled = handled
+    message_timings.finished = finished
+    return message_timings
+
+
+def test_stages_split_the_total_time():
+    stages = timings(10.0, 10.5, 11.5, 11.501, lock_ms=200.0).stages()
+
+    assert sorted(stages) == sorted([STAGE_WAIT, STAGE_LOCK, STAGE_HANDLER, STAGE_TOTAL])
+    assert round(stages[STAGE_WAIT]) == 500 and stages[STAGE_LOCK] == 200.0
+    assert round(stages[STAGE_HANDLER]) == 800 and round(stages[STAGE_TOTAL]) == 1501
+
+
+def test_start_is_stamped_once():
+    message_timings = MessageTimings()
+    message_timings.start(5.0)
+    message_timings.start()
+
+    assert message_timings.started == 5.0
+
+
+def test_spans_end_with_the_handler():
+    message_timings = timings(10.0, 10.5, 11.5, 11.501)
+
+    assert [(stage, round(duration)) for stage, _, duration in message_timings.spans()] == [
+        (STAGE_WAIT, 500), (STAGE_HANDLER, 1000)]
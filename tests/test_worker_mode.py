@@ -0,0 +1,54 @@
+import json
+import threading
+
+import nsq
+import pytest
+from tornado import gen, ioloop
+
+from nsqworker.basic_matchers import json_matcher
+from nsqworker.nsqhandler import NSQHandler, route
+
+
+class CoroutineHandler(NSQHandler):
+    @route(json_matcher("name", "event"))
+    async def handle(self, message):
+        pass
+
+
+@pytest.mark.parametrize("worker_mode", ["thread", "process"])
+def test_coroutine_route_needs_async_mode(create_handler, worker_mode):
+    with pytest.raises(ValueError, match="handle"):
+        create_handler(CoroutineHandler, worker_mode=worker_mode)
+
+
+def test_coroutine_route_in_async_mode(create_handler):
+    handler = create_handler(CoroutineHandler, worker_mode="async")
+
+    assert handler.worker_mode == "async"
+
+
+class MixedAsyncHandler(NSQHandler):
+    handled = []
+
+    @route(json_matcher("name", "event"))
+    async def handle(self, message):
+        await gen.sleep(0)
+        self.handled.append(("handle", threading.current_thread() is threading.main_thread()))
+
+    @route(json_matcher("name", "event"))
+    def audit(self, message):
+        self.handled.append(("audit", threading.current_thread() is threading.main_thread()))
+
+
+def test_coroutine_route_runs_on_the_ioloop(create_handler):
+    handler = create_handler(MixedAsyncHandler, worker_mode="async")
+    MixedAsyncHandler.handled = []
+    finished = []
+
+    message = nsq.Message(b"0123456789abcdef", json.dumps({"name": "event"}).encode(), 0, 1)
+    message.on(nsq.event.FINISH, lambda message, **kwargs: finished.append(message.id))
+    ioloop.IOLoop.current().run_sync(lambda: handler.worker._message_handler(message))
+
+    # the coroutine route runs on the IOLoop thread, the blocking one in the executor
+    assert MixedAsyncHandler.handled == [("handle", True), ("audit", False)]
+    assert finished == [message.id]